@@ -0,0 +1,154 @@
+"""Dynamic micro-batching for detector inference"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from concurrent.futures import Executor
+from typing import Any, Callable, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class _PendingItem:
+    """A single input waiting to be batched"""
+
+    tensor: Any
+    future: asyncio.Future[Any]
+    enqueued: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class InferenceBatcher:  # pylint: disable=R0902
+    """Collects inputs from concurrent callers into batches and runs them one batch at a time.
+
+    The runner is a blocking callable taking a list of inputs and returning a list of outputs in the same order,
+    it is executed in executor (the loop's default one if None) so the event loop stays responsive. Up to
+    concurrency batches run at the same time."""
+
+    runner: Callable[[list[Any]], list[Any]]
+    max_batch_size: int = 8
+    max_wait_ms: float = 10.0
+    executor: Optional[Executor] = None
+    concurrency: int = 1
+
+    batches: int = field(init=False, default=0)
+    images: int = field(init=False, default=0)
+    total_wait_ms: float = field(init=False, default=0.0)
+    max_wait_seen_ms: float = field(init=False, default=0.0)
+    total_run_ms: float = field(init=False, default=0.0)
+    last_batch_size: int = field(init=False, default=0)
+    in_progress: int = field(init=False, default=0)
+    last_wait_ms: float = field(init=False, default=0.0)
+    size_histogram: Counter[int] = field(init=False, default_factory=Counter)
+    _queue: Optional[asyncio.Queue[_PendingItem]] = field(init=False, default=None, repr=False)
+
+    @property
+    def queue(self) -> asyncio.Queue[_PendingItem]:
+        """The pending inputs, created lazily so it binds to the running loop"""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    async def predict(self, tensor: Any) -> Any:
+        """Queue the input for the next batch and wait for its own output"""
+        future: asyncio.Future[Any] = asyncio.get_running_loop().create_future()
+        await self.queue.put(_PendingItem(tensor, future))
+        return await future
+
+    async def _collect(self) -> list[_PendingItem]:
+        """Wait for the first input, then gather more until the batch is full or the oldest one waited long enough"""
+        batch = [await self.queue.get()]
+        deadline = batch[0].enqueued + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                # Take whatever is already waiting but do not wait for more
+                while len(batch) < self.max_batch_size and not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self) -> None:
+        """Batch loop, run this as a task"""
+        running: set[asyncio.Task[None]] = set()
+        try:
+            while True:
+                # Wait for a free slot before collecting so the batch can keep filling meanwhile
+                while len(running) >= max(1, self.concurrency):
+                    await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                batch = await self._collect()
+                # Callers that went away do not need a forward pass
+                batch = [item for item in batch if not item.future.done()]
+                if not batch:
+                    continue
+                task = asyncio.create_task(self._run_batch(batch))
+                running.add(task)
+                task.add_done_callback(running.discard)
+        except asyncio.CancelledError:
+            for task in running:
+                task.cancel()
+            LOGGER.debug("Cancelled")
+
+    async def _run_batch(self, batch: list[_PendingItem]) -> None:
+        """One forward pass, hand out the outputs (or the error) to the callers"""
+        started = time.monotonic()
+        self._record_batch(len(batch), (started - batch[0].enqueued) * 1000.0)
+        self.in_progress += 1
+        try:
+            outputs = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.runner, [item.tensor for item in batch]
+            )
+            # Without one output per input there is no telling which belongs to whom
+            if len(outputs) != len(batch):
+                raise RuntimeError("Runner returned {} outputs for {} inputs".format(len(outputs), len(batch)))
+        except Exception as exc:  # pylint: disable=W0718
+            LOGGER.error("Batch of {} failed: {}".format(len(batch), exc))
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(exc)
+            return
+        finally:
+            self.in_progress -= 1
+            self.total_run_ms += (time.monotonic() - started) * 1000.0
+        for item, output in zip(batch, outputs):
+            if not item.future.done():
+                item.future.set_result(output)
+
+    def _record_batch(self, size: int, wait_ms: float) -> None:
+        """Update the batch metrics"""
+        self.batches += 1
+        self.images += size
+        self.total_wait_ms += wait_ms
+        self.max_wait_seen_ms = max(self.max_wait_seen_ms, wait_ms)
+        self.last_batch_size = size
+        self.last_wait_ms = wait_ms
+        self.size_histogram[size] += 1
+        LOGGER.debug("Running batch of {} after waiting {:.1f}ms".format(size, wait_ms))
+
+    def stats(self) -> dict[str, Any]:
+        """Batch metrics for tuning throughput against latency"""
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_ms,
+            "pending": self.queue.qsize(),
+            "concurrency": self.concurrency,
+            "in_progress": self.in_progress,
+            "batches": self.batches,
+            "images": self.images,
+            "avg_batch_size": self.images / self.batches if self.batches else 0.0,
+            "avg_wait_ms": self.total_wait_ms / self.batches if self.batches else 0.0,
+            "max_wait_seen_ms": self.max_wait_seen_ms,
+            "avg_run_ms": self.total_run_ms / self.batches if self.batches else 0.0,
+            "last_batch_size": self.last_batch_size,
+            "last_wait_ms": self.last_wait_ms,
+            "size_histogram": {str(size): count for size, count in sorted(self.size_histogram.items())},
+        }
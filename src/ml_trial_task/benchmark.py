@@ -0,0 +1,119 @@
+"""Benchmarks for tuning the service on a given host"""
+
+from __future__ import annotations
+
+import dataclasses
+import logging
+import time
+from concurrent.futures import wait
+from typing import Any, Callable, Iterable
+
+import torch
+
+from .executor import ExecutorConfig, InferenceExecutor
+from .metrics import RollingHistogram
+from .models import ModelConfig, warm_up
+
+LOGGER = logging.getLogger(__name__)
+
+
+def benchmark_model(model_config: ModelConfig, *, batch_size: int, iterations: int, image_size: int) -> dict[str, Any]:
+    """Time forward passes of the configured model on random images"""
+    started = time.monotonic()
+    model = model_config.load()
+    load_s = time.monotonic() - started
+    warm_up(model, runs=1, batch_size=batch_size, image_size=image_size)
+    batch = [torch.rand(3, image_size, image_size) for _ in range(batch_size)]
+    started = time.monotonic()
+    with torch.inference_mode():
+        for _ in range(iterations):
+            model(batch)
+    elapsed = time.monotonic() - started
+    return {
+        "model": model_config.identity,
+        "batch_size": batch_size,
+        "image_size": image_size,
+        "iterations": iterations,
+        "threads": torch.get_num_threads(),
+        "load_s": load_s,
+        "batch_ms": elapsed * 1000.0 / iterations,
+        "images_per_s": batch_size * iterations / elapsed,
+    }
+
+
+def benchmark_models(
+    names: Iterable[str], base: ModelConfig, *, batch_size: int, iterations: int, image_size: int
+) -> list[dict[str, Any]]:
+    """Benchmark each named model with otherwise the same settings"""
+    results = []
+    for name in names:
+        model_config = dataclasses.replace(base, name=name)
+        LOGGER.info("Benchmarking {}".format(model_config.identity))
+        results.append(
+            benchmark_model(model_config, batch_size=batch_size, iterations=iterations, image_size=image_size)
+        )
+    return results
+
+
+def benchmark_inference(
+    model_config: ModelConfig,
+    settings: Iterable[ExecutorConfig],
+    *,
+    batch_size: int,
+    iterations: int,
+    image_size: int,
+) -> list[dict[str, Any]]:
+    """Throughput and batch latency of the model with each inference thread setting, all batches submitted at once.
+
+    The model is loaded once. Inter-op threads can only be set once per process, so only the first setting that
+    asks for them gets them."""
+    model = model_config.load()
+    warm_up(model, runs=1, batch_size=batch_size, image_size=image_size)
+    batch = [torch.rand(3, image_size, image_size) for _ in range(batch_size)]
+
+    def forward() -> float:
+        started = time.monotonic()
+        with torch.inference_mode():
+            model(batch)
+        return (time.monotonic() - started) * 1000.0
+
+    results = []
+    for executor_config in settings:
+        LOGGER.info("Benchmarking {} with {}".format(model_config.identity, executor_config.label))
+        latency, elapsed = _time_setting(forward, executor_config, iterations)
+        results.append(
+            {
+                "model": model_config.identity,
+                "setting": executor_config.label,
+                "workers": executor_config.workers,
+                "intra_op_threads": executor_config.threads_per_worker,
+                "interop_threads": torch.get_num_interop_threads(),
+                "pin_cpus": executor_config.pin_cpus,
+                "batch_size": batch_size,
+                "image_size": image_size,
+                "iterations": iterations,
+                "batch_ms": latency.stats(),
+                "images_per_s": batch_size * iterations / elapsed,
+            }
+        )
+    return results
+
+
+def _time_setting(
+    forward: Callable[[], float], executor_config: ExecutorConfig, iterations: int
+) -> tuple[RollingHistogram, float]:
+    """Run forward iterations times in the inference threads, return the latencies and the wall time"""
+    executor = InferenceExecutor(executor_config)
+    try:
+        # One forward pass per thread first so thread start-up is not timed
+        wait([executor.executor.submit(forward) for _ in range(executor_config.workers)])
+        started = time.monotonic()
+        futures = [executor.executor.submit(forward) for _ in range(iterations)]
+        wait(futures)
+        elapsed = time.monotonic() - started
+    finally:
+        executor.shutdown()
+    latency = RollingHistogram(window=max(1, iterations))
+    for future in futures:
+        latency.add(future.result())
+    return latency, elapsed
@@ -0,0 +1,175 @@
+"""On-disk cache of fetched image bodies, revalidated with the origin by ETag and Last-Modified"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import mmap
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedBody:
+    """A cached body (memory-mapped when it was looked up, so eviction can not pull it away) and its validators"""
+
+    data: mmap.mmap
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    def conditional_headers(self) -> dict[str, str]:
+        """Headers asking the origin to answer 304 if the copy is still current"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def close(self) -> None:
+        """Unmap, when the origin sent a new body instead"""
+        self.data.close()
+
+
+@dataclass
+class BodyCache:  # pylint: disable=R0902
+    """Bodies as files under directory with an sqlite index by URL, least recently used evicted by total bytes.
+
+    Only responses with an ETag or Last-Modified are kept, without them there is nothing to revalidate with.
+    The methods block on disk, call them in a thread."""
+
+    directory: Path
+    max_bytes: int = 1 << 30
+
+    hits: int = field(init=False, default=0)
+    misses: int = field(init=False, default=0)
+    stored: int = field(init=False, default=0)
+    evicted: int = field(init=False, default=0)
+    total_bytes: int = field(init=False, default=0)
+    _db: Optional[sqlite3.Connection] = field(init=False, default=None, repr=False)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self) -> None:
+        """Open the index"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.directory / "index.sqlite"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS bodies (key TEXT PRIMARY KEY, url TEXT NOT NULL, etag TEXT, "
+            "last_modified TEXT, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS bodies_last_access ON bodies (last_access)")
+        self._db.commit()
+        self.total_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+        LOGGER.info("Opened body cache {} with {} bytes".format(self.directory, self.total_bytes))
+
+    @staticmethod
+    def make_key(url: str) -> str:
+        """File name for the URL"""
+        return hashlib.blake2b(url.encode("utf-8"), digest_size=20).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        """Body file of the key, spread over subdirectories"""
+        return self.directory / key[:2] / key
+
+    def get(self, url: str) -> Optional[CachedBody]:
+        """The cached body of the URL (mapped) or None"""
+        assert self._db is not None
+        key = self.make_key(url)
+        with self._lock:
+            row = self._db.execute("SELECT etag, last_modified, size FROM bodies WHERE key = ?", (key,)).fetchone()
+            data = self._map(key, url, row[2]) if row is not None else None
+            if data is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE bodies SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            self.hits += 1
+        return CachedBody(data, row[0], row[1])
+
+    def _map(self, key: str, url: str, size: int) -> Optional[mmap.mmap]:
+        """Map the body file, drop the entry if that fails (removed from under us), with the lock held"""
+        assert self._db is not None
+        try:
+            with open(self._path(key), "rb") as fpntr:
+                return mmap.mmap(fpntr.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as exc:
+            LOGGER.warning("Dropping cached body of {}: {}".format(url, exc))
+            self._delete(key)
+            self._db.commit()
+            self.total_bytes -= size
+            return None
+
+    def put(self, url: str, body: bytes, etag: Optional[str], last_modified: Optional[str]) -> None:
+        """Store the body unless it can not be revalidated (or is empty or too big), evict to stay under max_bytes"""
+        assert self._db is not None
+        if not (etag or last_modified) or not body or len(body) > self.max_bytes:
+            return
+        key = self.make_key(url)
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        # Replaced in one go, a reader mapping the old file keeps its copy
+        fdesc, tmpname = tempfile.mkstemp(dir=path.parent, prefix=".tmp")
+        with os.fdopen(fdesc, "wb") as fpntr:
+            fpntr.write(body)
+        os.replace(tmpname, path)
+        with self._lock:
+            row = self._db.execute("SELECT size FROM bodies WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO bodies (key, url, etag, last_modified, size, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, url, etag, last_modified, len(body), time.time()),
+            )
+            self.total_bytes += len(body) - (row[0] if row else 0)
+            self.stored += 1
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self._db.commit()
+
+    def _evict(self) -> None:
+        """Drop the least recently used bodies until a tenth of the budget is free, with the lock held"""
+        assert self._db is not None
+        target = self.max_bytes - self.max_bytes // 10
+        for key, size in self._db.execute("SELECT key, size FROM bodies ORDER BY last_access ASC").fetchall():
+            if self.total_bytes <= target:
+                break
+            self._delete(key)
+            self.total_bytes -= size
+            self.evicted += 1
+
+    def _delete(self, key: str) -> None:
+        """Remove the body and its index row, with the lock held"""
+        assert self._db is not None
+        self._db.execute("DELETE FROM bodies WHERE key = ?", (key,))
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def close(self) -> None:
+        """Close the index"""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def stats(self) -> dict[str, Any]:
+        """Hit/miss counters and bytes kept"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stored": self.stored,
+            "evicted": self.evicted,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+        }
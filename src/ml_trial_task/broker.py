@@ -0,0 +1,414 @@
+"""Broker that spreads predict requests over several service instances and republishes their results"""
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+import logging
+import time
+import uuid
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Any, Optional, cast
+
+import zmq
+from datastreamcorelib.datamessage import PubSubDataMessage
+from datastreamcorelib.pubsub import PubSubMessage, Subscription
+from datastreamservicelib.reqrep import REPMixin, REQMixin
+from datastreamservicelib.service import SimpleService
+
+from .jobs import RESULTS_TOPIC, Job
+from .wire import FramesREPMixin, encode_message, predict_entries, send_command_with_frames
+
+LOGGER = logging.getLogger(__name__)
+# (name, None) for an URL, (name, bytes) for an inline image
+Entry = tuple[str, Optional[bytes]]
+
+
+def split_by_load(loads: list[int], total: int) -> list[int]:
+    """Shares of total that even out the loads as much as possible (the least loaded get the most)"""
+    if not loads:
+        return []
+    order = sorted(range(len(loads)), key=lambda idx: loads[idx])
+    # Raise the water level over the least loaded workers until the total is used up
+    filled = count = level = 0
+    while count < len(order):
+        filled += loads[order[count]]
+        count += 1
+        level = (total + filled) // count
+        if count < len(order) and level <= loads[order[count]]:
+            break
+    shares = [0] * len(loads)
+    for idx in order[:count]:
+        shares[idx] = max(0, level - loads[idx])
+    # Integer division leaves a few over, they go to the least loaded
+    for idx in itertools.islice(itertools.cycle(order[:count]), total - sum(shares)):
+        shares[idx] += 1
+    return shares
+
+
+@dataclass
+class WorkerState:  # pylint: disable=R0902
+    """A service instance as the broker sees it from its heartbeats and the work sent to it"""
+
+    rep: str
+    pub: str
+    last_seen: float = field(default=0.0)
+    ready: bool = field(default=False)
+    # As reported in the last heartbeat
+    queued: int = field(default=0)
+    free: int = field(default=0)
+    # Images sent by the broker without a result yet, and how many of them the last heartbeat already counted
+    assigned: int = field(default=0)
+    assigned_at_report: int = field(default=0)
+    completed: int = field(default=0)
+
+    def alive(self, timeout_s: float) -> bool:
+        """Has there been a heartbeat recently"""
+        return bool(self.last_seen) and time.monotonic() - self.last_seen < timeout_s
+
+    @property
+    def sent_since_report(self) -> int:
+        """Images sent after the last heartbeat, it does not count them yet"""
+        return max(0, self.assigned - self.assigned_at_report)
+
+    @property
+    def load(self) -> int:
+        """Images waiting or being processed"""
+        return self.queued + self.sent_since_report
+
+    def report(self, load: dict[str, Any]) -> None:
+        """Update from the load of a heartbeat"""
+        self.last_seen = time.monotonic()
+        self.ready = bool(load.get("ready", True))
+        self.queued = int(load.get("queued", 0))
+        self.free = int(load.get("free", 0))
+        self.assigned_at_report = self.assigned
+
+    def stats(self, timeout_s: float) -> dict[str, Any]:
+        """State for the broker stats"""
+        return {
+            "rep": self.rep,
+            "pub": self.pub,
+            "alive": self.alive(timeout_s),
+            "ready": self.ready,
+            "queued": self.queued,
+            "free": self.free,
+            "assigned": self.assigned,
+            "completed": self.completed,
+            "last_seen_s": time.monotonic() - self.last_seen if self.last_seen else None,
+        }
+
+
+@dataclass
+class Assignment:
+    """Images of a job sent to one worker, under a job ID of its own"""
+
+    job_id: str
+    job: Job
+    worker: WorkerState
+    entries: list[Entry]
+    # Names still waiting for a result (a name can be there more than once)
+    pending: Counter[str] = field(default_factory=Counter)
+
+    def __post_init__(self) -> None:
+        """Everything is pending at first"""
+        self.pending.update(name for name, _ in self.entries)
+
+    def remaining(self) -> list[Entry]:
+        """Entries without a result"""
+        pending = self.pending.copy()
+        entries = []
+        for name, data in self.entries:
+            if pending[name] > 0:
+                pending[name] -= 1
+                entries.append((name, data))
+        return entries
+
+
+@dataclass
+class ImageBroker(FramesREPMixin, REPMixin, REQMixin, SimpleService):  # pylint: disable=R0901,R0902
+    """Exposes the predict API of the service and shards each request over the worker services in [broker] workers.
+
+    Workers are alive while their heartbeats keep coming and get shares that even out the queue depth they report.
+    Their results are republished on the job topic of the broker, so clients do not see the workers. Images a dead
+    worker did not finish are sent again to the others (or held until a worker is back)."""
+
+    workers: dict[str, WorkerState] = field(init=False, default_factory=dict, repr=False)
+    heartbeat_timeout_s: float = field(init=False, default=3.0, repr=False)
+    request_timeout_s: float = field(init=False, default=10.0, repr=False)
+    max_priority: int = field(init=False, default=10, repr=False)
+    # Prefix of the job IDs the broker uses with the workers, so it only subscribes to the results of its own
+    session: str = field(init=False, default_factory=lambda: uuid.uuid4().hex[:12], repr=False)
+    jobs: dict[str, Job] = field(init=False, default_factory=dict, repr=False)
+    jobs_completed: int = field(init=False, default=0, repr=False)
+    assignments: dict[str, Assignment] = field(init=False, default_factory=dict, repr=False)
+    # Accepted images waiting for a live worker, with their job
+    unassigned: deque[tuple[Job, list[Entry]]] = field(init=False, default_factory=deque, repr=False)
+    reassigned: int = field(init=False, default=0, repr=False)
+    _seq: itertools.count[int] = field(init=False, default_factory=itertools.count, repr=False)
+
+    def reload(self) -> None:
+        """Load configs, restart sockets and subscribe to the workers"""
+        super().reload()
+        config = self.config.get("broker", {})
+        self.heartbeat_timeout_s = float(config.get("heartbeat_timeout_s", 3.0))
+        self.request_timeout_s = float(config.get("request_timeout_s", 10.0))
+        self.max_priority = int(config.get("max_priority", 10))
+        workers = {}
+        for worker_config in config.get("workers", []):
+            rep, pub = worker_config["rep"], worker_config["pub"]
+            # Keep the state (and the work assigned) of the workers that stay
+            workers[rep] = self.workers.get(rep) or WorkerState(rep, pub)
+            workers[rep].pub = pub
+        for rep, worker in self.workers.items():
+            if rep not in workers:
+                LOGGER.warning("Worker {} removed from the config, reassigning its work".format(rep))
+                self._orphan(worker)
+        self.workers = workers
+        # Reloading closed the sockets
+        for worker in self.workers.values():
+            self.psmgr.subscribe_async(
+                Subscription(
+                    worker.pub,
+                    ["HEARTBEAT", f"{RESULTS_TOPIC}/{self.session}-"],
+                    self._on_message,
+                    decoder_class=PubSubDataMessage,
+                    metadata={"rep": worker.rep},
+                )
+            )
+        if not self.tm.exists("WATCHDOG"):
+            self.tm.create_task(self._watchdog(), name="WATCHDOG")
+
+    def live_workers(self) -> list[WorkerState]:
+        """Workers with a recent heartbeat and the model loaded"""
+        return [worker for worker in self.workers.values() if worker.ready and worker.alive(self.heartbeat_timeout_s)]
+
+    async def predict(  # pylint: disable=R0913,R0917
+        self,
+        urls: list[str],
+        job_id: Optional[str] = None,
+        priority: int = 1,
+        inline: Optional[list[str]] = None,
+        frames: Optional[list[bytes]] = None,
+        ttl_s: Optional[float] = None,
+    ) -> dict[str, Any]:
+        """Same as the predict of the service: the accepted images are spread over the live workers and the results
+        published on results/<job_id>/ followed by the completion marker. What no worker accepts is rejected.
+        The workers get what is left of ttl_s, images of a dead worker are not sent again once it has passed."""
+        try:
+            job = Job.for_request(job_id, priority, self.max_priority, ttl_s)
+            entries = predict_entries(urls, inline, frames)
+        except ValueError as exc:
+            return {"status": "error", "error": str(exc)}
+        if job.job_id in self.jobs:
+            return {"status": "error", "error": f"Job {job.job_id} is still running"}
+        if not self.live_workers():
+            return {"status": "error", "error": "No live workers"}
+        # Register first, results may arrive before the workers have all answered
+        self.jobs[job.job_id] = job
+        job.expected = len(entries)
+        rejected = await self._assign(job, entries)
+        job.expected = len(entries) - len(rejected)
+        if not job.expected:
+            self.jobs.pop(job.job_id, None)
+        elif job.done and job.job_id in self.jobs:
+            await self._complete_job(job)
+        status = "processing"
+        if rejected:
+            status = "partial" if job.expected else "rejected"
+            LOGGER.warning("Workers full, rejected {} of {} images".format(len(rejected), len(entries)))
+        return {
+            "status": status,
+            "job_id": job.job_id,
+            "topic": job.topic,
+            "priority": job.priority,
+            "ttl_s": ttl_s,
+            "num_images": job.expected,
+            "num_rejected": len(rejected),
+            "num_workers": len({assignment.worker.rep for assignment in self._assignments_of(job)}),
+        }
+
+    async def _assign(self, job: Job, entries: list[Entry]) -> list[Entry]:
+        """Send the entries to the live workers in shares that even out their load, return what none accepted.
+
+        Entries are taken in order and a worker accepts a head of its share, so the rejected ones are a tail."""
+        if job.is_expired():
+            await self._expire(job, entries)
+            return []
+        remaining = deque(entries)
+        workers = sorted(self.live_workers(), key=lambda worker: worker.load)
+        shares = split_by_load([worker.load for worker in workers], len(remaining))
+        full: set[str] = set()
+        for worker, share in zip(workers, shares):
+            if remaining and share:
+                chunk = [remaining.popleft() for _ in range(min(share, len(remaining)))]
+                rest = await self._send(job, worker, chunk)
+                if rest:
+                    full.add(worker.rep)
+                    remaining.extendleft(reversed(rest))
+        # The rest of a full worker goes to whoever still has room
+        for worker in workers:
+            if remaining and worker.rep not in full:
+                chunk = list(remaining)
+                remaining.clear()
+                remaining.extend(await self._send(job, worker, chunk))
+        return list(remaining)
+
+    async def _send(self, job: Job, worker: WorkerState, chunk: list[Entry]) -> list[Entry]:
+        """Send the chunk to the worker as a job of its own, return the entries it did not accept"""
+        # The service accepts the URLs before the inline images
+        chunk = sorted(chunk, key=lambda entry: entry[1] is not None)
+        job_id = f"{self.session}-{next(self._seq)}"
+        urls = [name for name, data in chunk if data is None]
+        inline = [(name, data) for name, data in chunk if data is not None]
+        # Registered before sending, results may come before the reply
+        assignment = Assignment(job_id, job, worker, chunk)
+        # The worker refuses a ttl_s of 0, just past the deadline it expires the images itself
+        ttl_s = job.remaining_s()
+        if ttl_s is not None:
+            ttl_s = max(ttl_s, 0.001)
+        self.assignments[job_id] = assignment
+        worker.assigned += len(chunk)
+        try:
+            reply = await send_command_with_frames(
+                self,
+                worker.rep,
+                "predict",
+                [data for _, data in inline],
+                urls,
+                job_id=job_id,
+                priority=job.priority,
+                inline=[name for name, _ in inline],
+                ttl_s=ttl_s,
+                timeout=self.request_timeout_s,
+            )
+            response = reply.data.get("response") or {}
+        except (asyncio.TimeoutError, zmq.ZMQBaseError) as exc:
+            LOGGER.error("predict to worker {} failed: {}".format(worker.rep, exc))
+            response = {"status": "error", "error": str(exc)}
+        if response.get("status") == "error":
+            LOGGER.warning("Worker {} did not take the images: {}".format(worker.rep, response.get("error")))
+        accepted = int(response.get("num_images", 0))
+        worker.assigned = max(0, worker.assigned - (len(chunk) - accepted))
+        if not accepted:
+            # Anything published for it anyway is dropped
+            self.assignments.pop(job_id, None)
+            return chunk
+        assignment.entries = chunk[:accepted]
+        # Results already received for the accepted entries stay counted
+        received = Counter(name for name, _ in chunk) - assignment.pending
+        assignment.pending = Counter(name for name, _ in assignment.entries) - received
+        if not assignment.pending:
+            self.assignments.pop(job_id, None)
+        return chunk[accepted:]
+
+    async def _expire(self, job: Job, entries: list[Entry]) -> None:
+        """Publish expired results for the entries instead of sending them to a worker"""
+        for name, _ in entries:
+            data = {"url": name, "error": "Deadline passed before assignment", "expired": True, "job_id": job.job_id}
+            await self.psmgr.publish_async(PubSubDataMessage(topic=job.topic, data=data))
+            job.record(failed=False, cached=False, coalesced=False, expired=True)
+        if job.done and job.job_id in self.jobs:
+            await self._complete_job(job)
+
+    def _assignments_of(self, job: Job) -> list[Assignment]:
+        """Assignments still waiting for results of the job"""
+        return [assignment for assignment in self.assignments.values() if assignment.job is job]
+
+    def _orphan(self, worker: WorkerState) -> None:
+        """Queue what the worker did not finish for the other workers"""
+        for job_id, assignment in list(self.assignments.items()):
+            if assignment.worker is not worker:
+                continue
+            del self.assignments[job_id]
+            remaining = assignment.remaining()
+            self.reassigned += len(remaining)
+            self.unassigned.append((assignment.job, remaining))
+        worker.assigned = worker.assigned_at_report = 0
+
+    async def _watchdog(self) -> None:
+        """Notice dead workers and send their unfinished images elsewhere"""
+        dead: set[str] = set()
+        try:
+            while True:
+                await asyncio.sleep(min(0.5, self.heartbeat_timeout_s / 2))
+                for worker in self.workers.values():
+                    if worker.alive(self.heartbeat_timeout_s):
+                        dead.discard(worker.rep)
+                    elif worker.rep not in dead and worker.last_seen:
+                        dead.add(worker.rep)
+                        LOGGER.warning("Worker {} missed its heartbeats, reassigning its work".format(worker.rep))
+                        self._orphan(worker)
+                await self._assign_orphans()
+        except asyncio.CancelledError:
+            LOGGER.debug("Cancelled")
+
+    async def _assign_orphans(self) -> None:
+        """Try the held images again, in order"""
+        for _ in range(len(self.unassigned)):
+            if not self.live_workers():
+                return
+            job, entries = self.unassigned.popleft()
+            if job.job_id not in self.jobs:
+                continue
+            rest = await self._assign(job, entries)
+            if rest:
+                self.unassigned.appendleft((job, rest))
+                return
+
+    async def _on_message(self, sub: Subscription, msg: PubSubMessage) -> None:
+        """Heartbeats update the worker, results are republished for the job they belong to"""
+        msg = cast(PubSubDataMessage, msg)
+        worker = self.workers.get(sub.metadata["rep"])
+        if worker is None:
+            return
+        if msg.topic == b"HEARTBEAT":
+            worker.report(msg.data.get("load") or {})
+            return
+        assignment = self.assignments.get(msg.data.get("job_id", ""))
+        url = msg.data.get("url")
+        # Completion markers of the workers are not needed, the broker counts the results itself. Results from
+        # a worker the images were taken away from (or duplicates) are dropped.
+        if assignment is None or assignment.worker is not worker or url is None or assignment.pending[url] <= 0:
+            return
+        assignment.pending[url] -= 1
+        if not +assignment.pending:
+            self.assignments.pop(assignment.job_id, None)
+        worker.assigned = max(0, worker.assigned - 1)
+        worker.completed += 1
+        job = assignment.job
+        await self.psmgr.publish_async(encode_message(job.topic, {**msg.data, "job_id": job.job_id}, msg.dataparts[2:]))
+        expired = bool(msg.data.get("expired"))
+        job.record(
+            "error" in msg.data and not expired, bool(msg.data.get("cached")), bool(msg.data.get("coalesced")), expired
+        )
+        if job.done and job.job_id in self.jobs:
+            await self._complete_job(job)
+
+    async def _complete_job(self, job: Job) -> None:
+        """Publish the completion marker of the job and forget it"""
+        self.jobs.pop(job.job_id, None)
+        self.jobs_completed += 1
+        await self.psmgr.publish_async(PubSubDataMessage(topic=job.topic, data=job.summary()))
+        LOGGER.info("Job {} complete".format(job.job_id))
+
+    async def categories(self) -> dict[str, Any]:
+        """The category table of the workers (they are expected to run the same model)"""
+        for worker in self.live_workers():
+            try:
+                reply = await self.send_command(worker.rep, "categories", timeout=self.request_timeout_s)
+                return cast(dict[str, Any], reply.data["response"])
+            except (asyncio.TimeoutError, zmq.ZMQBaseError) as exc:
+                LOGGER.error("categories from worker {} failed: {}".format(worker.rep, exc))
+        return {"model": None, "categories": []}
+
+    async def stats(self) -> dict[str, Any]:
+        """Worker liveness and load, jobs and the images waiting for a worker"""
+        return {
+            "workers": [worker.stats(self.heartbeat_timeout_s) for worker in self.workers.values()],
+            "jobs": {"active": len(self.jobs), "completed": self.jobs_completed},
+            "assignments": len(self.assignments),
+            "unassigned": sum(len(entries) for _, entries in self.unassigned),
+            "reassigned": self.reassigned,
+        }
@@ -0,0 +1,90 @@
+"""Global memory budget the images being decoded and inferred reserve their estimated footprint from"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class MemoryBudget:
+    """Reservations in bytes granted in arrival order, later ones wait until enough is released.
+
+    A reservation larger than the whole budget is cut to the budget, so it still runs, alone. limit 0 only counts."""
+
+    limit: int = 0
+    in_use: int = field(init=False, default=0)
+    peak: int = field(init=False, default=0)
+    # Reservations that had to wait
+    waited: int = field(init=False, default=0)
+    _waiters: deque[tuple[int, asyncio.Future[None]]] = field(init=False, default_factory=deque, repr=False)
+
+    def resize(self, limit: int) -> None:
+        """Change the limit, the reservations made so far still count"""
+        self.limit = limit
+        self._wake()
+
+    async def reserve(self, nbytes: int) -> int:
+        """Wait until nbytes fit, return the bytes reserved (to pass to release)"""
+        if self.limit:
+            nbytes = min(nbytes, self.limit)
+        if not self._waiters and self._fits(nbytes):
+            self._take(nbytes)
+            return nbytes
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._waiters.append((nbytes, future))
+        self.waited += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just before the cancel
+                self.release(nbytes)
+            else:
+                self._waiters.remove((nbytes, future))
+                self._wake()
+            raise
+        return nbytes
+
+    def release(self, nbytes: int) -> None:
+        """Give back (a part of) a reservation"""
+        self.in_use = max(0, self.in_use - nbytes)
+        self._wake()
+
+    def _fits(self, nbytes: int) -> bool:
+        """Is there room for nbytes more"""
+        return not self.limit or self.in_use + nbytes <= self.limit
+
+    def _take(self, nbytes: int) -> None:
+        """Count a granted reservation"""
+        self.in_use += nbytes
+        self.peak = max(self.peak, self.in_use)
+
+    def _wake(self) -> None:
+        """Grant the waiting reservations that fit now, in order"""
+        while self._waiters:
+            nbytes, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if not self._fits(nbytes):
+                break
+            self._waiters.popleft()
+            self._take(nbytes)
+            future.set_result(None)
+
+    def stats(self) -> dict[str, Any]:
+        """Bytes in use against the budget"""
+        return {
+            "limit_bytes": self.limit,
+            "in_use_bytes": self.in_use,
+            "peak_bytes": self.peak,
+            "utilization": self.in_use / self.limit if self.limit else 0.0,
+            "waiting": len(self._waiters),
+            "waited": self.waited,
+        }
@@ -0,0 +1,158 @@
+"""Content-addressed cache of detection results"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Mapping, Optional
+
+from .fetcher import ImageData
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class ResultCache:  # pylint: disable=R0902
+    """In-memory LRU of detection results with an optional sqlite tier that survives restarts.
+
+    Keys are digests of the image bytes plus everything that changes the output for the same bytes
+    (model identity and score threshold), see make_key. The disk tier is queried in a thread, memory hits
+    are answered right away."""
+
+    max_entries: int = 10000
+    path: Optional[Path] = None
+    max_disk_entries: int = 100000
+
+    hits: int = field(init=False, default=0)
+    disk_hits: int = field(init=False, default=0)
+    misses: int = field(init=False, default=0)
+    _entries: OrderedDict[str, dict[str, Any]] = field(init=False, default_factory=OrderedDict, repr=False)
+    _db: Optional[sqlite3.Connection] = field(init=False, default=None, repr=False)
+    _disk_count: int = field(init=False, default=0, repr=False)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self) -> None:
+        """Open the disk tier if configured"""
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        self._db.commit()
+        self._disk_count = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        LOGGER.info("Opened result cache {} with {} entries".format(self.path, self._disk_count))
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> ResultCache:
+        """Create from the [cache] config section, empty path disables the disk tier"""
+        path = str(config.get("path", ""))
+        return cls(
+            max_entries=int(config.get("max_entries", cls.max_entries)),
+            path=Path(path) if path else None,
+            max_disk_entries=int(config.get("max_disk_entries", cls.max_disk_entries)),
+        )
+
+    @staticmethod
+    def make_key(data: ImageData, model_id: str, threshold: float) -> str:
+        """Digest of the image bytes and the settings that affect the result"""
+        digest = hashlib.blake2b(data, digest_size=20)
+        digest.update(f"\0{model_id}\0{threshold!r}".encode("utf-8"))
+        return digest.hexdigest()
+
+    async def get(self, key: str) -> Optional[dict[str, Any]]:
+        """Return the cached result or None"""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        if self._db is not None:
+            result = await asyncio.to_thread(self._disk_get, key)
+            if result is not None:
+                self._remember(key, result)
+                self.hits += 1
+                self.disk_hits += 1
+                return result
+        self.misses += 1
+        return None
+
+    def _disk_get(self, key: str) -> Optional[dict[str, Any]]:
+        """Look the key up in the disk tier, blocks"""
+        with self._lock:
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+        result: dict[str, Any] = json.loads(row[0])
+        return result
+
+    async def put(self, key: str, result: dict[str, Any]) -> None:
+        """Store the result in memory and on disk"""
+        self._remember(key, result)
+        if self._db is None:
+            return
+        await asyncio.to_thread(self._disk_put, key, json.dumps(result))
+
+    def _disk_put(self, key: str, encoded: str) -> None:
+        """Write the result to the disk tier, trim it if over its bound, blocks"""
+        with self._lock:
+            if self._db is None:
+                return
+            # Replacing an existing key does not add a row
+            exists = self._db.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone() is not None
+            self._db.execute(
+                "INSERT OR REPLACE INTO results (key, result, last_access) VALUES (?, ?, ?)",
+                (key, encoded, time.time()),
+            )
+            self._disk_count += int(not exists)
+            if self._disk_count > self.max_disk_entries:
+                # Trim the least recently used tenth in one go instead of one row per insert
+                excess = self._disk_count - self.max_disk_entries + self.max_disk_entries // 10
+                self._db.execute(
+                    "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_access ASC LIMIT ?)",
+                    (excess,),
+                )
+                self._disk_count = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            self._db.commit()
+
+    def _remember(self, key: str, result: dict[str, Any]) -> None:
+        """Put into the memory tier, evicting the least recently used entries"""
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def close(self) -> None:
+        """Close the disk tier, waits for a query running in a thread"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self) -> dict[str, Any]:
+        """Hit/miss counters and sizes"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "disk_entries": self._disk_count if self._db is not None else 0,
+        }
@@ -1,11 +1,12 @@
 """CLI entrypoints for ml-trial-task"""
 
 import asyncio
-import csv
+import itertools
+import json
 import logging
 import sys
 from pathlib import Path
-from typing import Any, cast
+from typing import Any, Iterable, cast
 
 import click
 import toml
@@ -16,10 +17,13 @@ from datastreamservicelib.reqrep import REQMixin
 from datastreamservicelib.zmqwrappers import PubSubManager, SocketHandler
 
 from ml_trial_task import __version__
-from ml_trial_task.defaultconfig import DEFAULT_CONFIG_STR
-from ml_trial_task.service import ImagePredictionService
+from ml_trial_task.defaultconfig import DEFAULT_BROKER_CONFIG_STR, DEFAULT_CONFIG_STR
+from ml_trial_task.jobs import job_topic, new_job_id
+from ml_trial_task.wire import decode_message, send_command_with_frames
 
 LOGGER = logging.getLogger(__name__)
+# Seconds to let a new subscription connect before triggering the messages it should get
+SUBSCRIBE_GRACE_S = 0.3
 
 
 def dump_default_config(ctx: Any, param: Any, value: bool) -> None:  # pylint: disable=W0613
@@ -31,6 +35,15 @@ def dump_default_config(ctx: Any, param: Any, value: bool) -> None:  # pylint: d
         ctx.exit()
 
 
+def dump_default_broker_config(ctx: Any, param: Any, value: bool) -> None:  # pylint: disable=W0613
+    """Print the default broker config and exit"""
+    if not value:
+        return
+    click.echo(DEFAULT_BROKER_CONFIG_STR)
+    if ctx:
+        ctx.exit()
+
+
 @click.group()
 def cli() -> None:
     """Main command group for ml-trial-task."""
@@ -51,6 +64,9 @@ def cli() -> None:
 @click.argument("configfile", type=click.Path(exists=True))
 def run_service(configfile: Path, loglevel: int, verbose: int) -> None:
     """Run the ml-trial-task service."""
+    # torch and torchvision load here, not for the client commands
+    from ml_trial_task.service import ImagePredictionService  # pylint: disable=C0415
+
     if verbose == 1:
         loglevel = 20
     if verbose >= 2:
@@ -63,6 +79,34 @@ def run_service(configfile: Path, loglevel: int, verbose: int) -> None:
     sys.exit(exitcode)
 
 
+@cli.command(name="broker")
+@click.option("-l", "--loglevel", help="Python log level, 10=DEBUG, 20=INFO, 30=WARNING, 40=CRITICAL", default=30)
+@click.option("-v", "--verbose", count=True, help="Shorthand for info/debug loglevel (-v/-vv)")
+@click.option(
+    "--defaultconfig",
+    is_flag=True,
+    callback=dump_default_broker_config,
+    expose_value=False,
+    is_eager=True,
+    help="Show default broker config",
+)
+@click.argument("configfile", type=click.Path(exists=True))
+def run_broker(configfile: Path, loglevel: int, verbose: int) -> None:
+    """Run a broker spreading predict requests over several services, use its sockets like those of a service."""
+    from ml_trial_task.broker import ImageBroker  # pylint: disable=C0415
+
+    if verbose == 1:
+        loglevel = 20
+    if verbose >= 2:
+        loglevel = 10
+    init_logging(loglevel)
+    LOGGER.setLevel(loglevel)
+
+    broker_instance = ImageBroker(Path(configfile))
+    exitcode = asyncio.get_event_loop().run_until_complete(broker_instance.run())
+    sys.exit(exitcode)
+
+
 @cli.command(name="predict")
 @click.option(
     "-u",
@@ -77,71 +121,413 @@ def run_service(configfile: Path, loglevel: int, verbose: int) -> None:
     type=click.Path(exists=True),
     help="CSV file with image URLs (assumes URL is in the first column)",
 )
+@click.option(
+    "-i",
+    "--image",
+    "images",
+    type=click.Path(exists=True, dir_okay=False),
+    multiple=True,
+    help="Local image file to send with the request itself instead of as a URL, can be repeated",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(),
+    help="Stream the URLs in chunks and write the results to this .jsonl or .parquet file instead of printing them",
+)
+@click.option("-p", "--priority", help="Share of the service relative to other requests (1 = normal)", default=1)
+@click.option("--column", help="CSV column of the URLs when streaming", default=0)
+@click.option("--chunk-size", help="URLs per predict command when streaming", default=100)
+@click.option("--window", help="Most images waiting for a result at a time when streaming", default=1000)
+@click.option("--progress-interval", help="Seconds between progress lines when streaming", default=2.0)
 @click.argument("configfile", type=click.Path(exists=True))
-def run_predict(configfile: Path, urls: str, csv_file: str) -> None:
+def run_predict(  # pylint: disable=R0913,R0917
+    configfile: Path,
+    urls: str,
+    csv_file: str,
+    images: tuple[str, ...],
+    output: str,
+    priority: int,
+    column: int,
+    chunk_size: int,
+    window: int,
+    progress_interval: float,
+) -> None:
     """
     Send a predict command to a running service and listen for published results.
     The service will publish detection results on the "results" topic.
+
+    With --output the CSV is read lazily and sent in chunks, for lists too big to send (or print) at once.
     """
-    url_list: list[str] = []
-    if urls:
-        url_list.extend([u.strip() for u in urls.split(",") if u.strip()])
-    if csv_file:
-        with open(csv_file, newline="", encoding="utf-8") as f:
-            reader = csv.reader(f)
-            # Skip the header row
-            next(reader)
-            for row in reader:
-                if row:
-                    url_list.append(row[0])
-    if not url_list:
+    from ml_trial_task.streaming import read_urls  # pylint: disable=C0415
+
+    if output:
+        if images:
+            raise click.UsageError("--image can not be used with --output")
+        source: Iterable[str] = [u.strip() for u in urls.split(",") if u.strip()]
+        if csv_file:
+            source = itertools.chain(source, read_urls(Path(csv_file), column=column))
+        stream_predict(Path(configfile), source, Path(output), chunk_size, window, progress_interval, priority)
+        return
+
+    url_list = [u.strip() for u in urls.split(",") if u.strip()]
+    url_list.extend(read_urls(Path(csv_file), column=column) if csv_file else [])
+    if not url_list and not images:
         click.echo("No URLs provided. Use --urls or --csv to supply image URLs.")
         return
 
     click.echo(f"URLs provided: {url_list}\n")
-    expected_count = len(url_list)
+    # Sent as they are in frames after the command, the results name them by the file name
+    frames = [Path(image).read_bytes() for image in images]
 
     async def predict_and_listen() -> None:
-        nonlocal expected_count
-
-        # Send the predict command over the REP socket.
         requester = REQMixin(Path(configfile))
         requester.config = toml.load(Path(configfile))
-        response = await requester.send_command(requester.config["zmq"]["rep_sockets"][0], "predict", url_list)
-        click.echo(f"Predict command response: {response}\n")
-
-        # Extract the expected number of results from the response.
-        received_count = 0
+        rep_socket = requester.config["zmq"]["rep_sockets"][0]
+        job_id = new_job_id()
         done_event = asyncio.Event()
+        categories: list[str] = []
 
         async def message_callback(sub: Subscription, msg: PubSubMessage) -> None:  # pylint: disable=W0613
             """Callback for subscription. Just log the message."""
 
-            nonlocal received_count
+            nonlocal categories
             # We know it's actually datamessage but the broker deals with the parent type
             msg = cast(PubSubDataMessage, msg)
-            click.echo(f"Received: {msg}")
-            received_count += 1
-            if received_count >= expected_count:
+            if msg.data.get("job_id") != job_id:
+                return
+            if msg.data.get("complete"):
+                click.echo(f"\nJob complete: {msg.data}")
                 done_event.set()
+                return
+            if msg.data.get("encoding") == "binary":
+                # Labels are indices into the category table, fetch it once
+                if not categories:
+                    reply = await requester.send_command(rep_socket, "categories")
+                    categories = reply.data["response"]["categories"]
+                click.echo(f"Received: {decode_message(msg, categories)}")
+            else:
+                click.echo(f"Received: {msg}")
 
-        # Subscribe to the "results" topic on the PUB socket.
+        # Subscribe to the topic of our own job on the PUB socket before sending the request,
+        # the socket filters out the results of other clients
         subscriber = Subscription(
             requester.config["zmq"]["pub_sockets"][0],
-            "results",
+            job_topic(job_id),
             message_callback,
             decoder_class=PubSubDataMessage,
         )
         pub_sub_manager = PubSubManager(SocketHandler)
         pub_sub_manager.subscribe_async(subscriber)
-        click.echo("Subscribed and waiting for results\n")
+        # Give the subscription a moment to connect, results published before that would be lost
+        await asyncio.sleep(SUBSCRIBE_GRACE_S)
 
-        # Wait until all expected messages are received.
+        # Send the predict command over the REP socket.
+        response = await send_command_with_frames(
+            requester,
+            rep_socket,
+            "predict",
+            frames,
+            url_list,
+            job_id=job_id,
+            priority=priority,
+            inline=[Path(image).name for image in images],
+        )
+        click.echo(f"Predict command response: {response}\n")
+        reply = response.data.get("response") or {}
+        if reply.get("status") == "error":
+            click.echo(f"Predict failed: {reply.get('error')}")
+            return
+        if reply.get("num_rejected"):
+            # The service may accept only part of the list when its queue is full
+            click.echo(f"Service queue is full, {reply['num_rejected']} URLs were rejected\n")
+        if not reply.get("num_images"):
+            click.echo("Nothing to wait for, exiting.")
+            return
+        click.echo(f"Waiting for the results of job {job_id}\n")
+
+        # The service publishes a completion marker after the last result of the job
         await done_event.wait()
         click.echo("All results received, exiting.")
 
     asyncio.run(predict_and_listen())
 
 
+def stream_predict(  # pylint: disable=R0913,R0917
+    configfile: Path,
+    urls: Iterable[str],
+    output: Path,
+    chunk_size: int,
+    window: int,
+    progress_interval: float,
+    priority: int = 1,
+) -> None:
+    """Send the URLs in chunks through a StreamingSubmitter and write the results to output"""
+    from ml_trial_task.streaming import Progress, StreamingSubmitter, make_sink  # pylint: disable=C0415
+
+    sink = make_sink(output)
+
+    async def submit() -> StreamingSubmitter:
+        requester = REQMixin(configfile)
+        requester.config = toml.load(configfile)
+        submitter = StreamingSubmitter(
+            requester,
+            requester.config["zmq"]["rep_sockets"][0],
+            requester.config["zmq"]["pub_sockets"][0],
+            sink,
+            chunk_size=chunk_size,
+            window=window,
+            priority=priority,
+            progress=Progress(progress_interval, click.echo),
+        )
+        await submitter.run(urls, subscribe_grace_s=SUBSCRIBE_GRACE_S)
+        return submitter
+
+    submitter = asyncio.run(submit())
+    click.echo(f"Wrote {submitter.received} results ({submitter.errors} errors) to {output}")
+
+
+@cli.command(name="profile")
+@click.option("-s", "--seconds", help="Seconds to profile for", default=10.0)
+@click.option("-m", "--mode", type=click.Choice(["sample", "cprofile"]), help="Profiler", default="sample")
+@click.option("--torch-ops", is_flag=True, help="Also time the operators of the forward passes")
+@click.option("-n", "--top", help="Functions and operators to show", default=25)
+@click.option("-o", "--output", type=click.Path(), help="Also write the summary to this JSON file")
+@click.argument("configfile", type=click.Path(exists=True))
+def run_profile(  # pylint: disable=R0913,R0917
+    configfile: Path, seconds: float, mode: str, torch_ops: bool, top: int, output: str
+) -> None:
+    """Profile a running service and show where its time goes."""
+
+    async def profile() -> dict[str, Any]:
+        requester = REQMixin(Path(configfile))
+        requester.config = toml.load(Path(configfile))
+        reply = await requester.send_command(
+            requester.config["zmq"]["rep_sockets"][0],
+            "profile",
+            seconds,
+            mode=mode,
+            torch_ops=torch_ops,
+            top=top,
+            wait=True,
+            timeout=seconds + 30.0,
+        )
+        return cast(dict[str, Any], reply.data["response"])
+
+    summary = asyncio.run(profile())
+    if summary.get("status") == "error":
+        raise click.ClickException(summary["error"])
+    click.echo(f"Profiled for {summary['seconds']:.1f}s ({summary['mode']})")
+    for row in summary["functions"]:
+        share = f"{row['own'] * 100:6.1f}% {row['total'] * 100:6.1f}%" if "own" in row else f"{row['own_s']:8.3f}s"
+        click.echo(f"{share}  {row['function']}")
+    if "torch" in summary:
+        click.echo(f"\nOperators over {summary['torch']['forward_passes']} forward passes")
+        for row in summary["torch"]["operators"]:
+            click.echo(f"{row['own_ms']:10.1f}ms {row['calls']:6d}  {row['operator']}")
+    if output:
+        Path(output).write_text(json.dumps(summary, indent=2), encoding="utf-8")
+
+
+@cli.group(name="benchmark")
+def benchmark() -> None:
+    """Benchmarks for tuning the service on this machine."""
+
+
+@benchmark.command(name="models")
+@click.option(
+    "-m",
+    "--models",
+    "model_names",
+    help="Comma-separated list of models to compare (default: all)",
+    default="",
+)
+@click.option("-b", "--batch-size", help="Images per forward pass", default=1)
+@click.option("-n", "--iterations", help="Timed forward passes per model", default=5)
+@click.option("-s", "--image-size", help="Width and height of the random test images", default=640)
+@click.option("--quantize", is_flag=True, help="Dynamic int8 quantization of the box heads (Faster R-CNN models only)")
+@click.option("--random-weights", is_flag=True, help="Do not load pretrained weights (no network access needed)")
+@click.option("--cache-dir", help="Local weights cache", default="~/.cache/ml_trial_task")
+@click.option("-o", "--output", type=click.Path(), help="Also write the results to this JSON file")
+def run_benchmark_models(  # pylint: disable=R0913,R0917
+    model_names: str,
+    batch_size: int,
+    iterations: int,
+    image_size: int,
+    quantize: bool,
+    random_weights: bool,
+    cache_dir: str,
+    output: str,
+) -> None:
+    """Report images/sec per detection model."""
+    from ml_trial_task.benchmark import benchmark_models  # pylint: disable=C0415
+    from ml_trial_task.models import MODELS, ModelConfig  # pylint: disable=C0415
+
+    # Only the models quantize applies to unless named
+    names = [name.strip() for name in model_names.split(",") if name.strip()] or [
+        name for name, spec in MODELS.items() if spec.quantizable or not quantize
+    ]
+    base = ModelConfig(
+        quantize=quantize, pretrained=not random_weights, cache_dir=Path(cache_dir) if cache_dir else None
+    )
+    try:
+        results = benchmark_models(names, base, batch_size=batch_size, iterations=iterations, image_size=image_size)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc), param_hint="--models") from exc
+    for result in results:
+        click.echo("{model}: {images_per_s:.2f} images/s ({batch_ms:.1f}ms per batch of {batch_size})".format(**result))
+    if output:
+        Path(output).write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+
+def parse_settings(ctx: Any, param: Any, value: str) -> list[tuple[int, int]]:  # pylint: disable=W0613
+    """Parse "1x4,2x2" into (workers, threads) tuples"""
+    try:
+        return [
+            (int(workers), int(threads))
+            for workers, threads in (pair.strip().lower().split("x") for pair in value.split(",") if pair.strip())
+        ]
+    except ValueError as exc:
+        raise click.BadParameter("use WORKERSxTHREADS[,WORKERSxTHREADS...]") from exc
+
+
+@benchmark.command(name="inference")
+@click.option("-m", "--model", help="Detection model", default="fasterrcnn_mobilenet_v3_large_320_fpn")
+@click.option(
+    "-t",
+    "--settings",
+    help="Comma-separated WORKERSxTHREADS inference thread settings to compare, threads 0 divides the cores",
+    default="1x0,2x0,4x0",
+    callback=parse_settings,
+)
+@click.option("--pin", is_flag=True, help="Also run each setting with the workers pinned to their own cores")
+@click.option("--interop-threads", help="torch inter-op threads (0 keeps the default)", default=0)
+@click.option("-b", "--batch-size", help="Images per forward pass", default=1)
+@click.option("-n", "--iterations", help="Forward passes per setting", default=8)
+@click.option("-s", "--image-size", help="Width and height of the random test images", default=640)
+@click.option("--random-weights", is_flag=True, help="Do not load pretrained weights (no network access needed)")
+@click.option("-o", "--output", type=click.Path(), help="Also write the results to this JSON file")
+def run_benchmark_inference(  # pylint: disable=R0913,R0917
+    model: str,
+    settings: list[tuple[int, int]],
+    pin: bool,
+    interop_threads: int,
+    batch_size: int,
+    iterations: int,
+    image_size: int,
+    random_weights: bool,
+    output: str,
+) -> None:
+    """Compare inference worker and torch thread settings ([inference] config) on this machine."""
+    from ml_trial_task.benchmark import benchmark_inference  # pylint: disable=C0415
+    from ml_trial_task.executor import ExecutorConfig  # pylint: disable=C0415
+    from ml_trial_task.models import ModelConfig  # pylint: disable=C0415
+
+    configs = [
+        ExecutorConfig(workers=workers, intra_op_threads=threads, interop_threads=interop_threads, pin_cpus=pinned)
+        for workers, threads in settings
+        for pinned in ((False, True) if pin else (False,))
+    ]
+    results = benchmark_inference(
+        ModelConfig(name=model, pretrained=not random_weights),
+        configs,
+        batch_size=batch_size,
+        iterations=iterations,
+        image_size=image_size,
+    )
+    for result in results:
+        click.echo(
+            "{setting}: {images_per_s:.2f} images/s, batch p50 {p50:.1f}ms p95 {p95:.1f}ms".format(
+                **result, **result["batch_ms"]
+            )
+        )
+    if output:
+        Path(output).write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+
+def parse_sizes(ctx: Any, param: Any, value: str) -> list[tuple[int, int]]:  # pylint: disable=W0613
+    """Parse "640x480,1920x1080" into (width, height) tuples"""
+    try:
+        return [
+            (int(width), int(height))
+            for width, height in (size.strip().lower().split("x") for size in value.split(",") if size.strip())
+        ]
+    except ValueError as exc:
+        raise click.BadParameter("use WIDTHxHEIGHT[,WIDTHxHEIGHT...]") from exc
+
+
+@benchmark.command(name="load")
+@click.option("-r", "--rate", help="predict commands per second", default=2.0)
+@click.option("-n", "--list-size", help="URLs per predict command", default=4)
+@click.option("--requests", help="Number of predict commands to send", default=20)
+@click.option("--sizes", help="Image sizes in the corpus", default="640x480,1920x1080,4000x3000", callback=parse_sizes)
+@click.option("--formats", help="Image formats in the corpus", default="jpeg,png")
+@click.option("-m", "--model", help="Detection model the service runs", default="fasterrcnn_mobilenet_v3_large_320_fpn")
+@click.option("--pretrained", is_flag=True, help="Use the pretrained weights instead of random ones (needs network)")
+@click.option("--cache", is_flag=True, help="Keep the result cache enabled")
+@click.option(
+    "--config", "configfile", type=click.Path(exists=True), help="Base service config (default config if not set)"
+)
+@click.option("-o", "--output", type=click.Path(), help="Also write the report to this JSON file")
+def run_benchmark_load(  # pylint: disable=R0913,R0917
+    rate: float,
+    list_size: int,
+    requests: int,
+    sizes: list[tuple[int, int]],
+    formats: str,
+    model: str,
+    pretrained: bool,
+    cache: bool,
+    configfile: str,
+    output: str,
+) -> None:
+    """Run the service against a local image server and report throughput, latency and memory."""
+    from ml_trial_task.loadtest import LoadTest, LoadTestConfig  # pylint: disable=C0415
+
+    config = LoadTestConfig(
+        rate=rate,
+        list_size=list_size,
+        requests=requests,
+        sizes=sizes,
+        formats=[fmt.strip() for fmt in formats.split(",") if fmt.strip()],
+        model=model,
+        pretrained=pretrained,
+        cache=cache,
+        base_config=Path(configfile) if configfile else None,
+    )
+
+    async def run() -> dict[str, Any]:
+        return await LoadTest(config).run()
+
+    report = asyncio.run(run())
+    click.echo(json.dumps(report, indent=2))
+    if output:
+        Path(output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+
+@benchmark.command(name="imports")
+@click.option("-n", "--runs", help="Fresh interpreters per command, the fastest counts", default=3)
+@click.option("-o", "--output", type=click.Path(), help="Also write the report to this JSON file")
+@click.argument("commands", nargs=-1)
+def run_benchmark_imports(runs: int, output: str, commands: tuple[str, ...]) -> None:
+    """Time the imports each command needs (python -X importtime), by default of every command.
+
+    The client commands must not import torch, torchvision or aiohttp, they only talk to the service."""
+    from ml_trial_task.importtime import CLIENT_COMMANDS, COMMAND_MODULES, measure_commands  # pylint: disable=C0415
+
+    unknown = set(commands) - set(COMMAND_MODULES)
+    if unknown:
+        raise click.BadParameter("unknown commands {}".format(", ".join(sorted(unknown))), param_hint="COMMANDS")
+    report = measure_commands(commands or COMMAND_MODULES, runs)
+    for row in report:
+        heavy = ", ".join(row["heavy"]) or "-"
+        click.echo(f"{row['command']:<22} {row['import_ms']:8.0f}ms {row['modules']:5d} modules  heavy: {heavy}")
+    if output:
+        Path(output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    regressed = [row["command"] for row in report if row["command"] in CLIENT_COMMANDS and row["heavy"]]
+    if regressed:
+        raise click.ClickException("Client commands import heavy modules: {}".format(", ".join(regressed)))
+
+
 if __name__ == "__main__":
     cli()
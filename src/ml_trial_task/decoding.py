@@ -0,0 +1,119 @@
+"""Image decoding at (roughly) the resolution the model works at"""
+
+from __future__ import annotations
+
+import io
+import logging
+import math
+import mmap
+from dataclasses import dataclass
+from typing import Any, Mapping, Optional
+
+import torch
+from PIL import Image
+from torchvision.transforms.functional import pil_to_tensor
+
+from .fetcher import ImageData
+
+LOGGER = logging.getLogger(__name__)
+
+
+class DecodeError(RuntimeError):
+    """The image can not or should not be decoded"""
+
+
+@dataclass
+class DecodedImage:
+    """uint8 [3, H, W] tensor and the size of the original image"""
+
+    tensor: torch.Tensor
+    width: int
+    height: int
+
+    @property
+    def scale(self) -> tuple[float, float]:
+        """Factors from the decoded image coordinates to the original ones"""
+        return self.width / self.tensor.shape[2], self.height / self.tensor.shape[1]
+
+
+@dataclass(frozen=True)
+class Decoder:
+    """Decodes straight to a size the model resize step only needs to scale down by less than half.
+
+    The sizes mirror the GeneralizedRCNNTransform of the detector: the shorter side is resized to min_size
+    unless that makes the longer one exceed max_size, or to fixed_size (width, height) regardless of aspect.
+    JPEGs are decoded at a reduced DCT scale (PIL draft mode), other formats are reduced after decoding.
+    max_pixels rejects images by their header before any pixels are decoded, 0 disables the check."""
+
+    min_size: int = 800
+    max_size: int = 1333
+    fixed_size: Optional[tuple[int, int]] = None
+    max_pixels: int = 50_000_000
+
+    @classmethod
+    def for_model(cls, model: torch.nn.Module, config: Mapping[str, Any]) -> Decoder:
+        """Sizes from the model transform, limits from the [decode] config section"""
+        max_pixels = int(config.get("max_pixels", cls.max_pixels))
+        transform = getattr(model, "transform", None)
+        if transform is None:
+            LOGGER.warning("Model has no resize transform, decoding at the default size")
+            return cls(max_pixels=max_pixels)
+        fixed_size = getattr(transform, "fixed_size", None)
+        return cls(
+            min_size=int(min(transform.min_size)),
+            max_size=int(transform.max_size),
+            fixed_size=(int(fixed_size[0]), int(fixed_size[1])) if fixed_size else None,
+            max_pixels=max_pixels,
+        )
+
+    def target_size(self, width: int, height: int) -> tuple[int, int]:
+        """Size the model resizes the image to"""
+        if self.fixed_size is not None:
+            return self.fixed_size
+        scale = min(self.min_size / min(width, height), self.max_size / max(width, height))
+        return max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale))
+
+    @staticmethod
+    def _source(data: ImageData) -> Any:
+        """File-like object for PIL"""
+        if isinstance(data, mmap.mmap):
+            # Read straight from the mapped file
+            data.seek(0)
+            return data
+        return io.BytesIO(data)
+
+    def _check(self, width: int, height: int) -> None:
+        """Reject decompression bombs"""
+        if self.max_pixels and width * height > self.max_pixels:
+            raise DecodeError(f"Image too large: {width}x{height} is over {self.max_pixels} pixels")
+
+    def footprint(self, data: ImageData) -> int:
+        """Estimated peak bytes held for the image from its header: the encoded bytes, the decoded (and converted)
+        pixels and the uint8 and float32 tensors. Nothing is decoded."""
+        with Image.open(self._source(data)) as image:
+            width, height = image.size
+            self._check(width, height)
+            target_w, target_h = self.target_size(width, height)
+            bands = len(image.getbands())
+            converted = image.mode != "RGB"
+            image.draft("RGB", (target_w, target_h))
+            decoded_w, decoded_h = image.size
+        factor = max(1, min(decoded_w // target_w, decoded_h // target_h))
+        pixels = decoded_w * decoded_h
+        tensor_pixels = (decoded_w // factor) * (decoded_h // factor)
+        return len(data) + pixels * (bands + 3 * int(converted)) + tensor_pixels * (3 + 3 * 4)
+
+    def decode(self, data: ImageData) -> DecodedImage:
+        """Decode to an RGB uint8 tensor no smaller than the target size"""
+        with Image.open(self._source(data)) as image:
+            width, height = image.size
+            self._check(width, height)
+            target_w, target_h = self.target_size(width, height)
+            # JPEG only, decodes at 1/2, 1/4 or 1/8 scale as long as the result stays at least the requested size
+            image.draft("RGB", (target_w, target_h))
+            rgb = image.convert("RGB")
+        # Other formats (or what draft could not reduce enough) get box filtered by the remaining whole factor
+        factor = min(rgb.width // target_w, rgb.height // target_h)
+        if factor >= 2:
+            rgb = rgb.reduce(factor)
+        return DecodedImage(pil_to_tensor(rgb), width, height)
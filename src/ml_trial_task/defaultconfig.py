@@ -6,4 +6,166 @@ DEFAULT_CONFIG_STR = """
 pub_sockets = ["ipc:///tmp/ml_trial_task_pub.sock", "tcp://*:56853"]
 rep_sockets = ["ipc:///tmp/ml_trial_task_rep.sock", "tcp://*:56854"]
 
+[model]
+# One of fasterrcnn_resnet50_fpn_v2, fasterrcnn_resnet50_fpn, fasterrcnn_mobilenet_v3_large_fpn,
+# fasterrcnn_mobilenet_v3_large_320_fpn, retinanet_resnet50_fpn_v2, retinanet_resnet50_fpn, fcos_resnet50_fpn,
+# ssd300_vgg16, ssdlite320_mobilenet_v3_large. Compare them with "ml_trial_task benchmark models".
+name = "fasterrcnn_resnet50_fpn_v2"
+# Detections scoring lower than this are dropped
+score_threshold = 0.8
+# Dynamic int8 quantization of the Linear layers, i.e. the box heads of the fasterrcnn_* models. The backbones
+# (convolutions) stay float, the other models have no Linear layers and refuse this setting.
+quantize = false
+# false gives random weights, only useful for load testing without network access
+pretrained = true
+# Local copy of the weights, the torchvision hub is only used the first time. Empty disables the cache.
+cache_dir = "~/.cache/ml_trial_task"
+# Forward passes on a dummy batch before the service reports ready
+warmup_runs = 1
+warmup_batch_size = 1
+warmup_image_size = 512
+
+[queue]
+# Accepted images waiting to be fetched, predict rejects what does not fit
+max_depth = 1000
+# "fair" interleaves the images of concurrent predict requests so a small request is not stuck behind a big one,
+# each request gets a share of the workers proportional to its priority. "fifo" processes images in arrival order.
+policy = "fair"
+# Largest priority predict accepts (the default priority is 1)
+max_priority = 10
+# Seconds the results of a predict request without its own ttl_s are wanted for, images not fetched or not run
+# through the model by then are skipped with an "expired" result. 0 waits for ever.
+default_ttl_s = 0
+
+[pipeline]
+# Workers per stage, fetch -> decode -> preprocess -> infer -> publish
+fetch_workers = 64
+decode_workers = 4
+preprocess_workers = 2
+# Images handed to the batcher at a time, keep this at least batching.max_batch_size
+infer_workers = 16
+publish_workers = 1
+# Bound for the queues between stages
+stage_queue_size = 64
+
+[sources]
+# Directories predict may read file:// URLs from (memory-mapped instead of fetched), empty disables file:// URLs
+file_roots = []
+
+[memory]
+# MiB the images being decoded and inferred may take, each reserves its estimated footprint (from the image header)
+# before decoding and waits while the budget is used up. 0 disables the limit.
+budget_mb = 2048
+
+[decode]
+# Images are decoded at about the size the model resizes them to, this rejects images with more pixels than this
+# (by the header, before decoding) to protect against decompression bombs. 0 disables the check.
+max_pixels = 50000000
+
+[batching]
+# Upper bound for images per forward pass
+max_batch_size = 8
+# How long the oldest queued image may wait for the batch to fill up
+max_wait_ms = 10.0
+
+[inference]
+# Forward passes running at the same time, each in its own dedicated thread (used when procpool is disabled)
+workers = 1
+# Size of torch's intra-op pool, 0 gives it the CPU cores divided by workers. The pool is process-wide and shared
+# by the workers, it does not partition the cores between them (pin_cpus does that for the worker threads).
+intra_op_threads = 0
+# torch inter-op threads, 0 keeps the torch default. Can only be set once, changing it needs a restart.
+interop_threads = 0
+# Pin each inference thread to its own share of the cores, Linux only
+pin_cpus = false
+
+[procpool]
+# Run decode, preprocess and inference in this many worker processes, 0 keeps everything in the service process
+workers = 0
+# torch threads inside each worker process
+threads_per_worker = 1
+# Where the weights shared (memory-mapped) by the workers are saved if model.cache_dir is not set,
+# defaults to a temp dir of the service (removed when it stops)
+state_path = ""
+
+[cache]
+# Detection results kept in memory, keyed by image content, model and threshold
+max_entries = 10000
+# sqlite file for results that survive restarts, leave empty to keep results in memory only
+path = ""
+max_disk_entries = 100000
+
+[results]
+# "json" publishes the detections as lists in the message data. "binary" packs the boxes, label indices and scores
+# in extra frames, decode them with ml_trial_task.wire.decode_message and the "categories" REP command.
+encoding = "json"
+# float16 or float32, for the binary encoding
+score_dtype = "float16"
+
+[metrics]
+# Seconds between publishing the stats on the "metrics" topic, 0 disables
+interval_s = 10.0
+# Latest images the p50/p95/p99 latencies are calculated over
+window = 1024
+# Seconds the images/s and bytes/s rates are averaged over
+rate_window_s = 60
+
+[profiling]
+# Directory the summaries of the "profile" REP command are written to as JSON, empty only publishes them
+output_dir = ""
+# Longest profile the command accepts, in seconds
+max_seconds = 300
+
+[http]
+# Connection pool size in total and per origin host
+limit = 100
+limit_per_host = 16
+# Seconds to cache DNS lookups
+dns_cache_ttl = 300
+# Seconds
+connect_timeout = 10.0
+read_timeout = 30.0
+# Seconds for all of one attempt (connecting, waiting and reading the body), 0 disables
+total_timeout = 60.0
+# Extra attempts after connection errors, timeouts and HTTP 408, 429 and 5xx. The wait before each is random
+# between 0 and backoff_base * 2^attempt seconds, at most backoff_max.
+retries = 2
+backoff_base = 0.2
+backoff_max = 5.0
+# Send a second request for an image when the first has not finished after the hedge_percentile latency of the
+# recent fetches (at least hedge_min_delay seconds), the first to arrive is used
+hedge = false
+hedge_percentile = 95
+hedge_min_delay = 0.1
+# After this many failures in a row requests to the host fail fast for breaker_reset_s seconds, 0 disables
+breaker_failures = 5
+breaker_reset_s = 30.0
+# Directory to keep fetched bodies in, a URL fetched before is revalidated with the origin and on
+# 304 Not Modified read from here. Only bodies with an ETag or Last-Modified are kept. Empty disables.
+body_cache_dir = ""
+# Megabytes of bodies to keep, the least recently used are removed first
+body_cache_max_mb = 1024
+
+""".lstrip()
+
+# Config of "ml_trial_task broker", remember to add tests for keys into test_broker.py
+DEFAULT_BROKER_CONFIG_STR = """
+[zmq]
+# Clients use these exactly like the sockets of a single service
+pub_sockets = ["ipc:///tmp/ml_trial_task_broker_pub.sock", "tcp://*:56855"]
+rep_sockets = ["ipc:///tmp/ml_trial_task_broker_rep.sock", "tcp://*:56856"]
+
+[broker]
+# Seconds without a heartbeat before a worker is considered dead and its unfinished images are sent elsewhere
+heartbeat_timeout_s = 3.0
+# Seconds to wait for a worker to answer a predict
+request_timeout_s = 10.0
+# Largest priority predict accepts, keep this at most the queue.max_priority of the workers
+max_priority = 10
+
+# The REP and PUB sockets of each worker service, add one [[broker.workers]] section per worker
+[[broker.workers]]
+rep = "ipc:///tmp/ml_trial_task_rep.sock"
+pub = "ipc:///tmp/ml_trial_task_pub.sock"
+
 """.lstrip()
@@ -0,0 +1,163 @@
+"""Dedicated threads for forward passes, with the torch thread settings and optional CPU pinning"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Mapping, Optional, TypeVar
+
+import torch
+
+LOGGER = logging.getLogger(__name__)
+T = TypeVar("T")
+# torch allows setting the inter-op thread count only once per process, before any inter-op work
+_INTEROP_LOCK = threading.Lock()
+_INTEROP_SET: list[int] = []
+
+
+def available_cpus() -> list[int]:
+    """CPUs this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_sets(workers: int, cpus: Optional[list[int]] = None) -> list[list[int]]:
+    """Split the CPUs into workers contiguous groups, workers share CPUs round-robin if there are more of them"""
+    cpus = cpus if cpus is not None else available_cpus()
+    workers = max(1, workers)
+    if workers >= len(cpus):
+        return [[cpus[idx % len(cpus)]] for idx in range(workers)]
+    per_worker, extra = divmod(len(cpus), workers)
+    sets = []
+    start = 0
+    for idx in range(workers):
+        end = start + per_worker + int(idx < extra)
+        sets.append(cpus[start:end])
+        start = end
+    return sets
+
+
+def set_interop_threads(threads: int) -> bool:
+    """Set torch inter-op threads if not done yet in this process, False if torch refused (too late)"""
+    with _INTEROP_LOCK:
+        if _INTEROP_SET:
+            if _INTEROP_SET[0] != threads:
+                LOGGER.warning("Inter-op threads already set to {}, restart to change them".format(_INTEROP_SET[0]))
+            return _INTEROP_SET[0] == threads
+        try:
+            torch.set_num_interop_threads(threads)
+        except RuntimeError as exc:
+            LOGGER.warning("Could not set inter-op threads to {}: {}".format(threads, exc))
+            return False
+        _INTEROP_SET.append(threads)
+        return True
+
+
+@dataclass(frozen=True)
+class ExecutorConfig:
+    """The [inference] config section.
+
+    workers forward passes run at the same time. torch has one intra-op pool per process, intra_op_threads sets its
+    size (0 gives it an equal share of the CPUs per worker, so the workers together do not oversubscribe the CPU) but
+    the workers share the pool, it does not split the cores between them. With pin_cpus each worker thread is pinned
+    to its own share of the CPUs (Linux only)."""
+
+    workers: int = 1
+    intra_op_threads: int = 0
+    interop_threads: int = 0
+    pin_cpus: bool = False
+
+    def __post_init__(self) -> None:
+        """Fail early on nonsense"""
+        if self.workers < 1:
+            raise ValueError("inference workers must be at least 1")
+        if self.intra_op_threads < 0 or self.interop_threads < 0:
+            raise ValueError("thread counts must be 0 (automatic) or positive")
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> ExecutorConfig:
+        """Create from the [inference] config section"""
+        return cls(
+            workers=int(config.get("workers", cls.workers)),
+            intra_op_threads=int(config.get("intra_op_threads", cls.intra_op_threads)),
+            interop_threads=int(config.get("interop_threads", cls.interop_threads)),
+            pin_cpus=bool(config.get("pin_cpus", cls.pin_cpus)),
+        )
+
+    @property
+    def threads_per_worker(self) -> int:
+        """intra_op_threads, or an equal share of the CPUs"""
+        if self.intra_op_threads:
+            return self.intra_op_threads
+        return max(1, len(available_cpus()) // self.workers)
+
+    @property
+    def label(self) -> str:
+        """Short description for benchmark reports"""
+        return "{}x{}{}".format(self.workers, self.threads_per_worker, " pinned" if self.pin_cpus else "")
+
+
+@dataclass
+class InferenceExecutor:
+    """Thread pool reserved for forward passes, so they neither share the default executor with decoding and
+    model loading nor each use every core"""
+
+    config: ExecutorConfig = field(default_factory=ExecutorConfig)
+
+    _executor: Optional[ThreadPoolExecutor] = field(init=False, default=None, repr=False)
+    _cpu_sets: list[list[int]] = field(init=False, default_factory=list, repr=False)
+    _started: int = field(init=False, default=0, repr=False)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """The pool, created on first use"""
+        if self._executor is None:
+            if self.config.interop_threads:
+                set_interop_threads(self.config.interop_threads)
+            # Process-wide, the worker threads share the intra-op pool
+            torch.set_num_threads(self.config.threads_per_worker)
+            self._cpu_sets = cpu_sets(self.config.workers) if self.config.pin_cpus else []
+            self._started = 0
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.config.workers, thread_name_prefix="inference", initializer=self._init_thread
+            )
+        return self._executor
+
+    def _init_thread(self) -> None:
+        """Apply the CPU pinning in each new worker thread"""
+        with self._lock:
+            index = self._started
+            self._started += 1
+        if self._cpu_sets and hasattr(os, "sched_setaffinity"):
+            cpus = self._cpu_sets[index % len(self._cpu_sets)]
+            try:
+                # Linux applies this to the calling thread only
+                os.sched_setaffinity(0, cpus)
+            except OSError as exc:
+                LOGGER.warning("Could not pin inference thread {} to CPUs {}: {}".format(index, cpus, exc))
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        """Run func(*args) in an inference thread"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def shutdown(self) -> None:
+        """Stop the threads once the submitted forward passes finish, their callers still get the outputs"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self) -> dict[str, Any]:
+        """Configuration and state"""
+        return {
+            "workers": self.config.workers,
+            "intra_op_threads": self.config.threads_per_worker,
+            "interop_threads": torch.get_num_interop_threads(),
+            "cpu_sets": self._cpu_sets,
+            "running": self._executor is not None,
+        }
@@ -0,0 +1,393 @@
+"""Shared HTTP client for fetching images"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import mmap
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Mapping, Optional, Sequence, Union
+from urllib.parse import unquote, urlsplit, urlunsplit
+
+import aiohttp
+
+from .bodycache import BodyCache, CachedBody
+from .metrics import RollingHistogram
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_PORTS = {"http": 80, "https": 443}
+# Bytes of an image: fetched or sent inline, or a read-only memory map of a local file
+ImageData = Union[bytes, mmap.mmap]
+# Body (None for 304 Not Modified), ETag and Last-Modified of a response
+Response = tuple[Optional[bytes], Optional[str], Optional[str]]
+# Worth another try, the origin may be overloaded or restarting
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+# Fetches the hedge delay needs before it follows the latencies instead of hedge_min_delay
+HEDGE_MIN_SAMPLES = 20
+FETCH_COUNTERS = (
+    "fetches",
+    "requests",
+    "retries",
+    "timeouts",
+    "connection_errors",
+    "failed",
+    "hedged",
+    "hedge_wins",
+    "circuit_opened",
+    "circuit_rejected",
+    "not_modified",
+)
+
+
+class FetchError(RuntimeError):
+    """Fetching the image failed"""
+
+
+class RetryableFetchError(FetchError):
+    """Fetching failed in a way another attempt may fix (and that counts against the origin)"""
+
+
+def normalize_url(url: str) -> str:
+    """Form of the URL for spotting duplicates: case of the scheme and host, default ports and fragments
+    do not change what gets fetched"""
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    host = parts.hostname or ""
+    if ":" in host:
+        host = f"[{host}]"
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{port}"
+    userinfo, _, _ = parts.netloc.rpartition("@")
+    netloc = f"{userinfo}@{host}" if userinfo else host
+    path = parts.path or ("/" if scheme in DEFAULT_PORTS else "")
+    return urlunsplit((scheme, netloc, path, parts.query, ""))
+
+
+def is_local(url: str) -> bool:
+    """Is the URL a file:// URL"""
+    return url.strip().lower().startswith("file:")
+
+
+def local_path(url: str, roots: Sequence[Path]) -> Path:
+    """Path of a file:// URL, it must be inside one of the roots (symlinks resolved)"""
+    parts = urlsplit(url.strip())
+    if parts.scheme.lower() != "file" or parts.netloc not in ("", "localhost"):
+        raise FetchError(f"Not a local file URL: {url}")
+    path = Path(unquote(parts.path)).resolve()
+    if not any(path.is_relative_to(root.resolve()) for root in roots):
+        raise FetchError("Local files are not allowed" if not roots else f"{path} is not in an allowed directory")
+    return path
+
+
+def map_file(path: Path) -> mmap.mmap:
+    """Read-only memory map of the file, pages are read in when decoding touches them instead of copied up front"""
+    with open(path, "rb") as fpntr:
+        return mmap.mmap(fpntr.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+@dataclass
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures of an origin, requests then fail fast. After reset_s one
+    trial request is let through (half open), its success closes the breaker again."""
+
+    failure_threshold: int = 5
+    reset_s: float = 30.0
+    failures: int = 0
+    opened_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        """closed, open or half-open"""
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < self.reset_s else "half-open"
+
+    def allow(self) -> bool:
+        """Can a request go to the origin now"""
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.reset_s:
+            return False
+        # The trial, the others keep failing fast for another period unless it succeeds
+        self.opened_at = now
+        return True
+
+    def success(self) -> None:
+        """The origin answered"""
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self) -> bool:
+        """The origin failed, True if that opened the breaker"""
+        self.failures += 1
+        if self.opened_at is None and self.failure_threshold and self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+
+@dataclass
+class ImageFetcher:  # pylint: disable=R0902
+    """Owns one long-lived aiohttp session so connections (and DNS lookups) get reused between images.
+
+    Each attempt has connect, read and total deadlines. Connection errors, timeouts and HTTP 408, 429 and 5xx are
+    retried with full jitter exponential backoff. With hedge a second request is sent when the first has not
+    finished after the hedge_percentile latency of the recent fetches, the first to succeed wins. Every origin has a
+    CircuitBreaker so a dead host fails fast instead of holding fetch workers.
+
+    With body_cache_dir the bodies are kept on disk (see BodyCache), a URL fetched before is asked for with
+    If-None-Match/If-Modified-Since and on 304 Not Modified the kept copy is used, memory-mapped."""
+
+    limit: int = 100
+    limit_per_host: int = 16
+    dns_cache_ttl: int = 300
+    connect_timeout: float = 10.0
+    read_timeout: float = 30.0
+    total_timeout: float = 60.0
+    retries: int = 2
+    backoff_base: float = 0.2
+    backoff_max: float = 5.0
+    hedge: bool = False
+    hedge_percentile: float = 95.0
+    hedge_min_delay: float = 0.1
+    breaker_failures: int = 5
+    breaker_reset_s: float = 30.0
+    user_agent: str = "service"
+    body_cache_dir: str = ""
+    body_cache_max_mb: float = 1024.0
+    counters: Counter[str] = field(init=False, default_factory=Counter, repr=False, compare=False)
+    latency: RollingHistogram = field(init=False, default_factory=lambda: RollingHistogram(256), compare=False)
+    _hedge_delay: Optional[float] = field(init=False, default=None, repr=False, compare=False)
+    _breakers: dict[str, CircuitBreaker] = field(init=False, default_factory=dict, repr=False, compare=False)
+    _session: Optional[aiohttp.ClientSession] = field(init=False, default=None, repr=False, compare=False)
+    _body_cache: Optional[BodyCache] = field(init=False, default=None, repr=False, compare=False)
+    _in_flight: int = field(init=False, default=0, repr=False, compare=False)
+    _idle: asyncio.Event = field(init=False, default_factory=asyncio.Event, repr=False, compare=False)
+    # No new fetches once closing, no new session (or body cache) once closed
+    _closing: bool = field(init=False, default=False, repr=False, compare=False)
+    _closed: bool = field(init=False, default=False, repr=False, compare=False)
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> ImageFetcher:
+        """Create from the [http] config section"""
+        return cls(
+            limit=int(config.get("limit", cls.limit)),
+            limit_per_host=int(config.get("limit_per_host", cls.limit_per_host)),
+            dns_cache_ttl=int(config.get("dns_cache_ttl", cls.dns_cache_ttl)),
+            connect_timeout=float(config.get("connect_timeout", cls.connect_timeout)),
+            read_timeout=float(config.get("read_timeout", cls.read_timeout)),
+            total_timeout=float(config.get("total_timeout", cls.total_timeout)),
+            retries=int(config.get("retries", cls.retries)),
+            backoff_base=float(config.get("backoff_base", cls.backoff_base)),
+            backoff_max=float(config.get("backoff_max", cls.backoff_max)),
+            hedge=bool(config.get("hedge", cls.hedge)),
+            hedge_percentile=float(config.get("hedge_percentile", cls.hedge_percentile)),
+            hedge_min_delay=float(config.get("hedge_min_delay", cls.hedge_min_delay)),
+            breaker_failures=int(config.get("breaker_failures", cls.breaker_failures)),
+            breaker_reset_s=float(config.get("breaker_reset_s", cls.breaker_reset_s)),
+            user_agent=str(config.get("user_agent", cls.user_agent)),
+            body_cache_dir=str(config.get("body_cache_dir", cls.body_cache_dir)),
+            body_cache_max_mb=float(config.get("body_cache_max_mb", cls.body_cache_max_mb)),
+        )
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The shared session, created on first use"""
+        if self._closed:
+            raise FetchError("The fetcher is closed")
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=self.total_timeout or None, sock_connect=self.connect_timeout, sock_read=self.read_timeout
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                headers={"User-Agent": self.user_agent},
+            )
+        return self._session
+
+    @property
+    def body_cache(self) -> Optional[BodyCache]:
+        """The body cache, opened on first use, None if disabled"""
+        if self._body_cache is None and self.body_cache_dir and not self._closed:
+            self._body_cache = BodyCache(
+                Path(self.body_cache_dir).expanduser(), int(self.body_cache_max_mb * 1024 * 1024)
+            )
+        return self._body_cache
+
+    async def fetch(self, url: str) -> ImageData:
+        """Fetch the body of the given URL, retrying (and hedging) as configured, revalidating a cached copy"""
+        if self._closing:
+            raise FetchError("The fetcher is closed")
+        self._in_flight += 1
+        self._idle.clear()
+        try:
+            return await self._fetch(url)
+        finally:
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.set()
+
+    async def _fetch(self, url: str) -> ImageData:
+        """Fetch, see fetch"""
+        cache = self.body_cache
+        key = normalize_url(url)
+        cached: Optional[CachedBody] = await asyncio.to_thread(cache.get, key) if cache else None
+        try:
+            body, etag, last_modified = await self._attempts(url, cached.conditional_headers() if cached else {})
+        except BaseException:
+            if cached:
+                cached.close()
+            raise
+        if body is None:
+            assert cached is not None
+            self.counters["not_modified"] += 1
+            return cached.data
+        if cached:
+            cached.close()
+        if cache:
+            await asyncio.to_thread(cache.put, key, body, etag, last_modified)
+        return body
+
+    async def _attempts(self, url: str, headers: Mapping[str, str]) -> Response:
+        """Request the URL until it succeeds, fails for good or the retries run out"""
+        host = urlsplit(url).netloc.lower()
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            breaker = self._breakers[host] = CircuitBreaker(self.breaker_failures, self.breaker_reset_s)
+        self.counters["fetches"] += 1
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                self.counters["circuit_rejected"] += 1
+                raise FetchError(f"Circuit open for {host}, not trying")
+            try:
+                response = await (self._hedged(url, headers) if self.hedge else self._get(url, headers))
+            except RetryableFetchError as exc:
+                if breaker.failure():
+                    self.counters["circuit_opened"] += 1
+                    LOGGER.warning("{} failed {} times in a row, failing fast for now".format(host, breaker.failures))
+                if attempt == self.retries:
+                    self.counters["failed"] += 1
+                    raise FetchError(f"{exc} (after {attempt + 1} attempts)") from exc
+                self.counters["retries"] += 1
+                await asyncio.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt)))  # nosec
+                attempt += 1
+                continue
+            except FetchError:
+                # The origin is up, the URL is just bad
+                breaker.success()
+                self.counters["failed"] += 1
+                raise
+            breaker.success()
+            return response
+
+    async def _get(self, url: str, headers: Mapping[str, str]) -> Response:
+        """One attempt, RetryableFetchError for what another attempt may fix"""
+        self.counters["requests"] += 1
+        started = time.monotonic()
+        try:
+            async with self.session.get(url, headers=headers) as resp:
+                if resp.status == 304 and headers:
+                    data: Optional[bytes] = None
+                elif resp.status != 200:
+                    error = RetryableFetchError if resp.status in RETRY_STATUSES else FetchError
+                    raise error(f"HTTP error: {resp.status}")
+                else:
+                    data = await resp.read()
+                etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+                if "no-store" in resp.headers.get("Cache-Control", ""):
+                    etag = last_modified = None
+        except asyncio.TimeoutError as exc:
+            self.counters["timeouts"] += 1
+            raise RetryableFetchError(f"Timed out after {time.monotonic() - started:.1f}s") from exc
+        except aiohttp.ClientError as exc:
+            self.counters["connection_errors"] += 1
+            raise RetryableFetchError(f"Connection error: {exc}") from exc
+        self.latency.add(time.monotonic() - started)
+        if self.latency.count % HEDGE_MIN_SAMPLES == 0:
+            self._hedge_delay = None
+        return data, etag, last_modified
+
+    def hedge_delay(self) -> float:
+        """Seconds to wait for the first request before hedging, the hedge_percentile latency (cached for a while)"""
+        if self.latency.count < HEDGE_MIN_SAMPLES:
+            return self.hedge_min_delay
+        if self._hedge_delay is None:
+            self._hedge_delay = max(self.hedge_min_delay, self.latency.percentile(self.hedge_percentile))
+        return self._hedge_delay
+
+    async def _hedged(self, url: str, headers: Mapping[str, str]) -> Response:
+        """First successful result of the request and, if it is slow, a second one sent after hedge_delay"""
+        tasks = [asyncio.ensure_future(self._get(url, headers))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay())
+            if not done:
+                self.counters["hedged"] += 1
+                tasks.append(asyncio.ensure_future(self._get(url, headers)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.counters["hedge_wins"] += int(task is not tasks[0])
+                        return task.result()
+            # Both failed, report the error of the original request whichever finished first
+            error = tasks[0].exception()
+            assert error is not None
+            raise error
+        finally:
+            for task in tasks:
+                if task.done() and not task.cancelled():
+                    # Mark the error of a loser as seen
+                    task.exception()
+                task.cancel()
+
+    def stats(self) -> dict[str, Any]:
+        """Counters, attempt latency and the origins failing fast"""
+        return {
+            **{key: self.counters[key] for key in FETCH_COUNTERS},
+            "latency_s": self.latency.stats(),
+            "hedge_delay_s": self.hedge_delay() if self.hedge else None,
+            "breakers": {
+                host: {"state": breaker.state, "failures": breaker.failures}
+                for host, breaker in self._breakers.items()
+                if breaker.opened_at is not None
+            },
+            "body_cache": self._body_cache.stats() if self._body_cache else None,
+        }
+
+    async def close_when_idle(self) -> None:
+        """Close once the fetches in progress are done, for a fetcher replaced on reload. New fetches fail."""
+        self._closing = True
+        try:
+            while self._in_flight:
+                await self._idle.wait()
+        finally:
+            # Also when the service stops meanwhile
+            await self.close()
+
+    async def close(self) -> None:
+        """Close the session and its pooled connections, fetches in progress fail"""
+        self._closing = self._closed = True
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        if self._body_cache is not None:
+            self._body_cache.close()
+            self._body_cache = None
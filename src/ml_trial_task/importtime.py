@@ -0,0 +1,101 @@
+"""Import cost of the CLI commands, measured with python -X importtime in fresh interpreters"""
+
+from __future__ import annotations
+
+import logging
+import re
+import subprocess  # nosec
+import sys
+from dataclasses import dataclass, field
+from typing import Any, Iterable
+
+LOGGER = logging.getLogger(__name__)
+# Too slow to import (up to seconds, hundreds of MB) for a command that only talks to the service
+HEAVY_MODULES = ("torch", "torchvision", "aiohttp", "numpy")
+# Modules each command imports when it runs, on top of the CLI module. Keep in sync with console.py (tested).
+COMMAND_MODULES: dict[str, tuple[str, ...]] = {
+    "service": ("ml_trial_task.service",),
+    "broker": ("ml_trial_task.broker",),
+    "predict": ("ml_trial_task.streaming",),
+    "profile": (),
+    "benchmark models": ("ml_trial_task.benchmark", "ml_trial_task.models"),
+    "benchmark inference": ("ml_trial_task.benchmark", "ml_trial_task.executor", "ml_trial_task.models"),
+    "benchmark load": ("ml_trial_task.loadtest",),
+    "benchmark imports": ("ml_trial_task.importtime",),
+}
+# Commands that must start without HEAVY_MODULES
+CLIENT_COMMANDS = ("predict", "profile", "benchmark imports")
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+
+@dataclass
+class ImportTimes:
+    """Microseconds spent importing each module (own time and including its imports) in one interpreter"""
+
+    command: str
+    own_us: dict[str, int] = field(default_factory=dict)
+    cumulative_us: dict[str, int] = field(default_factory=dict)
+    # Imported directly by the measured code, not by another module
+    top_level: list[str] = field(default_factory=list)
+
+    @classmethod
+    def parse(cls, command: str, output: str) -> ImportTimes:
+        """Read the -X importtime lines from the stderr of the interpreter"""
+        times = cls(command)
+        for line in output.splitlines():
+            match = IMPORTTIME_RE.match(line)
+            if match is None:
+                continue
+            own, cumulative, indent, module = match.groups()
+            times.own_us[module] = int(own)
+            times.cumulative_us[module] = int(cumulative)
+            if not indent:
+                times.top_level.append(module)
+        return times
+
+    @property
+    def total_ms(self) -> float:
+        """Milliseconds spent importing"""
+        return sum(self.own_us.values()) / 1000.0
+
+    @property
+    def heavy(self) -> list[str]:
+        """The HEAVY_MODULES that got imported"""
+        return [module for module in HEAVY_MODULES if module in self.own_us]
+
+    def stats(self, top: int = 5) -> dict[str, Any]:
+        """Summary with the slowest imports of the measured code"""
+        slowest = sorted(self.top_level, key=lambda module: self.cumulative_us[module], reverse=True)[:top]
+        return {
+            "command": self.command,
+            "import_ms": self.total_ms,
+            "modules": len(self.own_us),
+            "heavy": self.heavy,
+            "slowest_ms": {module: self.cumulative_us[module] / 1000.0 for module in slowest},
+        }
+
+
+def measure_command(command: str, runs: int = 3) -> ImportTimes:
+    """Import the CLI and the modules of the command in fresh interpreters, the fastest of runs"""
+    modules = ("ml_trial_task.console", *COMMAND_MODULES[command])
+    code = "; ".join(f"import {module}" for module in modules)
+    best = None
+    for _ in range(max(1, runs)):
+        proc = subprocess.run(  # nosec
+            [sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True
+        )
+        times = ImportTimes.parse(command, proc.stderr)
+        if best is None or times.total_ms < best.total_ms:
+            best = times
+    assert best is not None
+    return best
+
+
+def measure_commands(commands: Iterable[str], runs: int = 3) -> list[dict[str, Any]]:
+    """Import cost of each command, see measure_command"""
+    report = []
+    for command in commands:
+        stats = measure_command(command, runs).stats()
+        LOGGER.info("{}: {:.0f}ms".format(command, stats["import_ms"]))
+        report.append(stats)
+    return report
@@ -0,0 +1,106 @@
+"""Predict requests as jobs with their own result topic"""
+
+from __future__ import annotations
+
+import logging
+import re
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+LOGGER = logging.getLogger(__name__)
+# Results of a job go to RESULTS_TOPIC/<job_id>/, so subscribing to RESULTS_TOPIC still gets everything.
+# Topics filter by prefix, the trailing slash keeps job "a" from getting the results of job "a-1".
+RESULTS_TOPIC = "results"
+JOB_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def job_topic(job_id: str) -> str:
+    """Topic the results and the completion marker of the job are published on"""
+    return f"{RESULTS_TOPIC}/{job_id}/"
+
+
+def new_job_id() -> str:
+    """Random job ID"""
+    return uuid.uuid4().hex
+
+
+@dataclass
+class Job:  # pylint: disable=R0902
+    """Counts the results published for one predict request, done when every accepted image has one"""
+
+    job_id: str = field(default_factory=new_job_id)
+    # Share of the workers relative to the other running jobs, see pipeline.FairQueue
+    priority: int = 1
+    expected: int = 0
+    published: int = 0
+    errors: int = 0
+    cached: int = 0
+    coalesced: int = 0
+    # Images skipped because the deadline passed
+    expired: int = 0
+    created: float = field(default_factory=time.monotonic)
+    # time.monotonic() after which nobody waits for the results any more, None for no deadline
+    deadline: Optional[float] = None
+
+    def __post_init__(self) -> None:
+        """Job IDs end up in topics, keep them to safe characters"""
+        if not JOB_ID_RE.match(self.job_id):
+            raise ValueError("job_id must be 1-64 characters of A-Z, a-z, 0-9, _ and -")
+        if self.priority < 1:
+            raise ValueError("priority must be at least 1")
+
+    @classmethod
+    def for_request(cls, job_id: Optional[str], priority: int, max_priority: int, ttl_s: Optional[float] = None) -> Job:
+        """Job for the arguments of a predict request, ValueError tells what is wrong with them.
+
+        With ttl_s the results are wanted for that many seconds from now, see deadline."""
+        if isinstance(priority, bool) or not isinstance(priority, int) or not 1 <= priority <= max_priority:
+            raise ValueError(f"priority must be an integer from 1 to {max_priority}")
+        if ttl_s is not None and (isinstance(ttl_s, bool) or not isinstance(ttl_s, (int, float)) or ttl_s <= 0):
+            raise ValueError("ttl_s must be a positive number of seconds")
+        deadline = time.monotonic() + ttl_s if ttl_s is not None else None
+        if job_id is not None:
+            return cls(job_id, priority, deadline=deadline)
+        return cls(priority=priority, deadline=deadline)
+
+    @property
+    def topic(self) -> str:
+        """Topic the results and the completion marker of the job are published on"""
+        return job_topic(self.job_id)
+
+    @property
+    def done(self) -> bool:
+        """Has every accepted image got its result"""
+        return self.published >= self.expected
+
+    def is_expired(self, now: Optional[float] = None) -> bool:
+        """Has the deadline passed"""
+        return self.deadline is not None and (now if now is not None else time.monotonic()) >= self.deadline
+
+    def remaining_s(self) -> Optional[float]:
+        """Seconds left until the deadline, None if there is none"""
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def record(self, failed: bool, cached: bool, coalesced: bool, expired: bool = False) -> None:
+        """Count a published result"""
+        self.published += 1
+        self.errors += int(failed)
+        self.cached += int(cached)
+        self.coalesced += int(coalesced)
+        self.expired += int(expired)
+
+    def summary(self) -> dict[str, Any]:
+        """Data of the completion marker, the only message on the topic without an url"""
+        return {
+            "job_id": self.job_id,
+            "complete": True,
+            "num_images": self.expected,
+            "num_results": self.published,
+            "num_errors": self.errors,
+            "num_cached": self.cached,
+            "num_coalesced": self.coalesced,
+            "num_expired": self.expired,
+            "elapsed_s": time.monotonic() - self.created,
+        }
@@ -0,0 +1,280 @@
+"""End-to-end load test: a local image server, the service in a subprocess and a REQ client driving predict"""
+
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import io
+import logging
+import platform
+import resource
+import signal
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Optional, cast
+
+import numpy as np
+import tomlkit
+from aiohttp import web
+from datastreamcorelib.datamessage import PubSubDataMessage
+from datastreamcorelib.pubsub import PubSubMessage, Subscription
+from datastreamservicelib.reqrep import REQMixin
+from datastreamservicelib.zmqwrappers import PubSubManager, SocketHandler
+from PIL import Image
+
+from . import __version__
+from .defaultconfig import DEFAULT_CONFIG_STR
+from .metrics import RollingHistogram
+
+LOGGER = logging.getLogger(__name__)
+
+
+def make_corpus(sizes: list[tuple[int, int]], formats: list[str], seed: int = 0) -> dict[str, bytes]:
+    """Synthetic images by name, noise so they compress (and decode) about as badly as photos"""
+    rng = np.random.default_rng(seed)
+    corpus = {}
+    for width, height in sizes:
+        pixels = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+        for fmt in formats:
+            buf = io.BytesIO()
+            Image.fromarray(pixels).save(buf, format=fmt.upper())
+            corpus[f"img{width}x{height}.{fmt.lower()}"] = buf.getvalue()
+    return corpus
+
+
+async def serve_corpus(corpus: dict[str, bytes]) -> tuple[web.AppRunner, str]:
+    """Serve the images on /<name> from an ephemeral local port, return the runner and the base URL"""
+
+    async def image(request: web.Request) -> web.Response:
+        name = request.match_info["name"]
+        if name not in corpus:
+            raise web.HTTPNotFound()
+        content_type = "image/png" if name.endswith(".png") else "image/jpeg"
+        return web.Response(body=corpus[name], content_type=content_type)
+
+    app = web.Application()
+    app.router.add_get("/{name}", image)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+
+def _peak_rss_mb(pid: int) -> Optional[float]:
+    """High water mark of the resident set of a running process (Linux only)"""
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text(encoding="utf-8").splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def _children_peak_rss_mb() -> float:
+    """Largest resident set of the waited-for child processes"""
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss / (1024.0 * 1024.0) if platform.system() == "Darwin" else maxrss / 1024.0
+
+
+@dataclass
+class LoadTestConfig:  # pylint: disable=R0902
+    """What to send and how fast.
+
+    The service runs with its default config (or base_config) with the sockets moved to a temp dir, the given model
+    and the result cache disabled unless cache is set, so repeated images are really processed."""
+
+    rate: float = 2.0
+    list_size: int = 4
+    requests: int = 20
+    sizes: list[tuple[int, int]] = field(default_factory=lambda: [(640, 480), (1920, 1080), (4000, 3000)])
+    formats: list[str] = field(default_factory=lambda: ["jpeg", "png"])
+    model: str = "fasterrcnn_mobilenet_v3_large_320_fpn"
+    pretrained: bool = False
+    cache: bool = False
+    base_config: Optional[Path] = None
+    startup_timeout_s: float = 300.0
+    result_timeout_s: float = 300.0
+    probe_interval_s: float = 0.5
+
+    def service_config(self, sockdir: Path) -> dict[str, Any]:
+        """Config for the service under test"""
+        source = self.base_config.read_text(encoding="utf-8") if self.base_config else DEFAULT_CONFIG_STR
+        config: dict[str, Any] = tomlkit.parse(source).unwrap()
+        config["zmq"] = {
+            "pub_sockets": [f"ipc://{sockdir}/pub.sock"],
+            "rep_sockets": [f"ipc://{sockdir}/rep.sock"],
+        }
+        config.setdefault("model", {}).update({"name": self.model, "pretrained": self.pretrained})
+        if not self.cache:
+            config.setdefault("cache", {}).update({"max_entries": 0, "path": ""})
+        return config
+
+
+@dataclass
+class LoadTest:  # pylint: disable=R0902
+    """One run, see run"""
+
+    config: LoadTestConfig = field(default_factory=LoadTestConfig)
+
+    sent: dict[str, float] = field(init=False, default_factory=dict, repr=False)
+    latencies_ms: list[float] = field(init=False, default_factory=list, repr=False)
+    predict_rtt_ms: list[float] = field(init=False, default_factory=list, repr=False)
+    stats_rtt_ms: list[float] = field(init=False, default_factory=list, repr=False)
+    accepted: int = field(init=False, default=0)
+    rejected: int = field(init=False, default=0)
+    errors: int = field(init=False, default=0)
+    _pending: int = field(init=False, default=0, repr=False)
+    _done: asyncio.Event = field(init=False, default_factory=asyncio.Event, repr=False)
+    _last_result: float = field(init=False, default=0.0, repr=False)
+
+    async def run(self) -> dict[str, Any]:
+        """Serve the corpus, start the service, drive the load and return the report"""
+        corpus = make_corpus(self.config.sizes, self.config.formats)
+        server, base_url = await serve_corpus(corpus)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sockdir = Path(tmpdir)
+            service_config = self.config.service_config(sockdir)
+            configpath = sockdir / "service.toml"
+            configpath.write_text(tomlkit.dumps(service_config), encoding="utf-8")
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "ml_trial_task.console", "service", str(configpath)
+            )
+            try:
+                report = await self._drive(configpath, service_config, [f"{base_url}/{name}" for name in corpus])
+                report["peak_rss_mb"] = _peak_rss_mb(process.pid)
+            finally:
+                if process.returncode is None:
+                    process.send_signal(signal.SIGTERM)
+                    try:
+                        await asyncio.wait_for(process.wait(), timeout=10.0)
+                    except asyncio.TimeoutError:
+                        process.kill()
+                        await process.wait()
+                await server.cleanup()
+        if report["peak_rss_mb"] is None:
+            report["peak_rss_mb"] = _children_peak_rss_mb()
+        return report
+
+    async def _drive(self, configpath: Path, service_config: dict[str, Any], urls: list[str]) -> dict[str, Any]:
+        """Wait for the model, subscribe to the results, send the predicts and wait for the results"""
+        rep_socket = service_config["zmq"]["rep_sockets"][0]
+        requester = REQMixin(configpath)
+        requester.config = service_config
+        await self._wait_ready(requester, rep_socket)
+
+        subscription = Subscription(
+            service_config["zmq"]["pub_sockets"][0], "results", self._on_result, decoder_class=PubSubDataMessage
+        )
+        PubSubManager(SocketHandler).subscribe_async(subscription)
+        # Give the subscription time to connect so no results are missed
+        await asyncio.sleep(0.5)
+
+        probe = asyncio.create_task(self._probe(requester, rep_socket))
+        started = time.monotonic()
+        try:
+            for request_no in range(self.config.requests):
+                # Open-loop schedule, when behind send right away instead of skipping
+                await asyncio.sleep(max(0.0, started + request_no / self.config.rate - time.monotonic()))
+                batch = [
+                    f"{urls[(request_no * self.config.list_size + i) % len(urls)]}?r={request_no}&i={i}"
+                    for i in range(self.config.list_size)
+                ]
+                await self._predict(requester, rep_socket, batch)
+            if self._pending:
+                try:
+                    await asyncio.wait_for(self._done.wait(), timeout=self.config.result_timeout_s)
+                except asyncio.TimeoutError:
+                    LOGGER.error("Timed out waiting for {} results".format(self._pending))
+            final = await requester.send_command(rep_socket, "stats", timeout=10.0)
+        finally:
+            probe.cancel()
+        return self._report(started, final.data.get("response") or {})
+
+    async def _wait_ready(self, requester: REQMixin, rep_socket: str) -> None:
+        """Poll stats until the service reports the model loaded"""
+        deadline = time.monotonic() + self.config.startup_timeout_s
+        while time.monotonic() < deadline:
+            try:
+                reply = await requester.send_command(rep_socket, "stats", timeout=5.0)
+                if (reply.data.get("response") or {}).get("model", {}).get("ready"):
+                    return
+            except (asyncio.TimeoutError, OSError) as exc:
+                LOGGER.debug("Service not answering yet: {}".format(exc))
+            await asyncio.sleep(0.5)
+        raise TimeoutError("Service did not get ready in time")
+
+    async def _predict(self, requester: REQMixin, rep_socket: str, batch: list[str]) -> None:
+        """Send one predict and book what was accepted"""
+        sent = time.monotonic()
+        reply = await requester.send_command(rep_socket, "predict", batch, timeout=30.0)
+        self.predict_rtt_ms.append((time.monotonic() - sent) * 1000.0)
+        response = reply.data.get("response") or {}
+        accepted = int(response.get("num_images", 0))
+        for url in batch[:accepted]:
+            self.sent[url] = sent
+        self.accepted += accepted
+        self._pending += accepted
+        self.rejected += len(batch) - accepted
+
+    async def _probe(self, requester: REQMixin, rep_socket: str) -> None:
+        """Measure the REP round trip while the service is busy"""
+        try:
+            while True:
+                await asyncio.sleep(self.config.probe_interval_s)
+                sent = time.monotonic()
+                await requester.send_command(rep_socket, "stats", timeout=30.0)
+                self.stats_rtt_ms.append((time.monotonic() - sent) * 1000.0)
+        except asyncio.CancelledError:
+            LOGGER.debug("Cancelled")
+
+    async def _on_result(self, sub: Subscription, msg: PubSubMessage) -> None:  # pylint: disable=W0613
+        """Match the result to its request"""
+        data = cast(PubSubDataMessage, msg).data
+        sent = self.sent.pop(data.get("url", ""), None)
+        if sent is None:
+            return
+        self._last_result = time.monotonic()
+        self.latencies_ms.append((self._last_result - sent) * 1000.0)
+        if "error" in data:
+            self.errors += 1
+        self._pending -= 1
+        if not self._pending:
+            self._done.set()
+
+    def _report(self, started: float, final_stats: dict[str, Any]) -> dict[str, Any]:
+        """The numbers to compare between runs"""
+        completed = len(self.latencies_ms)
+        duration = (self._last_result or time.monotonic()) - started
+        return {
+            "version": __version__,
+            "config": {
+                **dataclasses.asdict(self.config),
+                "base_config": str(self.config.base_config) if self.config.base_config else None,
+            },
+            "images": self.config.requests * self.config.list_size,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "completed": completed,
+            "errors": self.errors,
+            "missing": self._pending,
+            "duration_s": duration,
+            "images_per_s": completed / duration if duration > 0 else 0.0,
+            "latency_ms": _percentiles(self.latencies_ms),
+            "predict_rtt_ms": _percentiles(self.predict_rtt_ms),
+            "stats_rtt_ms": _percentiles(self.stats_rtt_ms),
+            "service_metrics": final_stats.get("metrics", {}),
+        }
+
+
+def _percentiles(samples: list[float]) -> dict[str, Any]:
+    """p50/p95/p99/max of all the samples"""
+    histogram = RollingHistogram(window=max(1, len(samples)))
+    for sample in samples:
+        histogram.add(sample)
+    return histogram.stats()
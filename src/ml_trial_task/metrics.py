@@ -0,0 +1,147 @@
+"""Rolling latency histograms and throughput counters"""
+
+from __future__ import annotations
+
+import logging
+import math
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Mapping
+
+LOGGER = logging.getLogger(__name__)
+PERCENTILES = (50, 95, 99)
+
+
+def _nearest_rank(ordered: list[float], pct: float) -> float:
+    """Percentile of sorted samples, 0.0 if there are none"""
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)]
+
+
+@dataclass
+class RollingHistogram:
+    """Percentiles over the most recent samples"""
+
+    window: int = 1024
+
+    count: int = field(init=False, default=0)
+    _samples: deque[float] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        """Bound the sample buffer"""
+        self._samples = deque(maxlen=max(1, self.window))
+
+    def add(self, value: float) -> None:
+        """Record a sample, dropping the oldest one if the window is full"""
+        self._samples.append(value)
+        self.count += 1
+
+    def percentile(self, pct: float) -> float:
+        """Nearest-rank percentile of the samples in the window, 0.0 if there are none"""
+        return _nearest_rank(sorted(self._samples), pct)
+
+    def stats(self) -> dict[str, Any]:
+        """Total count and the percentiles of the window"""
+        ordered = sorted(self._samples)
+        stats: dict[str, Any] = {"count": self.count}
+        for pct in PERCENTILES:
+            stats[f"p{pct}"] = _nearest_rank(ordered, pct)
+        stats["max"] = ordered[-1] if ordered else 0.0
+        return stats
+
+
+@dataclass
+class RateMeter:
+    """Events per second over a sliding window of whole seconds"""
+
+    window_s: int = 60
+
+    total: float = field(init=False, default=0.0)
+    _buckets: deque[list[float]] = field(init=False, default_factory=deque, repr=False)
+    _started: float = field(init=False, default_factory=time.monotonic, repr=False)
+
+    def add(self, amount: float = 1.0) -> None:
+        """Count amount events now"""
+        now = int(time.monotonic())
+        if self._buckets and self._buckets[-1][0] == now:
+            self._buckets[-1][1] += amount
+        else:
+            self._buckets.append([now, amount])
+        self.total += amount
+        self._expire(now)
+
+    def _expire(self, now: int) -> None:
+        """Drop buckets that fell out of the window"""
+        while self._buckets and self._buckets[0][0] <= now - self.window_s:
+            self._buckets.popleft()
+
+    def rate(self) -> float:
+        """Average per second over the window (or the lifetime if shorter)"""
+        now = time.monotonic()
+        self._expire(int(now))
+        span = min(float(self.window_s), now - self._started)
+        if span <= 0:
+            return 0.0
+        return sum(amount for _, amount in self._buckets) / span
+
+
+@dataclass
+class ServiceMetrics:  # pylint: disable=R0902
+    """Per stage latency histograms, end-to-end latency and throughput of the published results"""
+
+    window: int = 1024
+    rate_window_s: int = 60
+
+    stages: dict[str, RollingHistogram] = field(init=False, default_factory=dict)
+    total: RollingHistogram = field(init=False)
+    nbytes: RollingHistogram = field(init=False)
+    images: RateMeter = field(init=False)
+    bytes_fetched: RateMeter = field(init=False)
+    errors: int = field(init=False, default=0)
+    cached: int = field(init=False, default=0)
+
+    def __post_init__(self) -> None:
+        """Create the histograms with the configured window"""
+        self.total = RollingHistogram(self.window)
+        self.nbytes = RollingHistogram(self.window)
+        self.images = RateMeter(self.rate_window_s)
+        self.bytes_fetched = RateMeter(self.rate_window_s)
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> ServiceMetrics:
+        """Create from the [metrics] config section"""
+        return cls(
+            window=int(config.get("window", cls.window)),
+            rate_window_s=int(config.get("rate_window_s", cls.rate_window_s)),
+        )
+
+    def record(self, timings_ms: Mapping[str, float], nbytes: int, failed: bool = False, cached: bool = False) -> None:
+        """Record one finished image, timings_ms has the stage durations and "total" for the whole time"""
+        for name, value in timings_ms.items():
+            if name == "total":
+                self.total.add(value)
+                continue
+            if name not in self.stages:
+                self.stages[name] = RollingHistogram(self.window)
+            self.stages[name].add(value)
+        if nbytes:
+            self.nbytes.add(nbytes)
+            self.bytes_fetched.add(nbytes)
+        self.images.add()
+        self.errors += int(failed)
+        self.cached += int(cached)
+
+    def stats(self) -> dict[str, Any]:
+        """Percentiles (milliseconds and bytes) and rates"""
+        return {
+            "images": int(self.images.total),
+            "errors": self.errors,
+            "cached": self.cached,
+            "images_per_s": self.images.rate(),
+            "bytes_per_s": self.bytes_fetched.rate(),
+            "total_ms": self.total.stats(),
+            "stages_ms": {name: histogram.stats() for name, histogram in self.stages.items()},
+            "bytes": self.nbytes.stats(),
+        }
@@ -0,0 +1,235 @@
+"""Detection model registry and loading, with a local cache of the weights"""
+
+from __future__ import annotations
+
+import logging
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Mapping, Optional
+
+import torch
+from torchvision.models import WeightsEnum, detection
+
+LOGGER = logging.getLogger(__name__)
+
+
+def load_state_dict(path: Path) -> dict[str, torch.Tensor]:
+    """Load a saved state dict memory-mapped so processes share the pages instead of copying them"""
+    try:
+        return dict(torch.load(str(path), map_location="cpu", mmap=True, weights_only=True))
+    except TypeError:
+        # torch < 2.1 has no mmap support
+        return dict(torch.load(str(path), map_location="cpu"))
+
+
+def assign_state_dict(model: torch.nn.Module, path: Path) -> None:
+    """Point the model parameters to the (memory-mapped) saved tensors instead of copying them"""
+    try:
+        model.load_state_dict(load_state_dict(path), assign=True)
+    except TypeError:
+        # torch < 2.1 can not assign, the weights get copied into the module
+        model.load_state_dict(load_state_dict(path))
+
+
+def save_state_dict(model: torch.nn.Module, path: Path) -> None:
+    """Save the weights atomically so concurrent loaders never see a partial file"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False) as tmpfile:
+        torch.save(model.state_dict(), tmpfile)
+    os.replace(tmpfile.name, path)
+    LOGGER.info("Saved weights to {}".format(path))
+
+
+def artifact_path(cache_dir: Path, weights: WeightsEnum) -> Path:
+    """Where the weights are cached locally"""
+    return cache_dir.expanduser() / f"{weights}.pt"
+
+
+def load_detector(
+    builder: Callable[..., torch.nn.Module],
+    weights: WeightsEnum,
+    cache_dir: Optional[Path],
+    **kwargs: Any,
+) -> torch.nn.Module:
+    """Build the detector in eval mode.
+
+    With a cache_dir the pretrained weights are resolved through torchvision only the first time and saved there,
+    later loads build the bare architecture and map the saved tensors."""
+    started = time.monotonic()
+    path = artifact_path(cache_dir, weights) if cache_dir else None
+    if path is not None and path.exists():
+        model = build_bare(builder, weights, **kwargs)
+        assign_state_dict(model, path)
+    else:
+        model = builder(weights=weights, **kwargs)
+        if path is not None:
+            save_state_dict(model, path)
+    model.eval()
+    LOGGER.info("Loaded {} in {:.2f}s".format(weights, time.monotonic() - started))
+    return model
+
+
+def build_bare(builder: Callable[..., torch.nn.Module], weights: WeightsEnum, **kwargs: Any) -> torch.nn.Module:
+    """Build the architecture for the weights without loading (or downloading) any of them"""
+    return builder(weights=None, weights_backbone=None, num_classes=len(weights.meta["categories"]), **kwargs)
+
+
+def quantize_dynamic(model: torch.nn.Module) -> torch.nn.Module:
+    """Dynamic int8 quantization, only applies to the Linear layers (the box heads), convolutions stay float.
+
+    The backbones are convolutional, dynamic quantization does not cover convolutions (static quantization would
+    need calibration data and fused modules the torchvision detectors do not provide)."""
+    if not any(isinstance(module, torch.nn.Linear) for module in model.modules()):
+        raise ValueError("The model has no Linear layers to quantize")
+    quantized: torch.nn.Module = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return quantized
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    """A torchvision detector, the keyword its builder uses for the score threshold and whether it has Linear layers
+    for quantize_dynamic (the Faster R-CNN box heads, the other detectors are convolutions only)"""
+
+    builder: Callable[..., torch.nn.Module]
+    weights: WeightsEnum
+    threshold_kwarg: str = "score_thresh"
+    quantizable: bool = False
+
+
+MODELS: dict[str, ModelSpec] = {
+    "fasterrcnn_resnet50_fpn_v2": ModelSpec(
+        detection.fasterrcnn_resnet50_fpn_v2,
+        detection.FasterRCNN_ResNet50_FPN_V2_Weights.DEFAULT,
+        "box_score_thresh",
+        quantizable=True,
+    ),
+    "fasterrcnn_resnet50_fpn": ModelSpec(
+        detection.fasterrcnn_resnet50_fpn,
+        detection.FasterRCNN_ResNet50_FPN_Weights.DEFAULT,
+        "box_score_thresh",
+        quantizable=True,
+    ),
+    "fasterrcnn_mobilenet_v3_large_fpn": ModelSpec(
+        detection.fasterrcnn_mobilenet_v3_large_fpn,
+        detection.FasterRCNN_MobileNet_V3_Large_FPN_Weights.DEFAULT,
+        "box_score_thresh",
+        quantizable=True,
+    ),
+    "fasterrcnn_mobilenet_v3_large_320_fpn": ModelSpec(
+        detection.fasterrcnn_mobilenet_v3_large_320_fpn,
+        detection.FasterRCNN_MobileNet_V3_Large_320_FPN_Weights.DEFAULT,
+        "box_score_thresh",
+        quantizable=True,
+    ),
+    "retinanet_resnet50_fpn_v2": ModelSpec(
+        detection.retinanet_resnet50_fpn_v2, detection.RetinaNet_ResNet50_FPN_V2_Weights.DEFAULT
+    ),
+    "retinanet_resnet50_fpn": ModelSpec(
+        detection.retinanet_resnet50_fpn, detection.RetinaNet_ResNet50_FPN_Weights.DEFAULT
+    ),
+    "fcos_resnet50_fpn": ModelSpec(detection.fcos_resnet50_fpn, detection.FCOS_ResNet50_FPN_Weights.DEFAULT),
+    "ssd300_vgg16": ModelSpec(detection.ssd300_vgg16, detection.SSD300_VGG16_Weights.DEFAULT),
+    "ssdlite320_mobilenet_v3_large": ModelSpec(
+        detection.ssdlite320_mobilenet_v3_large, detection.SSDLite320_MobileNet_V3_Large_Weights.DEFAULT
+    ),
+}
+DEFAULT_MODEL = "fasterrcnn_resnet50_fpn_v2"
+
+
+@dataclass(frozen=True)
+class ModelConfig:  # pylint: disable=R0902
+    """The [model] config section"""
+
+    name: str = DEFAULT_MODEL
+    score_threshold: float = 0.8
+    quantize: bool = False
+    pretrained: bool = True
+    cache_dir: Optional[Path] = None
+    warmup_runs: int = 1
+    warmup_batch_size: int = 1
+    warmup_image_size: int = 512
+
+    def __post_init__(self) -> None:
+        """Fail early on unknown models and on quantizing one that has nothing to quantize"""
+        if self.name not in MODELS:
+            raise ValueError(f"Unknown model {self.name!r}, choose one of {', '.join(MODELS)}")
+        if self.quantize and not self.spec.quantizable:
+            quantizable = ", ".join(name for name, spec in MODELS.items() if spec.quantizable)
+            raise ValueError(f"{self.name} has no Linear layers to quantize, quantize works with {quantizable}")
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> ModelConfig:
+        """Create from the [model] config section, empty cache_dir disables the weights cache"""
+        cache_dir = str(config.get("cache_dir", ""))
+        return cls(
+            name=str(config.get("name", cls.name)),
+            score_threshold=float(config.get("score_threshold", cls.score_threshold)),
+            quantize=bool(config.get("quantize", cls.quantize)),
+            pretrained=bool(config.get("pretrained", cls.pretrained)),
+            cache_dir=Path(cache_dir) if cache_dir else None,
+            warmup_runs=int(config.get("warmup_runs", cls.warmup_runs)),
+            warmup_batch_size=int(config.get("warmup_batch_size", cls.warmup_batch_size)),
+            warmup_image_size=int(config.get("warmup_image_size", cls.warmup_image_size)),
+        )
+
+    @property
+    def spec(self) -> ModelSpec:
+        """Registry entry for the model"""
+        return MODELS[self.name]
+
+    @property
+    def weights(self) -> WeightsEnum:
+        """Weights (metadata) of the model"""
+        return self.spec.weights
+
+    @property
+    def categories(self) -> list[str]:
+        """Label names by index"""
+        return list(self.weights.meta["categories"])
+
+    @property
+    def identity(self) -> str:
+        """Everything except the threshold that makes the same image give different results"""
+        return f"{self.name}:{self.weights if self.pretrained else 'random'}{':int8' if self.quantize else ''}"
+
+    @property
+    def artifact(self) -> Optional[Path]:
+        """The cached weights file, if caching is enabled"""
+        if not self.cache_dir or not self.pretrained:
+            return None
+        return artifact_path(self.cache_dir, self.weights)
+
+    def load(self, state_path: Optional[Path] = None, save_to: Optional[Path] = None) -> torch.nn.Module:
+        """Build the model in eval mode, from state_path if given. Blocking, run this in a thread.
+
+        save_to gets the float weights (before quantization) for loading elsewhere with state_path."""
+        kwargs = {self.spec.threshold_kwarg: self.score_threshold}
+        if state_path is not None:
+            model = build_bare(self.spec.builder, self.weights, **kwargs)
+            assign_state_dict(model, state_path)
+            model.eval()
+        elif self.pretrained:
+            model = load_detector(self.spec.builder, self.weights, self.cache_dir if self.cache_dir else None, **kwargs)
+        else:
+            # Random weights, for benchmarks and testing without network access
+            model = build_bare(self.spec.builder, self.weights, **kwargs).eval()
+        if save_to is not None:
+            save_state_dict(model, save_to)
+        if self.quantize:
+            model = quantize_dynamic(model)
+        return model
+
+
+def warm_up(model: torch.nn.Module, runs: int, batch_size: int, image_size: int) -> None:
+    """Run forward passes on a dummy batch so the first real request does not pay for lazy allocations"""
+    if runs <= 0:
+        return
+    started = time.monotonic()
+    batch = [torch.rand(3, image_size, image_size) for _ in range(max(1, batch_size))]
+    with torch.inference_mode():
+        for _ in range(runs):
+            model(batch)
+    LOGGER.info("Warm-up ({} x batch of {}) took {:.2f}s".format(runs, len(batch), time.monotonic() - started))
@@ -0,0 +1,303 @@
+"""Bounded work queues drained by fixed pools of worker tasks"""
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Hashable, Iterator, Optional
+
+from libadvian.tasks import TaskMaster
+
+from .fetcher import ImageData
+from .jobs import Job
+
+LOGGER = logging.getLogger(__name__)
+# Weight of the latest item in the moving average of handling time
+EWMA_ALPHA = 0.1
+
+
+@dataclass
+class WorkItem:  # pylint: disable=R0902
+    """One image travelling through the stages, each stage fills in its output and drops what is no longer needed"""
+
+    url: str
+    # Fetched, mapped or sent with the request (inline images have no key and are never coalesced)
+    data: Optional[ImageData] = None
+    image: Any = None
+    # From decoded image to original image coordinates
+    scale: tuple[float, float] = (1.0, 1.0)
+    tensor: Any = None
+    cache_key: Optional[str] = None
+    detections: Optional[dict[str, Any]] = None
+    cached: bool = False
+    error: Optional[str] = None
+    # Skipped because every request waiting for it is past its deadline
+    expired: bool = False
+    # The request the item was accepted for
+    job: Optional[Job] = None
+    # Normalized URL the item is registered under in InFlight, and the URLs (and jobs) of requests attached to it
+    key: Optional[str] = None
+    duplicates: list[tuple[str, Optional[Job]]] = field(default_factory=list)
+    # Bytes fetched and milliseconds spent in each stage, see timed
+    nbytes: int = 0
+    # Bytes of the memory budget held by the item, see budget.MemoryBudget
+    reserved: int = 0
+    timings_ms: dict[str, float] = field(default_factory=dict)
+    created: float = field(default_factory=time.monotonic)
+
+    @contextmanager
+    def timed(self, name: str) -> Iterator[None]:
+        """Add the time spent in the block to timings_ms[name]"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings_ms[name] = self.timings_ms.get(name, 0.0) + (time.monotonic() - started) * 1000.0
+
+    def elapsed_ms(self) -> float:
+        """Milliseconds since the item was accepted"""
+        return (time.monotonic() - self.created) * 1000.0
+
+    def past_deadline(self) -> bool:
+        """Have the jobs of the item and of all the requests attached to it given up (there is a job and deadline)"""
+        now = time.monotonic()
+        jobs = [self.job, *(job for _, job in self.duplicates)]
+        return all(job is not None and job.is_expired(now) for job in jobs)
+
+
+@dataclass
+class InFlight:
+    """Items being processed by normalized URL, so requests for the same image attach to the one running"""
+
+    items: dict[str, WorkItem] = field(default_factory=dict)
+    coalesced: int = 0
+
+    def attach(self, key: str, url: str, job: Optional[Job] = None) -> bool:
+        """Attach the URL to the item already processing the key, False if there is none"""
+        item = self.items.get(key)
+        if item is None:
+            return False
+        item.duplicates.append((url, job))
+        self.coalesced += 1
+        return True
+
+    def add(self, item: WorkItem) -> None:
+        """Register the item under its key"""
+        assert item.key is not None
+        self.items[item.key] = item
+
+    def remove(self, item: WorkItem) -> None:
+        """Unregister the item, later requests for the same key start a new one"""
+        if item.key is not None and self.items.get(item.key) is item:
+            del self.items[item.key]
+
+    def stats(self) -> dict[str, Any]:
+        """Distinct images in flight and how many requests were attached to one"""
+        return {"entries": len(self.items), "coalesced": self.coalesced}
+
+
+def single_flow(item: Any) -> tuple[Hashable, float]:  # pylint: disable=W0613
+    """Every item in the same flow, which makes FairQueue first in first out"""
+    return None, 1.0
+
+
+class FairQueue(asyncio.Queue[Any]):  # pylint: disable=R0903
+    """Queue that interleaves items of different flows, start-time fair queuing.
+
+    flow(item) returns the flow key and weight of the item. Each item gets a virtual start time: the later of the
+    current virtual time and the finish time of the previous item of its flow, and finishes 1/weight later. Items
+    come out in start time order, so backlogged flows take turns in proportion to their weight and the first item
+    of a new flow is served after at most one item of each other flow. Within a flow the order is kept."""
+
+    # asyncio.Queue sets up its storage in _init, like PriorityQueue the state is created there
+    # pylint: disable=W0201
+
+    def __init__(self, flow: Callable[[Any], tuple[Hashable, float]] = single_flow, maxsize: int = 0) -> None:
+        self.flow = flow
+        super().__init__(maxsize)
+
+    def _init(self, maxsize: int) -> None:  # pylint: disable=W0613
+        self._queue: list[tuple[float, int, Hashable, Any]] = []
+        self._seq = itertools.count()
+        self._vtime = 0.0
+        # Finish time of the last queued item and the number of queued items by flow
+        self._finish: dict[Hashable, float] = {}
+        self._pending: dict[Hashable, int] = {}
+
+    def _put(self, item: Any) -> None:
+        key, weight = self.flow(item)
+        start = max(self._vtime, self._finish.get(key, 0.0))
+        self._finish[key] = start + 1.0 / max(weight, 1e-6)
+        self._pending[key] = self._pending.get(key, 0) + 1
+        heapq.heappush(self._queue, (start, next(self._seq), key, item))
+
+    def _get(self) -> Any:
+        start, _, key, item = heapq.heappop(self._queue)
+        self._vtime = start
+        self._pending[key] -= 1
+        if not self._pending[key]:
+            del self._pending[key]
+            del self._finish[key]
+        return item
+
+    @property
+    def flows(self) -> int:
+        """Flows with queued items"""
+        return len(self._pending)
+
+
+@dataclass
+class Stage:  # pylint: disable=R0902
+    """A bounded queue with a fixed number of workers calling handler for each item.
+
+    maxsize is enforced here instead of by the queue so it can be changed on reload, 0 means unbounded.
+    Pass a FairQueue as queue to interleave the items of different requests instead of taking them in order."""
+
+    name: str
+    handler: Callable[[Any], Awaitable[None]]
+    workers: int = 1
+    maxsize: int = 0
+    queue: asyncio.Queue[Any] = field(default_factory=asyncio.Queue, repr=False)
+
+    busy: int = field(init=False, default=0)
+    processed: int = field(init=False, default=0)
+    failed: int = field(init=False, default=0)
+    avg_handling_s: float = field(init=False, default=0.0)
+    _not_full: asyncio.Event = field(init=False, default_factory=asyncio.Event, repr=False)
+    _tasks: list[asyncio.Task[Any]] = field(init=False, default_factory=list, repr=False)
+    # Workers waiting in queue.get(), safe to cancel
+    _idle: set[asyncio.Task[Any]] = field(init=False, default_factory=set, repr=False)
+    _spawned: int = field(init=False, default=0, repr=False)
+
+    @property
+    def depth(self) -> int:
+        """Items waiting for a worker"""
+        return self.queue.qsize()
+
+    @property
+    def free(self) -> int:
+        """How many more items fit, -1 if unbounded"""
+        if self.maxsize <= 0:
+            return -1
+        return max(0, self.maxsize - self.depth)
+
+    def full(self) -> bool:
+        """Is the queue at its bound"""
+        return self.free == 0
+
+    def offer(self, item: Any) -> bool:
+        """Queue the item if there is room, return False if not"""
+        if self.full():
+            return False
+        self.queue.put_nowait(item)
+        return True
+
+    async def put(self, item: Any) -> None:
+        """Queue the item, waiting for room if needed"""
+        while self.full():
+            self._not_full.clear()
+            await self._not_full.wait()
+        self.queue.put_nowait(item)
+
+    def estimated_wait(self) -> float:
+        """Rough seconds until a newly queued item gets picked up"""
+        if not self.workers:
+            return 0.0
+        return (self.depth + self.busy) * self.avg_handling_s / self.workers
+
+    def start(self, tm: TaskMaster) -> None:
+        """Create (or retire) worker tasks so that the configured number is running.
+
+        Surplus workers waiting for an item are cancelled (the item stays queued), busy ones retire once their
+        current item is handled."""
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            # Retired workers may still be finishing so never reuse a name
+            self._tasks.append(tm.create_task(self._worker(), name=f"{self.name}-worker-{self._spawned}"))
+            self._spawned += 1
+        for task in [task for task in self._tasks if task in self._idle][: len(self._tasks) - self.workers]:
+            self._tasks.remove(task)
+            self._idle.discard(task)
+            task.cancel()
+
+    async def _worker(self) -> None:
+        """Take items from the queue and handle them one at a time, retire between items if there are too many"""
+        task = asyncio.current_task()
+        assert task is not None
+        try:
+            while True:
+                if len(self._tasks) > self.workers and task in self._tasks:
+                    self._tasks.remove(task)
+                    LOGGER.debug("Retired")
+                    return
+                self._idle.add(task)
+                try:
+                    item = await self.queue.get()
+                finally:
+                    self._idle.discard(task)
+                self._not_full.set()
+                self.busy += 1
+                started = time.monotonic()
+                try:
+                    await self.handler(item)
+                    self.processed += 1
+                except Exception as exc:  # pylint: disable=W0718
+                    self.failed += 1
+                    LOGGER.exception("{} handler failed for {}: {}".format(self.name, item, exc))
+                finally:
+                    self.busy -= 1
+                    elapsed = time.monotonic() - started
+                    self.avg_handling_s += EWMA_ALPHA * (elapsed - self.avg_handling_s)
+                    self.queue.task_done()
+        except asyncio.CancelledError:
+            LOGGER.debug("Cancelled")
+
+    def stats(self) -> dict[str, Any]:
+        """Queue depth, occupancy and throughput of this stage"""
+        return {
+            "workers": self.workers,
+            "maxsize": self.maxsize,
+            "depth": self.depth,
+            "flows": self.queue.flows if isinstance(self.queue, FairQueue) else int(bool(self.depth)),
+            "busy": self.busy,
+            "occupancy": self.busy / self.workers if self.workers else 0.0,
+            "processed": self.processed,
+            "failed": self.failed,
+            "avg_handling_s": self.avg_handling_s,
+            "estimated_wait_s": self.estimated_wait(),
+        }
+
+
+@dataclass
+class Pipeline:
+    """Stages in processing order, items are passed between them by the stage handlers"""
+
+    stages: dict[str, Stage] = field(default_factory=dict)
+
+    def add(self, stage: Stage) -> Stage:
+        """Add a stage (or return the existing one with the same name)"""
+        return self.stages.setdefault(stage.name, stage)
+
+    def __getitem__(self, name: str) -> Stage:
+        return self.stages[name]
+
+    def start(self, tm: TaskMaster) -> None:
+        """Start (or resize) the workers of every stage"""
+        for stage in self.stages.values():
+            stage.start(tm)
+
+    def stats(self) -> dict[str, Any]:
+        """Per stage stats, the stage with the highest occupancy is likely the bottleneck"""
+        stats: dict[str, Any] = {name: stage.stats() for name, stage in self.stages.items()}
+        busiest = max(
+            self.stages.values(),
+            key=lambda stage: (stage.busy / stage.workers if stage.workers else 0.0, stage.depth),
+            default=None,
+        )
+        stats["bottleneck"] = busiest.name if busiest and (busiest.busy or busiest.depth) else None
+        return stats
@@ -0,0 +1,121 @@
+"""Process pool running decode, preprocess and inference outside the service process"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Optional, Sequence
+
+import torch
+
+from .decoding import Decoder
+from .models import save_state_dict
+
+LOGGER = logging.getLogger(__name__)
+
+# Per worker process state, set by _init_worker
+_WORKER: dict[str, Any] = {}
+
+
+def convert_prediction(
+    pred: dict[str, torch.Tensor], categories: Sequence[str], scale: tuple[float, float] = (1.0, 1.0)
+) -> dict[str, Any]:
+    """Convert model output tensors to plain boxes/labels/scores lists, scaling the boxes to the original image"""
+    boxes = pred["boxes"].detach().cpu()
+    if scale != (1.0, 1.0):
+        boxes = boxes * torch.tensor([scale[0], scale[1], scale[0], scale[1]])
+    boxes = boxes.numpy().astype(int).tolist()
+    labels = [categories[i] for i in pred["labels"].detach().cpu().numpy().tolist()]
+    scores = pred["scores"].detach().cpu().numpy().tolist()
+    return {"boxes": boxes, "labels": labels, "scores": scores}
+
+
+def _init_worker(
+    loader: Callable[[], torch.nn.Module],
+    preprocess: Callable[[], Callable[[Any], torch.Tensor]],
+    categories: Sequence[str],
+    decoder: Decoder,
+    num_threads: int,
+) -> None:
+    """Build the model around the shared weights once per worker process"""
+    torch.set_num_threads(num_threads)
+    model = loader()
+    _WORKER.update({"model": model, "preprocess": preprocess(), "categories": categories, "decoder": decoder})
+
+
+def _detect(img_bytes: bytes) -> dict[str, Any]:
+    """Decode, preprocess and run inference on one image inside a worker process"""
+    decoded = _WORKER["decoder"].decode(img_bytes)
+    input_tensor = _WORKER["preprocess"](decoded.tensor)
+    with torch.inference_mode():
+        pred = _WORKER["model"]([input_tensor])[0]
+    return convert_prediction(pred, _WORKER["categories"], decoded.scale)
+
+
+@dataclass
+class InferenceProcessPool:  # pylint: disable=R0902
+    """Pool of worker processes that each hold the model.
+
+    loader runs once in each worker, it should build the model on the memory-mapped weights in state_path
+    (see export) so the processes share them."""
+
+    loader: Callable[[], torch.nn.Module]
+    state_path: Path
+    preprocess: Callable[[], Callable[[Any], torch.Tensor]]
+    categories: Sequence[str]
+    decoder: Decoder = field(default_factory=Decoder)
+    workers: int = 2
+    threads_per_worker: int = 1
+    _executor: Optional[ProcessPoolExecutor] = field(init=False, default=None, repr=False)
+
+    def export(self, model: torch.nn.Module) -> None:
+        """Save the weights the workers map"""
+        save_state_dict(model, self.state_path)
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        """The pool, (re)created on demand"""
+        if self._executor is None:
+            # spawn instead of fork, forking after torch has started its threads is not safe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(
+                    self.loader,
+                    self.preprocess,
+                    list(self.categories),
+                    self.decoder,
+                    self.threads_per_worker,
+                ),
+            )
+        return self._executor
+
+    async def detect(self, img_bytes: bytes) -> dict[str, Any]:
+        """Run the full decode-to-result path for one image in a worker process"""
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, _detect, img_bytes)
+        except BrokenProcessPool:
+            LOGGER.error("Worker process died, restarting the pool")
+            self.shutdown()
+            raise
+
+    def shutdown(self) -> None:
+        """Stop the worker processes"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict[str, Any]:
+        """Pool configuration and state"""
+        return {
+            "workers": self.workers,
+            "threads_per_worker": self.threads_per_worker,
+            "running": self._executor is not None,
+        }
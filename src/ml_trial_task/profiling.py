@@ -0,0 +1,212 @@
+"""Profiling the running service on demand: stack sampling or cProfile, and torch operator timings"""
+
+from __future__ import annotations
+
+import cProfile
+import logging
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import CodeType, FrameType
+from typing import Any, Callable, Optional, TypeVar
+
+import torch
+
+LOGGER = logging.getLogger(__name__)
+T = TypeVar("T")
+PROFILE_MODES = ("sample", "cprofile")
+# Innermost frames of threads waiting for work, their samples are not counted as busy
+IDLE_FRAMES = frozenset(
+    (
+        ("selectors.py", "select"),
+        ("threading.py", "wait"),
+        ("queue.py", "get"),
+        ("thread.py", "_worker"),
+    )
+)
+
+
+def code_label(code: CodeType) -> str:
+    """Function name with its file and line"""
+    # co_qualname is new in Python 3.11
+    name = getattr(code, "co_qualname", code.co_name)
+    return "{} ({}:{})".format(name, Path(code.co_filename).name, code.co_firstlineno)
+
+
+def is_idle(frame: FrameType) -> bool:
+    """Is the thread blocked waiting for work"""
+    return (Path(frame.f_code.co_filename).name, frame.f_code.co_name) in IDLE_FRAMES
+
+
+@dataclass
+class StackSampler:
+    """Takes the stacks of all the other threads every interval seconds in a daemon thread.
+
+    Counts each function as innermost (own) and anywhere on the stack (total), idle threads are skipped."""
+
+    interval: float = 0.005
+    samples: int = field(init=False, default=0)
+    busy_samples: int = field(init=False, default=0)
+    own: Counter[str] = field(init=False, default_factory=Counter)
+    total: Counter[str] = field(init=False, default_factory=Counter)
+    _stop: threading.Event = field(init=False, default_factory=threading.Event, repr=False)
+    _thread: Optional[threading.Thread] = field(init=False, default=None, repr=False)
+
+    def start(self) -> None:
+        """Start sampling"""
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling and wait for the thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        """Sample until stopped"""
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():  # pylint: disable=W0212
+                if ident == own_ident:
+                    continue
+                self.samples += 1
+                if is_idle(frame):
+                    continue
+                self.busy_samples += 1
+                self.own[code_label(frame.f_code)] += 1
+                seen = set()
+                current: Optional[FrameType] = frame
+                while current is not None:
+                    seen.add(code_label(current.f_code))
+                    current = current.f_back
+                self.total.update(seen)
+
+    def summary(self, top: int) -> dict[str, Any]:
+        """The functions seen running most, shares of the busy samples"""
+        busy = self.busy_samples or 1
+        return {
+            "samples": self.samples,
+            "busy_samples": self.busy_samples,
+            "interval_s": self.interval,
+            "functions": [
+                {"function": label, "own": count / busy, "total": self.total[label] / busy}
+                for label, count in self.own.most_common(top)
+            ],
+        }
+
+
+def cprofile_summary(profile: cProfile.Profile, top: int) -> dict[str, Any]:
+    """The functions with the most own time"""
+    stats = pstats.Stats(profile).stats  # type: ignore[attr-defined]
+    rows = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:top]
+    return {
+        "functions": [
+            {
+                "function": "{} ({}:{})".format(func, Path(filename).name, line),
+                "calls": calls,
+                "own_s": own_s,
+                "cumulative_s": cumulative_s,
+            }
+            for (filename, line, func), (_, calls, own_s, cumulative_s, _) in rows
+        ]
+    }
+
+
+@dataclass
+class TorchOperators:
+    """Operator timings of the forward passes run through run, summed over the passes.
+
+    One pass is profiled at a time, passes in other inference threads meanwhile run unprofiled."""
+
+    calls: int = field(init=False, default=0)
+    ops: dict[str, list[float]] = field(init=False, default_factory=dict)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)
+
+    def run(self, func: Callable[[], T]) -> T:
+        """Call func, under torch.profiler if no other pass is being profiled"""
+        if not self._lock.acquire(blocking=False):  # pylint: disable=R1732
+            return func()
+        try:
+            with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU]) as prof:
+                result = func()
+            self.calls += 1
+            for event in prof.key_averages():
+                entry = self.ops.setdefault(event.key, [0, 0.0, 0.0])
+                entry[0] += event.count
+                entry[1] += event.self_cpu_time_total
+                entry[2] += event.cpu_time_total
+            return result
+        finally:
+            self._lock.release()
+
+    def summary(self, top: int) -> dict[str, Any]:
+        """The operators with the most own CPU time"""
+        rows = sorted(self.ops.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        return {
+            "forward_passes": self.calls,
+            "operators": [
+                {"operator": name, "calls": int(calls), "own_ms": own_us / 1000.0, "total_ms": total_us / 1000.0}
+                for name, (calls, own_us, total_us) in rows
+            ],
+        }
+
+
+@dataclass
+class ProfileSession:  # pylint: disable=R0902
+    """One profiling run of the service.
+
+    mode "sample" samples the stacks of all threads (the event loop, decoding and inference threads) with little
+    overhead, "cprofile" traces every call but only in the thread that starts it (the event loop). With torch_ops
+    the forward passes run in this process are also profiled by operator."""
+
+    seconds: float
+    mode: str = "sample"
+    torch_ops: bool = False
+    top: int = 25
+    interval: float = 0.005
+    started: float = field(init=False, default=0.0)
+    sampler: Optional[StackSampler] = field(init=False, default=None, repr=False)
+    cprofile: Optional[cProfile.Profile] = field(init=False, default=None, repr=False)
+    operators: Optional[TorchOperators] = field(init=False, default=None, repr=False)
+
+    def __post_init__(self) -> None:
+        """Fail early on nonsense"""
+        if self.mode not in PROFILE_MODES:
+            raise ValueError("mode must be one of {}".format(", ".join(PROFILE_MODES)))
+        if self.seconds <= 0:
+            raise ValueError("seconds must be positive")
+        if self.top < 1:
+            raise ValueError("top must be at least 1")
+
+    def start(self) -> None:
+        """Start profiling, call in the event loop thread"""
+        self.started = time.monotonic()
+        if self.mode == "sample":
+            self.sampler = StackSampler(self.interval)
+            self.sampler.start()
+        else:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        if self.torch_ops:
+            self.operators = TorchOperators()
+        LOGGER.info("Profiling ({}) for {}s".format(self.mode, self.seconds))
+
+    def stop(self) -> dict[str, Any]:
+        """Stop profiling and summarize"""
+        summary: dict[str, Any] = {"mode": self.mode, "seconds": time.monotonic() - self.started}
+        if self.sampler is not None:
+            self.sampler.stop()
+            summary.update(self.sampler.summary(self.top))
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            summary.update(cprofile_summary(self.cprofile, self.top))
+        if self.operators is not None:
+            summary["torch"] = self.operators.summary(self.top)
+            self.operators = None
+        return summary
@@ -3,116 +3,693 @@
 from __future__ import annotations
 
 import asyncio
-import io
+import functools
+import json
 import logging
+import shutil
+import tempfile
+import time
+from collections import Counter
 from dataclasses import dataclass, field
-from typing import Any
+from pathlib import Path
+from typing import Any, Callable, Hashable, Optional
 
-import aiohttp
 import torch
 from datastreamcorelib.datamessage import PubSubDataMessage
+from datastreamcorelib.utils import create_heartbeat_message
 from datastreamservicelib.reqrep import REPMixin
 from datastreamservicelib.service import SimpleService
-from PIL import Image
-from torchvision.models.detection import (
-    FasterRCNN_ResNet50_FPN_V2_Weights,
-    fasterrcnn_resnet50_fpn_v2,
+
+from .batching import InferenceBatcher
+from .budget import MemoryBudget
+from .cache import ResultCache
+from .decoding import Decoder
+from .executor import ExecutorConfig, InferenceExecutor
+from .fetcher import ImageData, ImageFetcher, is_local, local_path, map_file, normalize_url
+from .jobs import RESULTS_TOPIC, Job
+from .metrics import ServiceMetrics
+from .models import ModelConfig, save_state_dict, warm_up
+from .pipeline import FairQueue, InFlight, Pipeline, Stage, WorkItem
+from .procpool import InferenceProcessPool, convert_prediction
+from .profiling import ProfileSession
+from .wire import (
+    FramesREPMixin,
+    ResultEncoding,
+    category_index,
+    encode_detections,
+    encode_message,
+    predict_entries,
 )
 
 LOGGER = logging.getLogger(__name__)
-# Weights for the model, see the torchvision.models.detection docs for more options
-WEIGHTS = FasterRCNN_ResNet50_FPN_V2_Weights.DEFAULT
-INFERENCE_THRESHOLD = 0.8
+QUEUE_POLICIES = ("fair", "fifo")
+# Where an image is skipped once its deadline passed
+EXPIRY_POINTS = ("fetch", "infer")
 
 
 @dataclass
-class ImagePredictionService(REPMixin, SimpleService):
+class ImagePredictionService(FramesREPMixin, REPMixin, SimpleService):  # pylint: disable=R0902
     """Service that handles image prediction requests and publishes results.
     Main class for ml-trial-task"""
 
-    model: torch.nn.Module = field(default_factory=torch.nn.Module, repr=False)
+    model: Optional[torch.nn.Module] = field(default=None, repr=False)
+    model_config: Optional[ModelConfig] = field(init=False, default=None, repr=False)
+    loaded_model_config: Optional[ModelConfig] = field(init=False, default=None, repr=False)
+    preprocess: Optional[Callable[[Any], torch.Tensor]] = field(init=False, default=None, repr=False)
+    model_load_s: float = field(init=False, default=0.0, repr=False)
+    decoder: Optional[Decoder] = field(init=False, default=None, repr=False)
+    decode_config: dict[str, Any] = field(init=False, default_factory=dict, repr=False)
+    batcher: Optional[InferenceBatcher] = field(init=False, default=None, repr=False)
+    inference_executor: Optional[InferenceExecutor] = field(init=False, default=None, repr=False)
+    fetcher: Optional[ImageFetcher] = field(init=False, default=None, repr=False)
+    file_roots: tuple[Path, ...] = field(init=False, default=(), repr=False)
+    memory: MemoryBudget = field(init=False, default_factory=MemoryBudget, repr=False)
+    pipeline: Pipeline = field(init=False, default_factory=Pipeline, repr=False)
+    queue_policy: str = field(init=False, default="fair", repr=False)
+    max_priority: int = field(init=False, default=10, repr=False)
+    inflight: InFlight = field(init=False, default_factory=InFlight, repr=False)
+    jobs: dict[str, Job] = field(init=False, default_factory=dict, repr=False)
+    jobs_completed: int = field(init=False, default=0, repr=False)
+    # Seconds predict requests get without a ttl_s of their own, 0 for no deadline
+    default_ttl_s: float = field(init=False, default=0.0, repr=False)
+    expired: Counter[str] = field(init=False, default_factory=Counter, repr=False)
+    cache: Optional[ResultCache] = field(init=False, default=None, repr=False)
+    cache_config: dict[str, Any] = field(init=False, default_factory=dict, repr=False)
+    procpool: Optional[InferenceProcessPool] = field(init=False, default=None, repr=False)
+    procpool_config: dict[str, Any] = field(init=False, default_factory=dict, repr=False)
+    # Temp dir of the default state_path, removed on teardown
+    procpool_dir: Optional[Path] = field(init=False, default=None, repr=False)
+    metrics: ServiceMetrics = field(init=False, default_factory=ServiceMetrics, repr=False)
+    metrics_config: dict[str, Any] = field(init=False, default_factory=dict, repr=False)
+    result_encoding: ResultEncoding = field(init=False, default_factory=ResultEncoding, repr=False)
+    category_index: dict[str, int] = field(init=False, default_factory=dict, repr=False)
+    profiling: Optional[ProfileSession] = field(init=False, default=None, repr=False)
 
     def reload(self) -> None:
         """Load configs, restart sockets"""
         super().reload()
 
-        # Load the detection model (blocking call; if needed, offload to a thread)
-        self.model = fasterrcnn_resnet50_fpn_v2(
-            weights=WEIGHTS,
-            box_score_thresh=INFERENCE_THRESHOLD,
+        self._reload_batcher()
+
+        # Only replace the HTTP session (and drop its pooled connections) if the settings changed,
+        # the fetches in progress finish on the old one
+        fetcher = ImageFetcher.from_config(self.config.get("http", {}))
+        if fetcher != self.fetcher:
+            if self.fetcher is not None:
+                self.tm.create_task(self.fetcher.close_when_idle())
+            self.fetcher = fetcher
+        self.file_roots = tuple(
+            Path(root).expanduser() for root in self.config.get("sources", {}).get("file_roots", []) if root
+        )
+        # Kept across reloads, the images in flight still hold their reservations
+        self.memory.resize(int(float(self.config.get("memory", {}).get("budget_mb", 0)) * 1024 * 1024))
+
+        self._reload_pipeline()
+
+        # Keep cached results across reloads unless the cache settings changed
+        cacheconf = dict(self.config.get("cache", {}))
+        if self.cache is None or cacheconf != self.cache_config:
+            if self.cache is not None:
+                self.cache.close()
+            self.cache = ResultCache.from_config(cacheconf)
+            self.cache_config = cacheconf
+
+        self.result_encoding = ResultEncoding.from_config(self.config.get("results", {}))
+
+        # Histograms restart empty if their windows changed
+        metricsconf = dict(self.config.get("metrics", {}))
+        if metricsconf != self.metrics_config:
+            self.metrics = ServiceMetrics.from_config(metricsconf)
+            self.metrics_config = metricsconf
+        if not self.tm.exists("METRICS"):
+            self.tm.create_task(self._publish_metrics(), name="METRICS")
+
+        # The model is (re)built off the event loop and only if its settings changed, predict answers
+        # "Model not loaded" until it is ready. A load already in progress picks up changed settings when done.
+        model_config = ModelConfig.from_config(self.config.get("model", {}))
+        if model_config != self.model_config or self.model is None:
+            self.model_config = model_config
+            if not self.tm.exists("MODEL_LOAD"):
+                self.tm.create_task(self._load_model(), name="MODEL_LOAD")
+
+        # The decode size follows the loaded model, see _load_model. The worker processes get a copy of the decoder.
+        decodeconf = dict(self.config.get("decode", {}))
+        restart_pool = decodeconf != self.decode_config
+        self.decode_config = decodeconf
+        poolconf = dict(self.config.get("procpool", {}))
+        if poolconf != self.procpool_config:
+            self.procpool_config = poolconf
+            restart_pool = True
+        if restart_pool and self.model is not None:
+            self.decoder = Decoder.for_model(self.model, decodeconf)
+            self._restart_procpool()
+
+    def _reload_batcher(self) -> None:
+        """Create the batcher and the inference threads or apply the new settings to them"""
+        # Keep the batcher (and its pending inputs) across reloads, just apply the new limits
+        batchconf = self.config.get("batching", {})
+        if self.batcher is None:
+            self.batcher = InferenceBatcher(self._run_model)
+        self.batcher.max_batch_size = max(1, int(batchconf.get("max_batch_size", 8)))
+        self.batcher.max_wait_ms = float(batchconf.get("max_wait_ms", 10.0))
+        # Forward passes run in their own threads, replaced (after the running ones finish) if the settings changed
+        executor_config = ExecutorConfig.from_config(self.config.get("inference", {}))
+        if self.inference_executor is None or executor_config != self.inference_executor.config:
+            if self.inference_executor is not None:
+                self.inference_executor.shutdown()
+            self.inference_executor = InferenceExecutor(executor_config)
+        self.batcher.executor = self.inference_executor.executor
+        self.batcher.concurrency = executor_config.workers
+        if not self.tm.exists("BATCHER"):
+            self.tm.create_task(self.batcher.run(), name="BATCHER")
+
+    def _reload_pipeline(self) -> None:
+        """Create the stages or apply the new worker counts and bounds to them"""
+        # fetch -> decode -> preprocess -> infer -> publish, each stage with its own workers and bounded queue.
+        # The fetch queue is the admission queue predict puts accepted URLs into.
+        pipeconf = self.config.get("pipeline", {})
+        stage_queue_size = int(pipeconf.get("stage_queue_size", 64))
+        queueconf = self.config.get("queue", {})
+        policy = str(queueconf.get("policy", "fair"))
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"Unknown queue policy {policy!r}, choose one of {', '.join(QUEUE_POLICIES)}")
+        # The stage queues ask _flow for the policy, so changing it applies to the items queued after the reload
+        self.queue_policy = policy
+        self.max_priority = max(1, int(queueconf.get("max_priority", 10)))
+        self.default_ttl_s = max(0.0, float(queueconf.get("default_ttl_s", 0)))
+        for name, handler, default_workers in (
+            ("fetch", self._fetch_stage, 64),
+            ("decode", self._decode_stage, 4),
+            ("preprocess", self._preprocess_stage, 2),
+            ("infer", self._infer_stage, 16),
+            ("publish", self._publish_stage, 1),
+        ):
+            stage = self.pipeline.add(Stage(name, handler, queue=FairQueue(self._flow)))
+            stage.workers = max(1, int(pipeconf.get(f"{name}_workers", default_workers)))
+            stage.maxsize = stage_queue_size
+        self.pipeline["fetch"].maxsize = int(queueconf.get("max_depth", 1000))
+        self.pipeline.start(self.tm)
+
+    def _flow(self, item: WorkItem) -> tuple[Hashable, float]:
+        """Fair queuing flow of the item, its job weighted by priority (all items share one flow with fifo)"""
+        if self.queue_policy == "fifo" or item.job is None:
+            return None, 1.0
+        return item.job.job_id, float(item.job.priority)
+
+    def _procpool_state_path(self, model_config: ModelConfig) -> Optional[Path]:
+        """Float weights file the worker processes map, None if the pool is disabled"""
+        if int(self.procpool_config.get("workers", 0)) <= 0:
+            return None
+        if model_config.artifact is not None:
+            return model_config.artifact
+        if self.procpool_config.get("state_path"):
+            return Path(self.procpool_config["state_path"])
+        # Per service, so services on the same host do not overwrite each other's weights
+        if self.procpool_dir is None:
+            self.procpool_dir = Path(tempfile.mkdtemp(prefix="ml_trial_task_weights_"))
+        return self.procpool_dir / "weights.pt"
+
+    def _build_model(self, model_config: ModelConfig) -> torch.nn.Module:
+        """Load and warm up the model, blocking so run this in a thread"""
+        state_path = self._procpool_state_path(model_config)
+        model = model_config.load(save_to=state_path if state_path != model_config.artifact else None)
+        warm_up(
+            model,
+            runs=model_config.warmup_runs,
+            batch_size=model_config.warmup_batch_size,
+            image_size=model_config.warmup_image_size,
         )
-        self.model.eval()
-        LOGGER.info("Detection model loaded.")
+        return model
+
+    async def _load_model(self) -> None:
+        """Build the model in a thread, swap it in and advertise readiness"""
+        try:
+            while True:
+                model_config = self.model_config
+                assert model_config is not None
+                started = time.monotonic()
+                try:
+                    model = await asyncio.to_thread(self._build_model, model_config)
+                except Exception as exc:  # pylint: disable=W0718
+                    LOGGER.exception("Loading the detection model failed: {}".format(exc))
+                    return
+                if model_config == self.model_config:
+                    break
+                LOGGER.info("Model settings changed while loading, loading again")
+            self.model, self.loaded_model_config = model, model_config
+            self.preprocess = model_config.weights.transforms()
+            self.category_index = category_index(model_config.categories)
+            self.decoder = Decoder.for_model(model, self.decode_config)
+            self.model_load_s = time.monotonic() - started
+            LOGGER.info("Detection model {} loaded.".format(model_config.identity))
+            self._restart_procpool()
+            # Binary encoded results refer to the categories by index
+            status = {
+                "ready": True,
+                "model": model_config.identity,
+                "load_s": self.model_load_s,
+                "categories": model_config.categories,
+            }
+            await self.psmgr.publish_async(PubSubDataMessage(topic="status", data=status))
+        except asyncio.CancelledError:
+            LOGGER.debug("Cancelled")
+
+    def _restart_procpool(self) -> None:
+        """Optionally run decode, preprocess and inference in worker processes sharing the saved weights"""
+        if self.procpool is not None:
+            self.procpool.shutdown()
+            self.procpool = None
+        model_config = self.loaded_model_config
+        state_path = self._procpool_state_path(model_config) if model_config else None
+        if model_config is None or state_path is None:
+            return
+        if not state_path.exists():
+            if model_config.quantize:
+                LOGGER.error("No float weights for the worker processes, set model.cache_dir or restart")
+                return
+            assert self.model is not None
+            save_state_dict(self.model, state_path)
+        self.procpool = InferenceProcessPool(
+            loader=functools.partial(model_config.load, state_path),
+            state_path=state_path,
+            preprocess=model_config.weights.transforms,
+            categories=model_config.categories,
+            decoder=self.decoder or Decoder(),
+            workers=int(self.procpool_config["workers"]),
+            threads_per_worker=int(self.procpool_config.get("threads_per_worker", 1)),
+        )
+
+    async def _publish_metrics(self) -> None:
+        """Publish the stats on the metrics topic every metrics.interval_s seconds"""
+        try:
+            while True:
+                interval = float(self.metrics_config.get("interval_s", 10.0))
+                # Keep polling while disabled so a reload can enable it
+                await asyncio.sleep(interval if interval > 0 else 1.0)
+                if interval <= 0:
+                    continue
+                try:
+                    await self.psmgr.publish_async(PubSubDataMessage(topic="metrics", data=await self.stats()))
+                except Exception as exc:  # pylint: disable=W0718
+                    LOGGER.error("Publishing metrics failed: {}".format(exc))
+        except asyncio.CancelledError:
+            LOGGER.debug("Cancelled")
+
+    def _run_model(self, tensors: list[torch.Tensor]) -> list[dict[str, torch.Tensor]]:
+        """Single forward pass over a batch, called in an inference thread"""
+        if self.model is None:
+            raise RuntimeError("Model not loaded")
+        model = self.model
+        operators = self.profiling.operators if self.profiling is not None else None
+        with torch.inference_mode():
+            if operators is not None:
+                return operators.run(lambda: list(model(tensors)))
+            return list(model(tensors))
+
+    async def teardown(self) -> None:
+        """Close the HTTP session, then stop tasks and sockets"""
+        if self.fetcher is not None:
+            await self.fetcher.close()
+        if self.cache is not None:
+            self.cache.close()
+        if self.procpool is not None:
+            self.procpool.shutdown()
+        if self.procpool_dir is not None:
+            shutil.rmtree(self.procpool_dir, ignore_errors=True)
+            self.procpool_dir = None
+        if self.inference_executor is not None:
+            self.inference_executor.shutdown()
+        await super().teardown()
+
+    async def _heartbeat_task(self) -> None:
+        """Send a periodic heartbeat with the load, see load"""
+        try:
+            while self.psmgr.default_pub_socket and not self.psmgr.default_pub_socket.closed:
+                msg = create_heartbeat_message()
+                msg.data["load"] = self.load()
+                await self.psmgr.publish_async(msg)
+                await asyncio.sleep(1)
+            LOGGER.warning("Lost self.psmgr.default_pub_socket before heartbeat was cancelled")
+        except asyncio.CancelledError:
+            LOGGER.debug("Cancelled")
+
+    def load(self) -> dict[str, Any]:
+        """Images accepted but not published yet and room left in the queue, the broker routes by these"""
+        admission = self.pipeline.stages.get("fetch")
+        return {
+            "ready": self.model is not None,
+            "queued": sum(stage.depth + stage.busy for stage in self.pipeline.stages.values()),
+            "free": admission.free if admission else 0,
+        }
 
     async def echo(self, *args: Any) -> Any:
         """return the args, this method kept for pytest"""
         await asyncio.sleep(0.01)
         return args
 
-    async def predict(self, urls: list[str]) -> dict[str, Any]:
+    async def predict(  # pylint: disable=R0913,R0917
+        self,
+        urls: list[str],
+        job_id: Optional[str] = None,
+        priority: int = 1,
+        inline: Optional[list[str]] = None,
+        frames: Optional[list[bytes]] = None,
+        ttl_s: Optional[float] = None,
+    ) -> dict[str, Any]:
         """
-        Accepts a list of image URLs, spawns background tasks to process each,
+        Accepts a list of image URLs, queues as many as fit for the background workers,
         and immediately returns an acknowledgement.
+
+        URLs are accepted in order, so when the queue fills up the first num_images were accepted and the
+        rest (num_rejected) should be resubmitted later. URLs already being processed (num_coalesced) do not
+        take a queue slot, they get the same result published for them when it is ready.
+
+        The results are published on the job topic (results/<job_id>/) followed by a completion marker with
+        "complete" set and the counts. Pass your own job_id to subscribe to the topic before sending the request.
+
+        Images of concurrent requests are interleaved, a request with priority 2 gets twice the share of one
+        with priority 1 (up to queue.max_priority).
+
+        Besides http(s) URLs, urls may have file:// URLs of files under sources.file_roots, they are memory-mapped
+        instead of fetched. Image bytes can also be sent as extra frames after the command (see
+        wire.send_command_with_frames), inline names them for the results (default frame:<index>). They count
+        after the URLs when the queue fills up.
+
+        With ttl_s (default queue.default_ttl_s) the results are only wanted for that many seconds. Images still
+        waiting to be fetched or to run through the model then are skipped, their result has "expired" set.
         """
-        if not self.model:
+        if self.model is None:
             return {"status": "error", "error": "Model not loaded"}
-        for url in urls:
-            self.create_task(self.process_image(url, self.model), name=f"processing-{url}")
-        return {"status": "processing", "num_images": len(urls)}
+        if ttl_s is None and self.default_ttl_s:
+            ttl_s = self.default_ttl_s
+        try:
+            job = Job.for_request(job_id, priority, self.max_priority, ttl_s)
+            entries = predict_entries(urls, inline, frames)
+        except ValueError as exc:
+            return {"status": "error", "error": str(exc)}
+        if job.job_id in self.jobs:
+            return {"status": "error", "error": f"Job {job.job_id} is still running"}
+        admission = self.pipeline["fetch"]
+        accepted, coalesced = self._admit(entries, job)
+        job.expected = accepted
+        if accepted:
+            self.jobs[job.job_id] = job
+        rejected = len(entries) - accepted
+        status = "processing"
+        if rejected:
+            status = "partial" if accepted else "rejected"
+            LOGGER.warning("Queue full, rejected {} of {} images".format(rejected, len(entries)))
+        return {
+            "status": status,
+            "job_id": job.job_id,
+            "topic": job.topic,
+            "priority": job.priority,
+            "ttl_s": ttl_s,
+            "num_images": accepted,
+            "num_rejected": rejected,
+            "num_coalesced": coalesced,
+            "queue_depth": admission.depth,
+            "estimated_wait_s": admission.estimated_wait(),
+        }
+
+    def _admit(self, entries: list[tuple[str, Optional[bytes]]], job: Job) -> tuple[int, int]:
+        """Queue the (url, inline bytes) entries in order until the queue is full, return accepted and coalesced"""
+        admission = self.pipeline["fetch"]
+        accepted = coalesced = 0
+        for url, data in entries:
+            key = normalize_url(url) if data is None else None
+            if key is not None and self.inflight.attach(key, url, job):
+                coalesced += 1
+            else:
+                item = WorkItem(url, data=data, key=key, job=job)
+                if not admission.offer(item):
+                    break
+                if key is not None:
+                    self.inflight.add(item)
+            accepted += 1
+        return accepted, coalesced
+
+    async def categories(self) -> dict[str, Any]:
+        """The category table the label indices of binary encoded results refer to"""
+        model_config = self.loaded_model_config
+        return {
+            "model": model_config.identity if model_config else None,
+            "categories": model_config.categories if model_config else [],
+        }
 
-    async def process_image(self, url: str, model: torch.nn.Module) -> None:  # pylint: disable=R0914
-        """Fetch the image from URL, run detection, and publish results."""
-        LOGGER.info("Processing image: {}".format(url))
+    async def profile(  # pylint: disable=R0913,R0917
+        self,
+        seconds: float = 10.0,
+        mode: str = "sample",
+        torch_ops: bool = False,
+        top: int = 25,
+        wait: bool = False,
+    ) -> dict[str, Any]:
+        """
+        Profile the running service for the given seconds, see profiling.ProfileSession for the modes.
 
-        # Fetch the image asynchronously using aiohttp
+        The summary of the top functions (and with torch_ops the top operators of the forward passes, not available
+        with the worker processes) is published on the "profile" topic and written to profiling.output_dir if set.
+        With wait the reply is the summary, the socket then answers nothing else until it is done.
+        """
+        if self.profiling is not None:
+            return {"status": "error", "error": "Already profiling"}
+        max_seconds = float(self.config.get("profiling", {}).get("max_seconds", 300))
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers={"User-Agent": "service"}) as resp:
-                    if resp.status != 200:
-                        raise Exception(f"HTTP error: {resp.status}")  # pylint: disable=W0719
-                    img_bytes = await resp.read()
-        except Exception as e:  # pylint: disable=W0718
-            error_result = {"url": url, "error": f"Failed to fetch image: {str(e)}"}
-            await self.psmgr.publish_async(PubSubDataMessage(topic="results", data=error_result))
-            LOGGER.error("Error fetching {}: {}".format(url, e))
-            return
+            if seconds > max_seconds:
+                raise ValueError(f"seconds must be at most {max_seconds}")
+            session = ProfileSession(float(seconds), mode, bool(torch_ops), int(top))
+        except ValueError as exc:
+            return {"status": "error", "error": str(exc)}
+        session.start()
+        self.profiling = session
+        task = self.tm.create_task(self._finish_profile(session), name="PROFILE")
+        if wait:
+            return {"status": "done", **await task}
+        return {"status": "profiling", "seconds": session.seconds, "topic": "profile"}
 
-        # Convert bytes to a PIL image
+    async def _finish_profile(self, session: ProfileSession) -> dict[str, Any]:
+        """Stop profiling after the session's seconds, publish and write the summary"""
         try:
-            image = Image.open(io.BytesIO(img_bytes)).convert("RGB")
+            await asyncio.sleep(session.seconds)
+        finally:
+            summary = session.stop()
+            self.profiling = None
+        output_dir = str(self.config.get("profiling", {}).get("output_dir", ""))
+        if output_dir:
+            path = Path(output_dir).expanduser() / "profile-{}.json".format(time.strftime("%Y%m%d-%H%M%S"))
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                await asyncio.to_thread(path.write_text, json.dumps(summary, indent=2), "utf-8")
+                summary["path"] = str(path)
+            except OSError as exc:
+                LOGGER.error("Writing the profile to {} failed: {}".format(path, exc))
+        LOGGER.info("Profiling done")
+        await self.psmgr.publish_async(PubSubDataMessage(topic="profile", data=summary))
+        return summary
+
+    async def stats(self) -> dict[str, Any]:
+        """Return service metrics"""
+        return {
+            "pipeline": self.pipeline.stats(),
+            "inflight": self.inflight.stats(),
+            "fetch": self.fetcher.stats() if self.fetcher else {},
+            "jobs": {"active": len(self.jobs), "completed": self.jobs_completed},
+            "expired": {point: self.expired[point] for point in EXPIRY_POINTS},
+            "batching": self.batcher.stats() if self.batcher else {},
+            "inference": self.inference_executor.stats() if self.inference_executor else {},
+            "memory": self.memory.stats(),
+            "cache": self.cache.stats() if self.cache else {},
+            "procpool": self.procpool.stats() if self.procpool else {},
+            "metrics": self.metrics.stats(),
+            "model": {
+                "ready": self.model is not None,
+                "name": self.loaded_model_config.identity if self.loaded_model_config else None,
+                "load_s": self.model_load_s,
+            },
+        }
+
+    async def _fetch_stage(self, item: WorkItem) -> None:
+        """Fetch the image bytes, answer from the result cache when possible"""
+        LOGGER.info("Processing image: {}".format(item.url))
+        if self._expire(item, "fetch"):
+            await self.pipeline["publish"].put(item)
+            return
+        try:
+            # Inline images come with their bytes
+            if item.data is None:
+                with item.timed("fetch"):
+                    item.data = await self._read_source(item.url)
+            item.nbytes = len(item.data)
         except Exception as e:  # pylint: disable=W0718
-            error_result = {"url": url, "error": f"Image open error: {str(e)}"}
-            await self.psmgr.publish_async(PubSubDataMessage(topic="results", data=error_result))
-            LOGGER.error("Error processing {}: {}".format(url, e))
+            item.error = f"Failed to fetch image: {str(e)}"
+            LOGGER.error("Error fetching {}: {}".format(item.url, e))
+            await self.pipeline["publish"].put(item)
+            return
+
+        # Same bytes with the same model and threshold give the same detections
+        assert self.loaded_model_config
+        model_config = self.loaded_model_config
+        with item.timed("cache"):
+            item.cache_key = ResultCache.make_key(item.data, model_config.identity, model_config.score_threshold)
+            cached = await self.cache.get(item.cache_key) if self.cache else None
+        if cached is not None:
+            item.detections, item.cached, item.data = cached, True, None
+            await self.pipeline["publish"].put(item)
             return
+        # The worker processes decode for themselves
+        await self.pipeline["infer" if self.procpool is not None else "decode"].put(item)
+
+    def _expire(self, item: WorkItem, point: str) -> bool:
+        """Drop the work of the item if nobody waits for it any more, True if it should go to publish"""
+        if not item.past_deadline():
+            return False
+        item.expired = True
+        item.error = f"Deadline passed before {point}"
+        item.data = item.image = item.tensor = None
+        self.expired[point] += 1
+        LOGGER.info("Skipping {}, deadline passed before {}".format(item.url, point))
+        return True
 
-        # Preprocess the image using the transforms provided by the weights
-        preprocess = WEIGHTS.transforms()
-        input_tensor = preprocess(image)  # shape: [3, H, W]
+    async def _read_source(self, url: str) -> ImageData:
+        """Map a local file or fetch the URL using the shared session"""
+        if is_local(url):
+            return await asyncio.to_thread(map_file, local_path(url, self.file_roots))
+        assert self.fetcher
+        return await self.fetcher.fetch(url)
 
-        # Run inference in a thread to avoid blocking the event loop
+    async def _reserve(self, item: WorkItem) -> None:
+        """Wait for the estimated footprint of the image (by its header) to fit in the memory budget"""
+        assert item.data is not None
+        assert self.decoder
+        with item.timed("memory"):
+            item.reserved = await self.memory.reserve(self.decoder.footprint(item.data))
+
+    def _release(self, item: WorkItem, nbytes: Optional[int] = None) -> None:
+        """Give back nbytes (default all) of the reservation of the item"""
+        nbytes = item.reserved if nbytes is None else min(nbytes, item.reserved)
+        item.reserved -= nbytes
+        self.memory.release(nbytes)
+
+    async def _decode_stage(self, item: WorkItem) -> None:
+        """Decode the bytes to a uint8 tensor at about the model input size in a thread"""
+        assert item.data is not None
         try:
-            # The model expects a list of tensors
-            predictions = await asyncio.to_thread(model, [input_tensor])
+            assert self.decoder
+            await self._reserve(item)
+            with item.timed("decode"):
+                decoded = await asyncio.to_thread(self.decoder.decode, item.data)
+            item.image, item.scale = decoded.tensor, decoded.scale
         except Exception as e:  # pylint: disable=W0718
-            error_result = {"url": url, "error": f"Inference error: {str(e)}"}
-            await self.psmgr.publish_async(PubSubDataMessage(topic="results", data=error_result))
-            LOGGER.error("Inference error for {}: {}".format(url, e))
+            item.error = f"Image open error: {str(e)}"
+            LOGGER.error("Error processing {}: {}".format(item.url, e))
+            await self.pipeline["publish"].put(item)
             return
+        finally:
+            item.data = None
+            # The encoded bytes are gone
+            self._release(item, item.nbytes)
+        await self.pipeline["preprocess"].put(item)
 
-        # Extract and convert prediction results
-        pred = predictions[0]
+    async def _preprocess_stage(self, item: WorkItem) -> None:
+        """Apply the transforms provided by the weights (uint8 to float) in a thread"""
         try:
-            boxes = pred["boxes"].detach().cpu().numpy().astype(int).tolist()
-            labels = pred["labels"].detach().cpu().numpy().tolist()
-            labels = [WEIGHTS.meta["categories"][i] for i in labels]
-            scores = pred["scores"].detach().cpu().numpy().tolist()
+            assert self.preprocess
+            with item.timed("preprocess"):
+                item.tensor = await asyncio.to_thread(self.preprocess, item.image)  # shape: [3, H, W]
         except Exception as e:  # pylint: disable=W0718
-            error_result = {"url": url, "error": f"Result parsing error: {str(e)}"}
-            await self.psmgr.publish_async(PubSubDataMessage(topic="results", data=error_result))
-            LOGGER.error("Parsing error for {}: {}".format(url, e))
+            item.error = f"Preprocessing error: {str(e)}"
+            LOGGER.error("Preprocessing error for {}: {}".format(item.url, e))
+            await self.pipeline["publish"].put(item)
             return
+        finally:
+            item.image = None
+        await self.pipeline["infer"].put(item)
+
+    async def _infer_stage(self, item: WorkItem) -> None:
+        """Run detection, either in the worker processes or via the batcher.
+
+        Each worker here keeps one image in flight, so the number of workers caps how full a batch can get."""
+        if self._expire(item, "infer"):
+            await self.pipeline["publish"].put(item)
+            return
+        try:
+            if self.procpool is not None:
+                await self._reserve(item)
+                assert item.data is not None
+                # A memory map can not be sent to another process, its bytes can
+                data = item.data if isinstance(item.data, bytes) else item.data[:]
+                with item.timed("infer"):
+                    item.detections = await self.procpool.detect(data)
+                item.data = None
+            else:
+                # Queue for the next batched forward pass (which runs in a thread to avoid blocking the event loop)
+                assert self.batcher
+                with item.timed("infer"):
+                    pred = await self.batcher.predict(item.tensor)
+                item.tensor = None
+                assert self.loaded_model_config
+                item.detections = convert_prediction(pred, self.loaded_model_config.categories, item.scale)
+        except Exception as e:  # pylint: disable=W0718
+            item.error = f"Inference error: {str(e)}"
+            LOGGER.error("Inference error for {}: {}".format(item.url, e))
+        else:
+            if self.cache and item.cache_key:
+                await self.cache.put(item.cache_key, item.detections)
+        await self.pipeline["publish"].put(item)
+
+    async def _publish_stage(self, item: WorkItem) -> None:
+        """Publish the detections or the error for the image, with the bytes fetched and the stage timings.
+
+        timings_ms has the milliseconds spent in each stage, "queued" for the time spent waiting between them
+        and "total" from acceptance to publishing. Requests attached to the item get the same result with their URL
+        and "coalesced" set. Each goes to the topic of its job."""
+        # From here on a request for the same URL starts over instead of missing the result
+        self.inflight.remove(item)
+        self._release(item)
+        total_ms = item.elapsed_ms()
+        timings_ms = {
+            **item.timings_ms,
+            "queued": max(0.0, total_ms - sum(item.timings_ms.values())),
+            "total": total_ms,
+        }
+        failed = (item.error is not None or item.detections is None) and not item.expired
+        frames: list[bytes] = []
+        if item.error is not None or item.detections is None:
+            result: dict[str, Any] = {"url": item.url, "error": item.error or "No detections"}
+            if item.expired:
+                result["expired"] = True
+        elif self.result_encoding.binary:
+            description, frames = encode_detections(
+                item.detections, self.category_index, self.result_encoding.score_dtype
+            )
+            model_config = self.loaded_model_config
+            result = {"url": item.url, **description, "model": model_config.identity if model_config else None}
+        else:
+            result = {"url": item.url, **item.detections}
+        if item.cached:
+            result["cached"] = True
+        result.update({"bytes": item.nbytes, "timings_ms": timings_ms})
+        with item.timed("publish"):
+            for idx, (url, job) in enumerate([(item.url, item.job), *item.duplicates]):
+                data = {**result, "url": url} if idx else result
+                if idx:
+                    data["coalesced"] = True
+                if job is not None:
+                    data["job_id"] = job.job_id
+                await self.psmgr.publish_async(encode_message(job.topic if job else RESULTS_TOPIC, data, frames))
+                if job is not None:
+                    job.record(failed, item.cached, bool(idx), item.expired)
+                    if job.done:
+                        await self._complete_job(job)
+        # The publish time only makes it into the metrics
+        self.metrics.record({**timings_ms, "publish": item.timings_ms["publish"]}, item.nbytes, failed, item.cached)
+        if item.error is None and item.detections is not None:
+            LOGGER.info("Published results for {}, labels={}".format(item.url, item.detections["labels"]))
 
-        result = {"url": url, "boxes": boxes, "labels": labels, "scores": scores}
-        await self.psmgr.publish_async(PubSubDataMessage(topic="results", data=result))
-        LOGGER.info("Published results for {}, labels={}".format(url, labels))
+    async def _complete_job(self, job: Job) -> None:
+        """Publish the completion marker of the job and forget it"""
+        self.jobs.pop(job.job_id, None)
+        self.jobs_completed += 1
+        await self.psmgr.publish_async(PubSubDataMessage(topic=job.topic, data=job.summary()))
+        LOGGER.info("Job {} complete".format(job.job_id))
@@ -0,0 +1,295 @@
+"""Streaming submission of very large URL lists with results written to a file"""
+
+from __future__ import annotations
+
+import asyncio
+import csv
+import itertools
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, Any, Callable, Iterable, Iterator, Optional, Protocol, cast
+
+from datastreamcorelib.datamessage import PubSubDataMessage
+from datastreamcorelib.pubsub import PubSubMessage, Subscription
+from datastreamservicelib.reqrep import REQMixin
+from datastreamservicelib.zmqwrappers import PubSubManager, SocketHandler
+
+from .jobs import RESULTS_TOPIC
+from .wire import decode_message
+
+LOGGER = logging.getLogger(__name__)
+
+
+def read_urls(path: Path, column: int = 0, skip_header: bool = True) -> Iterator[str]:
+    """URLs from a CSV column, read lazily row by row"""
+    with open(path, newline="", encoding="utf-8") as fpntr:
+        reader = csv.reader(fpntr)
+        if skip_header:
+            next(reader, None)
+        for row in reader:
+            if len(row) > column and row[column].strip():
+                yield row[column].strip()
+
+
+class ResultSink(Protocol):
+    """Where the results end up"""
+
+    def write(self, result: dict[str, Any]) -> None:
+        """Add one result"""
+
+    def close(self) -> None:
+        """Flush and close"""
+
+
+@dataclass
+class JsonlSink:
+    """One JSON object per line through a large write buffer"""
+
+    path: Path
+    buffer_size: int = 1 << 20
+    _fpntr: Optional[IO[str]] = field(init=False, default=None, repr=False)
+
+    def write(self, result: dict[str, Any]) -> None:
+        """Add one result"""
+        if self._fpntr is None:
+            self._fpntr = open(self.path, "wt", encoding="utf-8", buffering=self.buffer_size)  # pylint: disable=R1732
+        self._fpntr.write(json.dumps(result, default=str))
+        self._fpntr.write("\n")
+
+    def close(self) -> None:
+        """Flush and close"""
+        if self._fpntr is not None:
+            self._fpntr.close()
+            self._fpntr = None
+
+
+@dataclass
+class ParquetSink:
+    """Results as rows of a Parquet file, written in row groups of batch_rows. Needs pyarrow."""
+
+    path: Path
+    batch_rows: int = 10000
+    _rows: list[dict[str, Any]] = field(init=False, default_factory=list, repr=False)
+    _writer: Any = field(init=False, default=None, repr=False)
+
+    def __post_init__(self) -> None:
+        """Fail before anything is sent if pyarrow is missing"""
+        try:
+            import pyarrow  # pylint: disable=C0415,W0611
+        except ImportError as exc:
+            raise RuntimeError("Parquet output needs pyarrow, install it or use a .jsonl file") from exc
+
+    @staticmethod
+    def schema() -> Any:
+        """Columns of the file, timings are kept as a JSON string"""
+        import pyarrow as pa  # pylint: disable=C0415
+
+        return pa.schema(
+            [
+                ("url", pa.string()),
+                ("job_id", pa.string()),
+                ("error", pa.string()),
+                ("boxes", pa.list_(pa.list_(pa.int32()))),
+                ("labels", pa.list_(pa.string())),
+                ("scores", pa.list_(pa.float32())),
+                ("cached", pa.bool_()),
+                ("coalesced", pa.bool_()),
+                ("bytes", pa.int64()),
+                ("timings_ms", pa.string()),
+            ]
+        )
+
+    def write(self, result: dict[str, Any]) -> None:
+        """Add one result, a row group is written every batch_rows results"""
+        self._rows.append(
+            {
+                "url": result.get("url"),
+                "job_id": result.get("job_id"),
+                "error": result.get("error"),
+                "boxes": [list(box) for box in result.get("boxes", [])],
+                "labels": list(result.get("labels", [])),
+                "scores": [float(score) for score in result.get("scores", [])],
+                "cached": bool(result.get("cached", False)),
+                "coalesced": bool(result.get("coalesced", False)),
+                "bytes": int(result.get("bytes", 0)),
+                "timings_ms": json.dumps(result.get("timings_ms", {})),
+            }
+        )
+        if len(self._rows) >= self.batch_rows:
+            self._flush()
+
+    def _flush(self) -> None:
+        """Write the buffered rows as a row group"""
+        import pyarrow as pa  # pylint: disable=C0415
+        import pyarrow.parquet as pq  # pylint: disable=C0415
+
+        if not self._rows:
+            return
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(str(self.path), self.schema())
+        self._writer.write_table(pa.Table.from_pylist(self._rows, schema=self.schema()))
+        self._rows = []
+
+    def close(self) -> None:
+        """Write what is left and close the file"""
+        self._flush()
+        if self._writer is None:
+            # Still leave a valid (empty) file behind
+            import pyarrow.parquet as pq  # pylint: disable=C0415
+
+            self._writer = pq.ParquetWriter(str(self.path), self.schema())
+        self._writer.close()
+        self._writer = None
+
+
+def make_sink(path: Path) -> ResultSink:
+    """Sink by file extension, .parquet or .jsonl (the default)"""
+    if path.suffix.lower() == ".parquet":
+        return ParquetSink(path)
+    return JsonlSink(path)
+
+
+@dataclass
+class Progress:
+    """Prints a progress line at most every interval_s seconds"""
+
+    interval_s: float = 2.0
+    echo: Callable[[str], None] = print
+    _started: float = field(init=False, default_factory=time.monotonic, repr=False)
+    _last: float = field(init=False, default_factory=time.monotonic, repr=False)
+
+    def update(self, submitter: StreamingSubmitter, force: bool = False) -> None:
+        """Report unless the last report was too recent"""
+        now = time.monotonic()
+        if not force and now - self._last < self.interval_s:
+            return
+        self._last = now
+        elapsed = now - self._started
+        self.echo(
+            "sent {} done {} ({} errors) in flight {} rejected {} | {:.1f} images/s".format(
+                submitter.submitted,
+                submitter.received,
+                submitter.errors,
+                submitter.in_flight,
+                submitter.rejected,
+                submitter.received / elapsed if elapsed > 0 else 0.0,
+            )
+        )
+
+
+@dataclass
+class StreamingSubmitter:  # pylint: disable=R0902
+    """Sends the URLs in chunks, keeping at most window images in flight, and hands the results to the sink.
+
+    Each chunk is its own job. The job IDs share a prefix so one subscription gets the results of all of them.
+    URLs the service rejects (queue full) are sent again after a pause."""
+
+    requester: REQMixin
+    rep_socket: str
+    pub_socket: str
+    sink: ResultSink
+    chunk_size: int = 100
+    window: int = 1000
+    priority: int = 1
+    idle_timeout_s: float = 300.0
+    progress: Progress = field(default_factory=Progress)
+
+    session: str = field(init=False, default_factory=lambda: uuid.uuid4().hex[:16])
+    submitted: int = field(init=False, default=0)
+    received: int = field(init=False, default=0)
+    errors: int = field(init=False, default=0)
+    rejected: int = field(init=False, default=0)
+    jobs: int = field(init=False, default=0)
+    _categories: list[str] = field(init=False, default_factory=list, repr=False)
+    _room: asyncio.Event = field(init=False, default_factory=asyncio.Event, repr=False)
+    _last_result: float = field(init=False, default_factory=time.monotonic, repr=False)
+
+    @property
+    def in_flight(self) -> int:
+        """Accepted images without a result yet"""
+        return self.submitted - self.received
+
+    async def run(self, urls: Iterable[str], subscribe_grace_s: float = 0.3) -> None:
+        """Submit everything and wait for the last result"""
+        subscription = Subscription(
+            self.pub_socket, f"{RESULTS_TOPIC}/{self.session}-", self._on_message, decoder_class=PubSubDataMessage
+        )
+        PubSubManager(SocketHandler).subscribe_async(subscription)
+        await asyncio.sleep(subscribe_grace_s)
+        source = iter(urls)
+        retry: deque[str] = deque()
+        try:
+            while True:
+                chunk = [retry.popleft() for _ in range(min(len(retry), self.chunk_size))]
+                chunk.extend(itertools.islice(source, self.chunk_size - len(chunk)))
+                if not chunk:
+                    break
+                await self._wait_for_room(len(chunk))
+                rejected = await self._submit(chunk)
+                if rejected:
+                    retry.extendleft(reversed(rejected))
+                    # The service queue is full, give it time to drain
+                    await asyncio.sleep(0.5)
+                self.progress.update(self)
+            await self._wait_for_room(self.window)
+        finally:
+            self.sink.close()
+            self.progress.update(self, force=True)
+
+    async def _wait_for_room(self, count: int) -> None:
+        """Wait until count more images fit in the window (or until everything is done if count >= window)"""
+        limit = max(0, self.window - count)
+        while self.in_flight > limit:
+            self._room.clear()
+            try:
+                await asyncio.wait_for(self._room.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                if time.monotonic() - self._last_result > self.idle_timeout_s:
+                    raise TimeoutError(
+                        f"No results for {self.idle_timeout_s}s with {self.in_flight} in flight"
+                    ) from None
+            self.progress.update(self)
+
+    def owns(self, job_id: Any) -> bool:
+        """Is the job one of ours, the subscription prefix also matches sessions that start with our session"""
+        prefix = f"{self.session}-"
+        return isinstance(job_id, str) and job_id.startswith(prefix) and job_id[len(prefix) :].isdigit()
+
+    async def _submit(self, chunk: list[str]) -> list[str]:
+        """Send the chunk as a job, return the URLs that were not accepted"""
+        job_id = f"{self.session}-{self.jobs}"
+        self.jobs += 1
+        response = await self.requester.send_command(
+            self.rep_socket, "predict", chunk, job_id=job_id, priority=self.priority, timeout=30.0
+        )
+        reply = response.data.get("response") or {}
+        if reply.get("status") == "error":
+            raise RuntimeError(f"predict failed: {reply.get('error')}")
+        accepted = int(reply.get("num_images", 0))
+        self.submitted += accepted
+        self.rejected += len(chunk) - accepted
+        if accepted:
+            # The idle timeout counts from the last result or the last accepted chunk
+            self._last_result = time.monotonic()
+        return chunk[accepted:]
+
+    async def _on_message(self, sub: Subscription, msg: PubSubMessage) -> None:  # pylint: disable=W0613
+        """Write results to the sink, skip the job completion markers and the results of other sessions"""
+        msg = cast(PubSubDataMessage, msg)
+        if not self.owns(msg.data.get("job_id")) or msg.data.get("complete"):
+            return
+        if msg.data.get("encoding") == "binary" and not self._categories:
+            reply = await self.requester.send_command(self.rep_socket, "categories")
+            self._categories = reply.data["response"]["categories"]
+        result = decode_message(msg, self._categories)
+        result.pop("systemtime", None)
+        self.sink.write(result)
+        self.received += 1
+        self.errors += int("error" in result)
+        self._last_result = time.monotonic()
+        self._room.set()
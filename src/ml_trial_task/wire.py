@@ -0,0 +1,166 @@
+"""Binary payloads in extra ZMQ frames: compact detection results and inline images for predict"""
+
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, Mapping, Optional, Sequence, Union
+
+from datastreamcorelib.abstract import ZMQSocket, ZMQSocketDescription, ZMQSocketUrisInputTypes
+from datastreamcorelib.datamessage import PubSubDataMessage
+from datastreamcorelib.reqrep import REQREP_DEFAULT_TIMEOUT, REPMixinBase, REQMixinBase
+from datastreamservicelib.reqrep import REQMixin
+
+LOGGER = logging.getLogger(__name__)
+ENCODINGS = ("json", "binary")
+# Keys of the message data that describe the frames, dropped when decoding
+_FRAME_KEYS = ("encoding", "count", "dtypes")
+
+
+@dataclass(frozen=True)
+class ResultEncoding:
+    """The [results] config section.
+
+    With "binary" the boxes, label indices and scores go as packed little-endian arrays in three extra frames
+    after the msgpack data, which keeps the url, the model identity and the rest. Labels are indices into the
+    category table from the categories REP command. "json" (the default) keeps them as lists in the data."""
+
+    encoding: str = "json"
+    score_dtype: str = "float16"
+
+    def __post_init__(self) -> None:
+        """Fail early on typos"""
+        if self.encoding not in ENCODINGS:
+            raise ValueError(f"Unknown result encoding {self.encoding!r}, choose one of {', '.join(ENCODINGS)}")
+        if self.score_dtype not in ("float16", "float32"):
+            raise ValueError(f"score_dtype must be float16 or float32, not {self.score_dtype!r}")
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> ResultEncoding:
+        """Create from the [results] config section"""
+        return cls(
+            encoding=str(config.get("encoding", cls.encoding)),
+            score_dtype=str(config.get("score_dtype", cls.score_dtype)),
+        )
+
+    @property
+    def binary(self) -> bool:
+        """Are the detections sent in extra frames"""
+        return self.encoding == "binary"
+
+
+def category_index(categories: Sequence[str]) -> dict[str, int]:
+    """Index of each category name, repeated names (like "N/A") map to the first one"""
+    index: dict[str, int] = {}
+    for idx, name in enumerate(categories):
+        index.setdefault(name, idx)
+    return index
+
+
+def encode_detections(
+    detections: Mapping[str, Any], index: Mapping[str, int], score_dtype: str = "float16"
+) -> tuple[dict[str, Any], list[bytes]]:
+    """Pack boxes, labels and scores, return the frame description for the message data and the frames"""
+    # Not at the top, the CLI imports this module and should start without numpy
+    import numpy as np  # pylint: disable=C0415
+
+    boxes = np.asarray(detections["boxes"], dtype="<i4").reshape(-1, 4)
+    if not boxes.size or (boxes.min() >= np.iinfo(np.int16).min and boxes.max() <= np.iinfo(np.int16).max):
+        boxes = boxes.astype("<i2")
+    label_dtype = "<u1" if len(index) and max(index.values()) < 256 else "<u2"
+    labels = np.fromiter((index[label] for label in detections["labels"]), dtype=label_dtype)
+    scores = np.asarray(detections["scores"], dtype=np.dtype(score_dtype).newbyteorder("<"))
+    description = {
+        "encoding": "binary",
+        "count": len(boxes),
+        "dtypes": [boxes.dtype.str, labels.dtype.str, scores.dtype.str],
+    }
+    return description, [boxes.tobytes(), labels.tobytes(), scores.tobytes()]
+
+
+def decode_detections(
+    data: Mapping[str, Any], frames: Sequence[bytes], categories: Sequence[str], as_arrays: bool = False
+) -> dict[str, Any]:
+    """Inverse of encode_detections, returns the result as it would be with the json encoding.
+
+    as_arrays keeps boxes ([N, 4]) and scores as (read-only) numpy arrays instead of converting them to lists.
+    Results that are not binary encoded (like errors) are returned as they are."""
+    if data.get("encoding") != "binary":
+        return dict(data)
+    import numpy as np  # pylint: disable=C0415
+
+    box_dtype, label_dtype, score_dtype = data["dtypes"]
+    boxes = np.frombuffer(frames[0], dtype=box_dtype).reshape(-1, 4)
+    labels = np.frombuffer(frames[1], dtype=label_dtype)
+    scores = np.frombuffer(frames[2], dtype=score_dtype)
+    result = {key: value for key, value in data.items() if key not in _FRAME_KEYS}
+    result["labels"] = [categories[idx] for idx in labels.tolist()]
+    if as_arrays:
+        result.update({"boxes": boxes, "scores": scores})
+    else:
+        result.update({"boxes": boxes.tolist(), "scores": scores.astype(np.float32).tolist()})
+    return result
+
+
+def encode_message(topic: str, data: dict[str, Any], frames: Optional[Sequence[bytes]] = None) -> PubSubDataMessage:
+    """Message with the frames after the msgpack data"""
+    msg = PubSubDataMessage(topic=topic, data=data)
+    if frames:
+        # zmq_encode fills in the first two parts (message id and data) and keeps the rest
+        msg.dataparts = [b"", b"", *frames]
+    return msg
+
+
+def decode_message(msg: PubSubDataMessage, categories: Sequence[str], as_arrays: bool = False) -> dict[str, Any]:
+    """Result of a received results message, see decode_detections"""
+    return decode_detections(msg.data, msg.dataparts[2:], categories, as_arrays)
+
+
+def predict_entries(
+    urls: Sequence[str], inline: Optional[Sequence[str]] = None, frames: Optional[Sequence[bytes]] = None
+) -> list[tuple[str, Optional[bytes]]]:
+    """(url, None) for the URLs then (name, bytes) for the frames, in the order predict accepts them.
+    The frames are named frame:<index> unless inline names them, ValueError if the counts differ."""
+    frames = frames or []
+    names = inline if inline is not None else [f"frame:{idx}" for idx in range(len(frames))]
+    if len(names) != len(frames):
+        raise ValueError(f"{len(names)} inline names for {len(frames)} image frames")
+    entries: list[tuple[str, Optional[bytes]]] = [(url, None) for url in urls]
+    entries.extend(zip(names, frames))
+    return entries
+
+
+async def send_command_with_frames(  # pylint: disable=R0913
+    requester: REQMixin,
+    sockdef: Union[ZMQSocket, ZMQSocketUrisInputTypes],
+    cmd: str,
+    frames: Sequence[bytes],
+    *args: Any,
+    timeout: float = REQREP_DEFAULT_TIMEOUT,
+    **kwargs: Any,
+) -> PubSubDataMessage:
+    """Like requester.send_command but with the frames sent as they are after the command data.
+
+    For predict the frames are image files, name them with inline=[...] to tell the results apart:
+    send_command_with_frames(requester, sock, "predict", [jpeg_bytes], [], inline=["cam1.jpg"])"""
+    msg = REQMixinBase.construct_command(cmd, *args, **kwargs)
+    # zmq_encode fills in the first two parts (message id and data) and keeps the rest
+    msg.dataparts = [b"", b"", *frames]
+    return await requester._do_reqrep_async(sockdef, msg, timeout=timeout)  # pylint: disable=W0212
+
+
+class FramesREPMixin(REPMixinBase):
+    """Hands the frames after the command data of a predict request to predict as its frames argument"""
+
+    def resolve_command_method_and_args(
+        self,
+        msg: PubSubDataMessage,
+        look_in: Optional[Sequence[Any]] = None,
+        sdesc: Optional[ZMQSocketDescription] = None,
+    ) -> tuple[Callable[..., Any], Any, dict[str, Any]]:
+        """Add the frames to the predict arguments"""
+        cmd_method, cmd_args, cmd_kwargs = super().resolve_command_method_and_args(msg, look_in, sdesc)
+        if getattr(cmd_method, "__name__", None) == "predict":
+            # Only from the frames, not from the msgpack data
+            cmd_kwargs = {**cmd_kwargs, "frames": msg.dataparts[2:]}
+        return cmd_method, cmd_args, cmd_kwargs
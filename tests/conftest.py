@@ -1,7 +1,8 @@
 """Test fixtures"""
 
-from typing import Any, AsyncGenerator, Generator
+from typing import Any, AsyncGenerator, Awaitable, Callable, Generator
 import asyncio
+import io
 from pathlib import Path
 import logging
 import platform
@@ -15,6 +16,7 @@ from libadvian.logging import init_logging
 from datastreamservicelib.reqrep import REPMixin, REQMixin
 from datastreamservicelib.service import SimpleService
 from datastreamservicelib.compat import asyncio_eventloop_check_policy, asyncio_eventloop_get
+from PIL import Image
 
 from ml_trial_task.defaultconfig import DEFAULT_CONFIG_STR
 from ml_trial_task.service import ImagePredictionService
@@ -70,6 +72,54 @@ async def service_instance(nice_tmpdir: str) -> ImagePredictionService:
     return serv
 
 
+@pytest.fixture
+def offline_config(nice_tmpdir: str) -> dict[str, Any]:
+    """Service config with the sockets in the temp dir and a small model with random weights (no downloads),
+    no warm-up and no result cache, see offline_service"""
+    parsed: dict[str, Any] = tomlkit.parse(DEFAULT_CONFIG_STR).unwrap()
+    parsed["zmq"]["pub_sockets"] = ["ipc://" + str(Path(nice_tmpdir) / "ml_trial_task_offline_pub.sock")]
+    parsed["zmq"]["rep_sockets"] = ["ipc://" + str(Path(nice_tmpdir) / "ml_trial_task_offline_rep.sock")]
+    parsed["model"].update(
+        {"name": "fasterrcnn_mobilenet_v3_large_320_fpn", "pretrained": False, "cache_dir": "", "warmup_runs": 0}
+    )
+    parsed["cache"].update({"max_entries": 0, "path": ""})
+    return parsed
+
+
+@pytest.fixture
+def jpeg_bytes() -> bytes:
+    """A small JPEG to send to the offline_service"""
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 48), (200, 30, 30)).save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+@pytest_asyncio.fixture
+async def offline_service(
+    nice_tmpdir: str,
+) -> AsyncGenerator[Callable[[dict[str, Any]], Awaitable[ImagePredictionService]], None]:
+    """Factory starting a service with the given (offline_config based) config, returns once the model is
+    loaded. The services are stopped after the test."""
+    started: list[tuple[ImagePredictionService, asyncio.Task[int]]] = []
+
+    async def start(config: dict[str, Any]) -> ImagePredictionService:
+        configpath = Path(nice_tmpdir) / f"ml_trial_task_offline_{len(started)}.toml"
+        configpath.write_text(tomlkit.dumps(config), encoding="utf-8")
+        serv = ImagePredictionService(configpath)
+        started.append((serv, asyncio.create_task(serv.run())))
+        while serv.model is None:
+            await asyncio.sleep(0.1)
+        return serv
+
+    yield start
+    for serv, task in started:
+        serv.quit()
+        await asyncio.wait_for(task, timeout=10.0)
+    # Clear alarms and default exception handlers
+    ImagePredictionService.clear_exit_alarm()
+    asyncio.get_event_loop().set_exception_handler(None)
+
+
 @pytest_asyncio.fixture
 async def replier_instance(nice_tmpdir: str) -> ExampleREPlier:
     """Create a replier instance for use with tests"""
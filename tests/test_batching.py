@@ -0,0 +1,119 @@
+"""Test the inference batcher"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import pytest
+
+from ml_trial_task.batching import InferenceBatcher
+
+
+def double_all(inputs: list[Any]) -> list[Any]:
+    """Fake model, outputs are the inputs doubled"""
+    return [value * 2 for value in inputs]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_inputs_are_batched() -> None:
+    """Inputs arriving together go through in as few passes as the batch size allows"""
+    batcher = InferenceBatcher(double_all, max_batch_size=4, max_wait_ms=50)
+    task = asyncio.create_task(batcher.run())
+    try:
+        results = await asyncio.gather(*(batcher.predict(value) for value in range(10)))
+        assert results == [value * 2 for value in range(10)]
+        assert batcher.images == 10
+        assert batcher.batches == 3
+        stats = batcher.stats()
+        assert stats["size_histogram"] == {"2": 1, "4": 2}
+        assert stats["avg_batch_size"] == pytest.approx(10 / 3)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_lone_input_waits_at_most_max_wait() -> None:
+    """A single input is not held back waiting for a full batch"""
+    batcher = InferenceBatcher(double_all, max_batch_size=16, max_wait_ms=20)
+    task = asyncio.create_task(batcher.run())
+    try:
+        assert await asyncio.wait_for(batcher.predict(21), timeout=1.0) == 42
+        assert batcher.last_batch_size == 1
+        assert batcher.last_wait_ms < 500
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_runner_errors_reach_every_caller() -> None:
+    """A failing batch raises in each waiting caller and the loop keeps going"""
+    calls = 0
+
+    def flaky(inputs: list[Any]) -> list[Any]:
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise ValueError("boom")
+        return double_all(inputs)
+
+    batcher = InferenceBatcher(flaky, max_batch_size=2, max_wait_ms=50)
+    task = asyncio.create_task(batcher.run())
+    try:
+        results = await asyncio.gather(batcher.predict(1), batcher.predict(2), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert await batcher.predict(3) == 6
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_missing_outputs_fail_the_batch() -> None:
+    """A runner returning fewer outputs than inputs fails the callers instead of leaving some waiting"""
+    batcher = InferenceBatcher(lambda inputs: double_all(inputs)[:-1], max_batch_size=2, max_wait_ms=50)
+    task = asyncio.create_task(batcher.run())
+    try:
+        results = await asyncio.wait_for(
+            asyncio.gather(batcher.predict(1), batcher.predict(2), return_exceptions=True), timeout=1.0
+        )
+        assert all(isinstance(result, RuntimeError) and "1 outputs for 2" in str(result) for result in results)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_batches_run_concurrently_in_the_executor() -> None:
+    """With concurrency 2 two batches are in the given executor at the same time"""
+    running: list[int] = []
+    peak: list[int] = [0]
+    threads: set[str] = set()
+    lock = threading.Lock()
+
+    def slow_double(inputs: list[Any]) -> list[Any]:
+        with lock:
+            running.append(1)
+            peak[0] = max(peak[0], len(running))
+            threads.add(threading.current_thread().name)
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+        return double_all(inputs)
+
+    pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="test-inference")
+    batcher = InferenceBatcher(slow_double, max_batch_size=2, max_wait_ms=1, executor=pool, concurrency=2)
+    task = asyncio.create_task(batcher.run())
+    try:
+        results = await asyncio.gather(*(batcher.predict(value) for value in range(8)))
+        assert results == [value * 2 for value in range(8)]
+        assert peak[0] == 2
+        assert all(name.startswith("test-inference") for name in threads)
+        assert batcher.stats()["in_progress"] == 0
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        pool.shutdown()
@@ -0,0 +1,62 @@
+"""Test the on-disk body cache"""
+
+from pathlib import Path
+
+from ml_trial_task.bodycache import BodyCache
+
+
+def test_store_and_reopen(tmp_path: Path) -> None:
+    """Bodies with validators are kept across instances, the rest are not"""
+    cache = BodyCache(tmp_path / "bodies", 1024)
+    cache.put("http://example.com/a", b"first", '"a1"', None)
+    cache.put("http://example.com/b", b"second", None, None)
+    cache.put("http://example.com/c", b"", '"c1"', None)
+    assert cache.get("http://example.com/b") is None
+    assert cache.get("http://example.com/c") is None
+    cache.close()
+
+    cache = BodyCache(tmp_path / "bodies", 1024)
+    assert cache.total_bytes == 5
+    cached = cache.get("http://example.com/a")
+    assert cached is not None
+    assert cached.data[:] == b"first"
+    assert cached.conditional_headers() == {"If-None-Match": '"a1"'}
+    # Replacing the file does not change a mapped copy
+    cache.put("http://example.com/a", b"updated", '"a2"', "Wed, 21 Oct 2015 07:28:00 GMT")
+    assert cached.data[:] == b"first"
+    cached.close()
+    cached = cache.get("http://example.com/a")
+    assert cached is not None
+    assert cached.data[:] == b"updated"
+    assert cached.conditional_headers() == {
+        "If-None-Match": '"a2"',
+        "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT",
+    }
+    cached.close()
+    assert cache.total_bytes == 7
+    assert cache.stats()["hits"] == 2
+    cache.close()
+
+
+def test_evicts_least_recently_used(tmp_path: Path) -> None:
+    """Going over max_bytes removes the bodies used longest ago, a missing file is a miss"""
+    cache = BodyCache(tmp_path, 100)
+    for name in "abc":
+        cache.put(f"http://example.com/{name}", name.encode() * 40, '"x"', None)
+        if name == "b":
+            # Use a so b is the oldest
+            cached = cache.get("http://example.com/a")
+            assert cached is not None
+            cached.close()
+    assert cache.evicted == 1
+    assert cache.total_bytes == 80
+    assert cache.get("http://example.com/b") is None
+    for name in "ac":
+        cached = cache.get(f"http://example.com/{name}")
+        assert cached is not None
+        cached.close()
+
+    cache._path(cache.make_key("http://example.com/c")).unlink()  # pylint: disable=W0212
+    assert cache.get("http://example.com/c") is None
+    assert cache.total_bytes == 40
+    cache.close()
@@ -0,0 +1,231 @@
+"""Test the broker with worker services in their own processes"""
+
+# pylint: disable=W0621
+
+import asyncio
+import signal
+import sys
+import time
+from asyncio.subprocess import Process
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, AsyncGenerator, Callable, Optional, cast
+
+import pytest
+import pytest_asyncio
+import tomlkit
+from datastreamcorelib.datamessage import PubSubDataMessage
+from datastreamcorelib.pubsub import PubSubMessage, Subscription
+from datastreamservicelib.reqrep import REQMixin
+from datastreamservicelib.zmqwrappers import PubSubManager, SocketHandler
+
+from ml_trial_task.broker import Assignment, ImageBroker, WorkerState, split_by_load
+from ml_trial_task.defaultconfig import DEFAULT_BROKER_CONFIG_STR, DEFAULT_CONFIG_STR
+from ml_trial_task.jobs import Job
+from ml_trial_task.loadtest import make_corpus, serve_corpus
+
+
+def test_default_broker_config() -> None:
+    """The broker config has its own sockets and a worker"""
+    parsed = tomlkit.parse(DEFAULT_BROKER_CONFIG_STR).unwrap()
+    assert "pub_sockets" in parsed["zmq"]
+    assert "rep_sockets" in parsed["zmq"]
+    assert parsed["broker"]["heartbeat_timeout_s"] > 0
+    assert "request_timeout_s" in parsed["broker"]
+    assert "max_priority" in parsed["broker"]
+    assert set(parsed["broker"]["workers"][0]) == {"rep", "pub"}
+
+
+def test_split_by_load() -> None:
+    """The least loaded workers get the most, the shares add up"""
+    assert split_by_load([0, 0], 10) == [5, 5]
+    assert split_by_load([5, 0], 10) == [2, 8]
+    assert split_by_load([100, 0, 0], 10) == [0, 5, 5]
+    assert split_by_load([0, 0, 0], 10) == [4, 3, 3]
+    assert split_by_load([3, 1], 0) == [0, 0]
+    assert not split_by_load([], 5)
+
+
+def write_worker_config(tmpdir: Path, name: str) -> Path:
+    """Service config with a small model with random weights and sockets in tmpdir"""
+    config: dict[str, Any] = tomlkit.parse(DEFAULT_CONFIG_STR).unwrap()
+    config["zmq"] = {
+        "pub_sockets": [f"ipc://{tmpdir}/{name}_pub.sock"],
+        "rep_sockets": [f"ipc://{tmpdir}/{name}_rep.sock"],
+    }
+    config["model"].update(
+        {"name": "fasterrcnn_mobilenet_v3_large_320_fpn", "pretrained": False, "cache_dir": "", "warmup_runs": 0}
+    )
+    config["cache"].update({"max_entries": 0, "path": ""})
+    path = tmpdir / f"{name}.toml"
+    path.write_text(tomlkit.dumps(config), encoding="utf-8")
+    return path
+
+
+def write_broker_config(tmpdir: Path, names: list[str]) -> tuple[Path, dict[str, Any]]:
+    """Broker config for the workers written by write_worker_config"""
+    config: dict[str, Any] = tomlkit.parse(DEFAULT_BROKER_CONFIG_STR).unwrap()
+    config["zmq"] = {
+        "pub_sockets": [f"ipc://{tmpdir}/broker_pub.sock"],
+        "rep_sockets": [f"ipc://{tmpdir}/broker_rep.sock"],
+    }
+    config["broker"].update(
+        {
+            "heartbeat_timeout_s": 1.5,
+            "workers": [
+                {"rep": f"ipc://{tmpdir}/{name}_rep.sock", "pub": f"ipc://{tmpdir}/{name}_pub.sock"} for name in names
+            ],
+        }
+    )
+    path = tmpdir / "broker.toml"
+    path.write_text(tomlkit.dumps(config), encoding="utf-8")
+    return path, config
+
+
+async def wait_until(condition: Callable[[], bool], timeout: float) -> None:
+    """Poll the condition, fail on timeout"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.1)
+
+
+@dataclass
+class Cluster:  # pylint: disable=R0902
+    """A broker running in the test with two worker processes and a local image server"""
+
+    broker: ImageBroker
+    requester: REQMixin
+    rep_socket: str
+    base_url: str
+    workers: dict[str, Process]
+    results: dict[str, list[dict[str, Any]]] = field(default_factory=dict)
+    markers: dict[str, dict[str, Any]] = field(default_factory=dict)
+
+    async def predict(self, urls: list[str], job_id: str) -> dict[str, Any]:
+        """Send predict to the broker, return the reply"""
+        reply = await self.requester.send_command(self.rep_socket, "predict", urls, job_id=job_id, timeout=30.0)
+        return cast(dict[str, Any], reply.data["response"])
+
+
+@pytest_asyncio.fixture
+async def cluster(nice_tmpdir: str) -> AsyncGenerator[Cluster, None]:
+    """Start the workers and the broker, subscribe to the results of the broker once the workers are ready"""
+    tmpdir = Path(nice_tmpdir)
+    server, base_url = await serve_corpus(make_corpus([(640, 480)], ["jpeg", "png"]))
+    workers = {}
+    for name in ("worker1", "worker2"):
+        workers[name] = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "ml_trial_task.console", "service", str(write_worker_config(tmpdir, name))
+        )
+    configpath, config = write_broker_config(tmpdir, list(workers))
+    broker = ImageBroker(configpath)
+    broker_task = asyncio.create_task(broker.run())
+    requester = REQMixin(configpath)
+    requester.config = config
+    running = Cluster(broker, requester, config["zmq"]["rep_sockets"][0], base_url, workers)
+
+    async def on_result(sub: Subscription, msg: PubSubMessage) -> None:  # pylint: disable=W0613
+        data = cast(PubSubDataMessage, msg).data
+        if data.get("complete"):
+            running.markers[data["job_id"]] = data
+        else:
+            running.results.setdefault(data["job_id"], []).append(data)
+
+    try:
+        # Models load in the worker processes
+        await wait_until(lambda: len(broker.live_workers()) == 2, 180.0)
+        PubSubManager(SocketHandler).subscribe_async(
+            Subscription(config["zmq"]["pub_sockets"][0], "results", on_result, decoder_class=PubSubDataMessage)
+        )
+        await asyncio.sleep(0.5)
+        yield running
+    finally:
+        broker.quit()
+        await asyncio.wait_for(broker_task, timeout=10.0)
+        # Clear alarms and default exception handlers
+        ImageBroker.clear_exit_alarm()
+        asyncio.get_event_loop().set_exception_handler(None)
+        for process in workers.values():
+            if process.returncode is None:
+                process.send_signal(signal.SIGTERM)
+            await process.wait()
+        await server.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_broker_shards(cluster: Cluster) -> None:
+    """A list is split over the workers, the results and the completion marker come from the broker"""
+    urls = [f"{cluster.base_url}/img640x480.{fmt}?i={idx}" for idx in range(4) for fmt in ("jpeg", "png")]
+    reply = await cluster.predict(urls, "first")
+    assert reply["num_images"] == 8
+    assert reply["num_workers"] == 2
+    await wait_until(lambda: "first" in cluster.markers, 120.0)
+    assert sorted(result["url"] for result in cluster.results["first"]) == sorted(urls)
+    assert all("error" not in result for result in cluster.results["first"])
+    assert cluster.markers["first"]["num_results"] == 8
+    assert all(worker.completed for worker in cluster.broker.workers.values())
+
+
+@pytest.mark.asyncio
+async def test_broker_resends_images_of_dead_worker(cluster: Cluster) -> None:
+    """The images a worker had not finished when its heartbeats stopped are done by the other one"""
+    urls = [f"{cluster.base_url}/img640x480.jpeg?j={idx}" for idx in range(16)]
+    reply = await cluster.predict(urls, "second")
+    assert reply["num_images"] == 16
+    # Kill the worker with the most unfinished images right after it got them
+    victim = max(cluster.broker.workers.values(), key=lambda worker: worker.assigned)
+    assert victim.assigned
+    cluster.workers["worker1" if "worker1" in victim.rep else "worker2"].send_signal(signal.SIGKILL)
+    await wait_until(lambda: "second" in cluster.markers, 120.0)
+    assert sorted(result["url"] for result in cluster.results["second"]) == sorted(urls)
+    assert cluster.markers["second"]["num_results"] == 16
+    stats = await cluster.broker.stats()
+    assert stats["reassigned"] > 0
+    assert stats["jobs"] == {"active": 0, "completed": 1}
+    assert [worker["alive"] for worker in stats["workers"]].count(True) == 1
+
+
+@pytest.mark.asyncio
+async def test_broker_drops_late_results(nice_tmpdir: str) -> None:
+    """Results from a worker the images were taken away from, and duplicates, are not republished"""
+    # pylint: disable=W0212
+    configpath, _ = write_broker_config(Path(nice_tmpdir), ["worker1", "worker2"])
+    broker = ImageBroker(configpath)
+    first, second = WorkerState("rep1", "pub1"), WorkerState("rep2", "pub2")
+    broker.workers = {"rep1": first, "rep2": second}
+    published: list[PubSubDataMessage] = []
+
+    async def record(msg: PubSubMessage, *args: Any) -> None:  # pylint: disable=W0613
+        published.append(cast(PubSubDataMessage, msg))
+
+    broker.psmgr.publish_async = record  # type: ignore[method-assign,assignment]
+    job = Job("client", expected=2)
+    broker.jobs[job.job_id] = job
+    entries: list[tuple[str, Optional[bytes]]] = [("a.jpg", None), ("b.jpg", None)]
+    broker.assignments["s-0"] = Assignment("s-0", job, first, entries)
+    first.assigned = 2
+
+    # The first worker missed its heartbeats, its images wait for another worker
+    broker._orphan(first)
+    assert broker.unassigned == deque([(job, entries)])
+    assert broker.reassigned == 2
+    broker.assignments["s-1"] = Assignment("s-1", job, second, entries)
+
+    async def result(worker: WorkerState, job_id: str, url: str) -> None:
+        sub = Subscription(worker.pub, "results", broker._on_message, metadata={"rep": worker.rep})
+        message = PubSubDataMessage(topic=f"results/{job_id}/", data={"job_id": job_id, "url": url, "labels": []})
+        await broker._on_message(sub, message)
+
+    await result(first, "s-0", "a.jpg")
+    assert not published
+    await result(second, "s-1", "a.jpg")
+    await result(second, "s-1", "a.jpg")
+    assert [msg.data["url"] for msg in published] == ["a.jpg"]
+    assert published[0].data["job_id"] == "client"
+    await result(second, "s-1", "b.jpg")
+    assert published[-1].data["complete"]
+    assert published[-1].data["num_results"] == 2
+    assert not broker.jobs
+    assert not broker.assignments
@@ -0,0 +1,52 @@
+"""Test the memory budget"""
+
+import asyncio
+
+import pytest
+
+from ml_trial_task.budget import MemoryBudget
+
+
+@pytest.mark.asyncio
+async def test_reservations_wait_in_order() -> None:
+    """Reservations over the limit wait, and are granted in arrival order as memory is released"""
+    budget = MemoryBudget(100)
+    assert await budget.reserve(60) == 60
+    granted: list[int] = []
+
+    async def reserve(nbytes: int) -> None:
+        granted.append(await budget.reserve(nbytes))
+
+    tasks = [asyncio.create_task(reserve(50)), asyncio.create_task(reserve(10))]
+    await asyncio.sleep(0.01)
+    # The small one fits but does not overtake
+    assert not granted
+    assert budget.stats()["waiting"] == 2
+    budget.release(60)
+    await asyncio.gather(*tasks)
+    assert granted == [50, 10]
+    assert budget.stats() == {
+        "limit_bytes": 100,
+        "in_use_bytes": 60,
+        "peak_bytes": 60,
+        "utilization": 0.6,
+        "waiting": 0,
+        "waited": 2,
+    }
+
+
+@pytest.mark.asyncio
+async def test_oversized_and_cancelled() -> None:
+    """A reservation larger than the budget is cut to it, a cancelled waiter lets the next one through"""
+    budget = MemoryBudget(100)
+    assert await budget.reserve(500) == 100
+    waiting = asyncio.create_task(budget.reserve(80))
+    nxt = asyncio.create_task(budget.reserve(20))
+    await asyncio.sleep(0.01)
+    waiting.cancel()
+    budget.release(20)
+    assert await asyncio.wait_for(nxt, 1.0) == 20
+    assert budget.in_use == 100
+    # Unlimited only counts
+    unlimited = MemoryBudget()
+    assert await unlimited.reserve(10**12) == 10**12
@@ -0,0 +1,76 @@
+"""Test the detection result cache"""
+
+from pathlib import Path
+
+import pytest
+
+from ml_trial_task.cache import ResultCache
+
+RESULT = {"boxes": [[1, 2, 3, 4]], "labels": ["cat"], "scores": [0.9]}
+
+
+def test_key_depends_on_bytes_model_and_threshold() -> None:
+    """Changing any input of the key changes the key"""
+    key = ResultCache.make_key(b"image", "model-a", 0.8)
+    assert key == ResultCache.make_key(b"image", "model-a", 0.8)
+    assert key != ResultCache.make_key(b"other", "model-a", 0.8)
+    assert key != ResultCache.make_key(b"image", "model-b", 0.8)
+    assert key != ResultCache.make_key(b"image", "model-a", 0.5)
+
+
+@pytest.mark.asyncio
+async def test_memory_lru_eviction() -> None:
+    """Least recently used entries go first and counters track lookups"""
+    cache = ResultCache(max_entries=2)
+    await cache.put("a", RESULT)
+    await cache.put("b", RESULT)
+    assert await cache.get("a") == RESULT
+    await cache.put("c", RESULT)
+    assert await cache.get("b") is None
+    assert await cache.get("a") == RESULT
+    assert await cache.get("c") == RESULT
+    stats = cache.stats()
+    assert stats["hits"] == 3
+    assert stats["misses"] == 1
+    assert stats["entries"] == 2
+
+
+@pytest.mark.asyncio
+async def test_disk_tier_survives_restart(tmp_path: Path) -> None:
+    """Results written to the sqlite tier are found by a new instance"""
+    path = tmp_path / "cache" / "results.sqlite"
+    cache = ResultCache(max_entries=10, path=path)
+    await cache.put("a", RESULT)
+    cache.close()
+
+    reopened = ResultCache.from_config({"max_entries": 10, "path": str(path)})
+    assert reopened.stats()["disk_entries"] == 1
+    assert await reopened.get("a") == RESULT
+    assert reopened.disk_hits == 1
+    # Second lookup is served from memory
+    assert await reopened.get("a") == RESULT
+    assert reopened.disk_hits == 1
+    reopened.close()
+
+
+@pytest.mark.asyncio
+async def test_disk_tier_is_bounded(tmp_path: Path) -> None:
+    """The disk tier trims the oldest entries when over its bound"""
+    cache = ResultCache(max_entries=1, path=tmp_path / "results.sqlite", max_disk_entries=10)
+    for idx in range(25):
+        await cache.put(str(idx), RESULT)
+    assert cache.stats()["disk_entries"] <= 10
+    assert await cache.get("24") == RESULT
+    assert await cache.get("0") is None
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_disk_tier_counts_replaced_keys_once(tmp_path: Path) -> None:
+    """Storing a key again replaces its row without growing the count"""
+    cache = ResultCache(max_entries=1, path=tmp_path / "results.sqlite", max_disk_entries=10)
+    for _ in range(3):
+        await cache.put("a", RESULT)
+    await cache.put("b", RESULT)
+    assert cache.stats()["disk_entries"] == 2
+    cache.close()
@@ -1,8 +1,10 @@
 """Test CLI scripts"""
 
 import asyncio
+import json
 from pathlib import Path
-from typing import AnyStr
+from types import SimpleNamespace
+from typing import Any, AnyStr
 
 import pytest
 from _pytest.monkeypatch import MonkeyPatch
@@ -45,13 +47,53 @@ def test_run_predict_no_urls(config_file: str) -> None:  # pylint: disable=W0621
 def test_run_service_success(monkeypatch: MonkeyPatch, config_file: str) -> None:  # pylint: disable=W0621
     """Test the service command by monkeypatching ImagePredictionService to return 0."""
     # Replace ImagePredictionService with a dummy that returns exit code 0
-    monkeypatch.setattr("ml_trial_task.console.ImagePredictionService", lambda cfg: DummyService())
+    monkeypatch.setattr("ml_trial_task.service.ImagePredictionService", lambda cfg: DummyService())
     runner = CliRunner()
     result = runner.invoke(cli, ["service", config_file], catch_exceptions=False)
     # The CLI command should exit with code 0.
     assert result.exit_code == 0
 
 
+def test_run_broker(monkeypatch: MonkeyPatch, config_file: str) -> None:  # pylint: disable=W0621
+    """The broker command runs the broker, --defaultconfig shows its own config"""
+    monkeypatch.setattr("ml_trial_task.broker.ImageBroker", lambda cfg: DummyService())
+    runner = CliRunner()
+    result = runner.invoke(cli, ["broker", config_file], catch_exceptions=False)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ["broker", "--defaultconfig"])
+    assert "[[broker.workers]]" in result.output
+
+
+def test_run_profile(monkeypatch: MonkeyPatch, config_file: str, tmp_path: Path) -> None:  # pylint: disable=W0621
+    """The profile command waits for the summary of the service and shows it"""
+    summary = {
+        "status": "done",
+        "mode": "sample",
+        "seconds": 2.0,
+        "functions": [{"function": "decode (decoding.py:10)", "own": 0.5, "total": 0.75}],
+        "torch": {"forward_passes": 3, "operators": [{"operator": "aten::conv2d", "calls": 9, "own_ms": 12.5}]},
+    }
+    sent: list[tuple[Any, ...]] = []
+
+    async def send_command(_: Any, *args: Any, **kwargs: Any) -> Any:
+        sent.append((args, kwargs))
+        return SimpleNamespace(data={"response": summary})
+
+    monkeypatch.setattr("ml_trial_task.console.REQMixin.send_command", send_command)
+    output = tmp_path / "profile.json"
+    runner = CliRunner()
+    result = runner.invoke(cli, ["profile", "-s", "2", "--torch-ops", "-o", str(output), config_file])
+    # asyncio.run in the command leaves no current event loop for the next tests
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    assert result.exit_code == 0, result.output
+    assert sent[0][0][1:] == ("profile", 2.0)
+    assert sent[0][1]["torch_ops"] is True
+    assert sent[0][1]["wait"] is True
+    assert "50.0%" in result.output
+    assert "aten::conv2d" in result.output
+    assert json.loads(output.read_text(encoding="utf-8")) == summary
+
+
 @pytest.mark.asyncio
 async def test_run_predict_with_urls(tmp_path: Path) -> None:
     """Test the predict command when providing URLs."""
@@ -66,6 +108,21 @@ async def test_run_predict_with_urls(tmp_path: Path) -> None:
     assert "URLs provided" in result.output
 
 
+def test_run_benchmark_imports(tmp_path: Path) -> None:
+    """The import benchmark reports the given commands, unknown ones are refused"""
+    output = tmp_path / "imports.json"
+    runner = CliRunner()
+    result = runner.invoke(cli, ["benchmark", "imports", "-n", "1", "-o", str(output), "predict"])
+    assert result.exit_code == 0, result.output
+    assert "heavy: -" in result.output
+    report = json.loads(output.read_text(encoding="utf-8"))
+    assert [row["command"] for row in report] == ["predict"]
+    assert report[0]["import_ms"] > 0
+    result = runner.invoke(cli, ["benchmark", "imports", "nosuch"])
+    assert result.exit_code != 0
+    assert "unknown commands nosuch" in result.output
+
+
 def test_default_config_func(capsys: pytest.CaptureFixture[AnyStr]) -> None:
     """Make sure the default config is/is not dumped"""
     dump_default_config(None, None, True)
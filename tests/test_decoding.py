@@ -0,0 +1,90 @@
+"""Test reduced resolution decoding"""
+
+import io
+import mmap
+from pathlib import Path
+
+import pytest
+import torch
+from PIL import Image
+from torchvision.models.detection.transform import GeneralizedRCNNTransform
+
+from ml_trial_task.decoding import DecodeError, Decoder
+
+
+def encode(width: int, height: int, fmt: str) -> bytes:
+    """Image of the given size as file bytes"""
+    buf = io.BytesIO()
+    Image.new("RGB", (width, height), color=(200, 100, 50)).save(buf, format=fmt)
+    return buf.getvalue()
+
+
+def test_jpeg_decoded_at_reduced_scale() -> None:
+    """Large JPEGs decode to at least the model size but not twice that"""
+    decoder = Decoder(min_size=200, max_size=400)
+    assert decoder.target_size(4000, 2000) == (400, 200)
+    decoded = decoder.decode(encode(4000, 2000, "JPEG"))
+    assert decoded.tensor.dtype == torch.uint8
+    height, width = decoded.tensor.shape[1:]
+    assert 400 <= width < 800
+    assert 200 <= height < 400
+    assert decoded.scale == (4000 / width, 2000 / height)
+    assert (decoded.width, decoded.height) == (4000, 2000)
+
+
+def test_png_reduced_after_decoding() -> None:
+    """Formats without draft support get reduced by a whole factor"""
+    decoded = Decoder(min_size=100, max_size=200).decode(encode(1000, 500, "PNG"))
+    assert decoded.tensor.shape == (3, 100, 200)
+    assert decoded.scale == (5.0, 5.0)
+
+
+def test_small_image_untouched() -> None:
+    """Images smaller than the model size are not scaled"""
+    decoded = Decoder().decode(encode(64, 32, "PNG"))
+    assert decoded.tensor.shape == (3, 32, 64)
+    assert decoded.scale == (1.0, 1.0)
+    assert decoded.tensor[:, 0, 0].tolist() == [200, 100, 50]
+
+
+def test_max_pixels() -> None:
+    """Images over the pixel cap are rejected, 0 disables the cap"""
+    data = encode(300, 200, "JPEG")
+    with pytest.raises(DecodeError):
+        Decoder(max_pixels=300 * 200 - 1).decode(data)
+    assert Decoder(max_pixels=0).decode(data).width == 300
+
+
+def test_for_model() -> None:
+    """Sizes are taken from the model resize transform"""
+    model = torch.nn.Module()
+    model.transform = GeneralizedRCNNTransform(320, 640, [0.5] * 3, [0.5] * 3)
+    assert Decoder.for_model(model, {"max_pixels": 10}) == Decoder(min_size=320, max_size=640, max_pixels=10)
+    model.transform = GeneralizedRCNNTransform(300, 300, [0.5] * 3, [0.5] * 3, fixed_size=(300, 300))
+    decoder = Decoder.for_model(model, {})
+    assert decoder.target_size(1000, 10) == (300, 300)
+
+
+def test_decode_memory_map(tmp_path: Path) -> None:
+    """A mapped file decodes like its bytes"""
+    path = tmp_path / "image.png"
+    path.write_bytes(encode(300, 200, "PNG"))
+    with open(path, "rb") as fpntr:
+        mapped = mmap.mmap(fpntr.fileno(), 0, access=mmap.ACCESS_READ)
+    decoder = Decoder(min_size=100, max_size=200)
+    assert torch.equal(decoder.decode(mapped).tensor, decoder.decode(path.read_bytes()).tensor)
+    # Decoding again starts from the beginning
+    assert decoder.decode(mapped).width == 300
+    mapped.close()
+
+
+def test_footprint() -> None:
+    """The estimate follows the reduced decode size, not the file size"""
+    decoder = Decoder(min_size=200, max_size=400)
+    jpeg = encode(4000, 2000, "JPEG")
+    # Decoded at 1/8 scale, 500x250 is still at least 400x200
+    assert decoder.footprint(jpeg) == len(jpeg) + 500 * 250 * 3 + 500 * 250 * 15
+    png = encode(1000, 500, "PNG")
+    assert decoder.footprint(png) == len(png) + 1000 * 500 * 3 + 500 * 250 * 15
+    with pytest.raises(DecodeError):
+        Decoder(max_pixels=10).footprint(png)
@@ -0,0 +1,49 @@
+"""Test the inference threads"""
+
+import os
+import threading
+
+import pytest
+import torch
+
+from ml_trial_task.executor import ExecutorConfig, InferenceExecutor, available_cpus, cpu_sets
+
+
+def test_cpu_sets() -> None:
+    """CPUs are split evenly, extra workers share"""
+    assert cpu_sets(2, [0, 1, 2, 3, 4]) == [[0, 1, 2], [3, 4]]
+    assert cpu_sets(1, [4, 5]) == [[4, 5]]
+    assert cpu_sets(3, [0, 1]) == [[0], [1], [0]]
+
+
+def test_executor_config() -> None:
+    """Config parsing, validation and the automatic thread share"""
+    config = ExecutorConfig.from_config({"workers": 2, "intra_op_threads": 3, "pin_cpus": True})
+    assert (config.workers, config.threads_per_worker, config.pin_cpus) == (2, 3, True)
+    assert config.label == "2x3 pinned"
+    assert ExecutorConfig(workers=1).threads_per_worker == len(available_cpus())
+    with pytest.raises(ValueError):
+        ExecutorConfig(workers=0)
+    with pytest.raises(ValueError):
+        ExecutorConfig(intra_op_threads=-1)
+
+
+@pytest.mark.asyncio
+async def test_inference_executor_threads() -> None:
+    """Work runs in the dedicated threads with the configured torch threads and pinning"""
+    executor = InferenceExecutor(ExecutorConfig(workers=1, intra_op_threads=1, pin_cpus=True))
+
+    def probe() -> tuple[str, int, list[int]]:
+        affinity = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        return threading.current_thread().name, torch.get_num_threads(), affinity
+
+    try:
+        name, threads, affinity = await executor.run(probe)
+        assert name.startswith("inference")
+        assert threads == 1
+        if hasattr(os, "sched_setaffinity"):
+            assert affinity == cpu_sets(1)[0]
+        assert executor.stats()["running"]
+    finally:
+        executor.shutdown()
+    assert not executor.stats()["running"]
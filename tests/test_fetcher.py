@@ -0,0 +1,300 @@
+"""Test the shared image fetcher against a local HTTP server"""
+
+import asyncio
+import mmap
+import time
+from collections import Counter
+from pathlib import Path
+from typing import AsyncGenerator, Mapping
+
+import pytest
+import pytest_asyncio
+from aiohttp import web
+
+from ml_trial_task.fetcher import (
+    CircuitBreaker,
+    FetchError,
+    ImageFetcher,
+    is_local,
+    local_path,
+    map_file,
+    normalize_url,
+)
+
+# pylint: disable=W0621
+
+
+@pytest_asyncio.fixture
+async def image_server() -> AsyncGenerator[str, None]:
+    """Serve a fixed payload on /image and 404 for anything else, yield the base URL"""
+
+    async def image(request: web.Request) -> web.Response:
+        _ = request
+        return web.Response(body=b"not really a jpeg", content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_get("/image", image)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    yield f"http://127.0.0.1:{port}"
+    await runner.cleanup()
+
+
+@pytest_asyncio.fixture
+async def faulty_server() -> AsyncGenerator[tuple[str, Counter[str]], None]:
+    """Serve /flaky/<n> (503 for the first n requests), /slow/<ms> (the first request waits ms), /down (500) and
+    /gone (404), yield the base URL and the requests seen per path"""
+    hits: Counter[str] = Counter()
+
+    async def handle(request: web.Request) -> web.Response:
+        hits[request.path] += 1
+        kind, _, arg = request.path.strip("/").partition("/")
+        if kind == "flaky" and hits[request.path] <= int(arg):
+            return web.Response(status=503)
+        if kind == "slow" and hits[request.path] == 1:
+            await asyncio.sleep(int(arg) / 1000.0)
+        if kind == "down":
+            return web.Response(status=500)
+        if kind == "gone":
+            return web.Response(status=404)
+        return web.Response(body=b"image", content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    yield f"http://127.0.0.1:{runner.addresses[0][1]}", hits
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_retries_and_timeouts(faulty_server: tuple[str, Counter[str]]) -> None:
+    """5xx and timeouts are retried up to retries times, other errors are not"""
+    base_url, hits = faulty_server
+    fetcher = ImageFetcher(retries=2, backoff_base=0.01, total_timeout=0.3)
+    try:
+        assert await fetcher.fetch(f"{base_url}/flaky/2") == b"image"
+        assert hits["/flaky/2"] == 3
+        with pytest.raises(FetchError, match="after 3 attempts"):
+            await fetcher.fetch(f"{base_url}/flaky/5")
+        # The second attempt does not wait
+        assert await fetcher.fetch(f"{base_url}/slow/2000") == b"image"
+        # Not worth another try
+        with pytest.raises(FetchError, match="404"):
+            await fetcher.fetch(f"{base_url}/gone")
+        assert hits["/gone"] == 1
+        stats = fetcher.stats()
+        assert stats["fetches"] == 4
+        assert stats["retries"] == 5
+        assert stats["timeouts"] == 1
+        assert stats["failed"] == 2
+    finally:
+        await fetcher.close()
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker(faulty_server: tuple[str, Counter[str]]) -> None:
+    """A failing host fails fast once the breaker opens, a trial request is let through after the reset time"""
+    base_url, hits = faulty_server
+    fetcher = ImageFetcher(retries=0, breaker_failures=2, breaker_reset_s=0.2)
+    try:
+        for _ in range(2):
+            with pytest.raises(FetchError, match="500"):
+                await fetcher.fetch(f"{base_url}/down")
+        with pytest.raises(FetchError, match="Circuit open"):
+            await fetcher.fetch(f"{base_url}/flaky/0")
+        assert hits["/flaky/0"] == 0
+        assert fetcher.stats()["breakers"]["127.0.0.1:" + base_url.rsplit(":", 1)[1]]["state"] == "open"
+        await asyncio.sleep(0.25)
+        # Half open, the trial succeeds and closes the breaker
+        assert await fetcher.fetch(f"{base_url}/flaky/0") == b"image"
+        assert not fetcher.stats()["breakers"]
+        assert fetcher.stats()["circuit_opened"] == 1
+        assert fetcher.stats()["circuit_rejected"] == 1
+    finally:
+        await fetcher.close()
+
+
+def test_circuit_breaker_trial_failure() -> None:
+    """A failed trial keeps the breaker open for another period"""
+    breaker = CircuitBreaker(failure_threshold=1, reset_s=0.0)
+    assert breaker.failure()
+    assert breaker.allow()
+    assert not breaker.failure()
+    assert breaker.opened_at is not None
+    breaker.success()
+    assert breaker.state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_hedged_requests(faulty_server: tuple[str, Counter[str]]) -> None:
+    """A slow request gets a second one after the hedge delay, the faster one wins"""
+    base_url, hits = faulty_server
+    fetcher = ImageFetcher(hedge=True, hedge_min_delay=0.05)
+    try:
+        started = time.monotonic()
+        assert await fetcher.fetch(f"{base_url}/slow/3000") == b"image"
+        assert time.monotonic() - started < 2.0
+        assert hits["/slow/3000"] == 2
+        # Fast ones finish before the delay
+        assert await fetcher.fetch(f"{base_url}/flaky/0") == b"image"
+        assert hits["/flaky/0"] == 1
+        stats = fetcher.stats()
+        assert stats["hedged"] == 1
+        assert stats["hedge_wins"] == 1
+        assert stats["hedge_delay_s"] == 0.05
+    finally:
+        await fetcher.close()
+
+
+@pytest.mark.asyncio
+async def test_hedged_requests_both_fail(monkeypatch: pytest.MonkeyPatch) -> None:
+    """If the hedge fails first and then the original too, the error of the original is raised"""
+    fetcher = ImageFetcher(hedge=True, hedge_min_delay=0.05)
+    calls = 0
+
+    async def failing_get(url: str, headers: Mapping[str, str]) -> None:
+        nonlocal calls
+        _ = url, headers
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(0.2)
+            raise FetchError("original failed")
+        raise FetchError("hedge failed")
+
+    monkeypatch.setattr(fetcher, "_get", failing_get)
+    with pytest.raises(FetchError, match="original failed"):
+        await fetcher._hedged("http://example.com/a.jpg", {})  # pylint: disable=W0212
+    assert calls == 2
+
+
+@pytest.mark.asyncio
+async def test_close_when_idle(faulty_server: tuple[str, Counter[str]]) -> None:
+    """A replaced fetcher finishes the fetches in progress before closing, then refuses new ones"""
+    base_url, _ = faulty_server
+    fetcher = ImageFetcher()
+    fetch = asyncio.create_task(fetcher.fetch(f"{base_url}/slow/300"))
+    await asyncio.sleep(0.05)
+    closing = asyncio.create_task(fetcher.close_when_idle())
+    await asyncio.sleep(0.05)
+    with pytest.raises(FetchError, match="closed"):
+        await fetcher.fetch(f"{base_url}/flaky/0")
+    assert not closing.done()
+    assert await fetch == b"image"
+    await asyncio.wait_for(closing, timeout=1.0)
+    # Not opened again behind our back
+    with pytest.raises(FetchError, match="closed"):
+        _ = fetcher.session
+
+
+@pytest.mark.asyncio
+async def test_fetch_reuses_session(image_server: str) -> None:
+    """Consecutive fetches go through the same long-lived session"""
+    fetcher = ImageFetcher(limit_per_host=2)
+    try:
+        assert await fetcher.fetch(f"{image_server}/image") == b"not really a jpeg"
+        session = fetcher.session
+        assert await fetcher.fetch(f"{image_server}/image") == b"not really a jpeg"
+        assert fetcher.session is session
+    finally:
+        await fetcher.close()
+    assert session.closed
+
+
+@pytest.mark.asyncio
+async def test_fetch_http_error(image_server: str) -> None:
+    """Non-200 responses raise FetchError"""
+    fetcher = ImageFetcher()
+    try:
+        with pytest.raises(FetchError, match="404"):
+            await fetcher.fetch(f"{image_server}/missing")
+    finally:
+        await fetcher.close()
+
+
+@pytest.mark.asyncio
+async def test_body_cache_revalidation(tmp_path: Path) -> None:
+    """A cached body is revalidated, on 304 the local copy is used and a changed body replaces it"""
+    version = {"etag": '"v1"', "body": b"first"}
+    seen: list[str] = []
+
+    async def image(request: web.Request) -> web.Response:
+        seen.append(request.headers.get("If-None-Match", ""))
+        if request.headers.get("If-None-Match") == version["etag"]:
+            return web.Response(status=304, headers={"ETag": str(version["etag"])})
+        return web.Response(body=version["body"], headers={"ETag": str(version["etag"])}, content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_get("/image", image)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{runner.addresses[0][1]}/image"
+    fetcher = ImageFetcher(body_cache_dir=str(tmp_path))
+    try:
+        assert await fetcher.fetch(url) == b"first"
+        cached = await fetcher.fetch(url)
+        assert isinstance(cached, mmap.mmap)
+        assert cached[:] == b"first"
+        version.update({"etag": '"v2"', "body": b"second"})
+        assert await fetcher.fetch(url) == b"second"
+        assert (await fetcher.fetch(url))[:] == b"second"
+        assert seen == ["", '"v1"', '"v1"', '"v2"']
+        stats = fetcher.stats()
+        assert stats["not_modified"] == 2
+        assert stats["body_cache"]["stored"] == 2
+        assert stats["body_cache"]["bytes"] == len(b"second")
+    finally:
+        await fetcher.close()
+        await runner.cleanup()
+    # Kept across restarts
+    fetcher = ImageFetcher(body_cache_dir=str(tmp_path))
+    assert fetcher.body_cache is not None
+    assert fetcher.body_cache.total_bytes == len(b"second")
+    await fetcher.close()
+
+
+def test_from_config() -> None:
+    """Config values override the defaults and equal settings compare equal"""
+    fetcher = ImageFetcher.from_config({"limit": 10, "limit_per_host": 2, "read_timeout": 5})
+    assert fetcher.limit == 10
+    assert fetcher.limit_per_host == 2
+    assert fetcher.read_timeout == 5.0
+    assert fetcher.dns_cache_ttl == ImageFetcher.dns_cache_ttl
+    assert fetcher == ImageFetcher.from_config({"limit": 10, "limit_per_host": 2, "read_timeout": 5.0})
+
+
+def test_normalize_url() -> None:
+    """Spellings of the same URL normalize the same, different resources do not"""
+    assert normalize_url(" HTTP://Example.COM:80/a.jpg#frag ") == "http://example.com/a.jpg"
+    assert normalize_url("https://example.com:443") == "https://example.com/"
+    assert normalize_url("http://user@Example.com:8080/a.jpg?x=1") == "http://user@example.com:8080/a.jpg?x=1"
+    assert normalize_url("http://example.com/A.jpg") != normalize_url("http://example.com/a.jpg")
+    assert normalize_url("http://[::1]:81/a") == "http://[::1]:81/a"
+    assert normalize_url("http://example.com:bad/") == "http://example.com:bad/"
+
+
+def test_local_files(tmp_path: Path) -> None:
+    """file:// URLs are mapped only from under the allowed roots"""
+    root = tmp_path / "images"
+    root.mkdir()
+    (root / "a b.jpg").write_bytes(b"jpeg bytes")
+    (tmp_path / "secret").write_bytes(b"no")
+    assert is_local("FILE:///x") and not is_local("http://example.com/file.jpg")
+    path = local_path(f"file://{root}/a%20b.jpg", [root])
+    assert path == (root / "a b.jpg").resolve()
+    mapped = map_file(path)
+    assert mapped[:] == b"jpeg bytes"
+    mapped.close()
+    with pytest.raises(FetchError):
+        local_path(f"file://{root}/../secret", [root])
+    with pytest.raises(FetchError):
+        local_path(f"file://{root}/a%20b.jpg", [])
+    with pytest.raises(FetchError):
+        local_path(f"file://otherhost{root}/a%20b.jpg", [root])
@@ -0,0 +1,51 @@
+"""Test the import cost of the CLI commands"""
+
+import click
+
+from ml_trial_task.console import cli
+from ml_trial_task.importtime import CLIENT_COMMANDS, COMMAND_MODULES, ImportTimes, measure_command
+
+SAMPLE = """import time: self [us] | cumulative | imported package
+import time:       120 |        120 |     _io
+import time:       300 |        420 |   numpy
+import time:      1000 |       1420 | ml_trial_task.wire
+import time:        50 |         50 | json
+"""
+
+
+def command_names(group: click.Group, prefix: str = "") -> list[str]:
+    """Names of the commands under the group, subgroups spelled out"""
+    names = []
+    for name, command in group.commands.items():
+        if isinstance(command, click.Group):
+            names.extend(command_names(command, f"{prefix}{name} "))
+        else:
+            names.append(f"{prefix}{name}")
+    return names
+
+
+def test_parse() -> None:
+    """Own and cumulative times of each module, the top level ones in order"""
+    times = ImportTimes.parse("predict", SAMPLE)
+    assert times.own_us["numpy"] == 300
+    assert times.cumulative_us["ml_trial_task.wire"] == 1420
+    assert times.top_level == ["ml_trial_task.wire", "json"]
+    assert times.total_ms == 1.47
+    assert times.heavy == ["numpy"]
+    stats = times.stats(top=1)
+    assert stats["modules"] == 4
+    assert stats["slowest_ms"] == {"ml_trial_task.wire": 1.42}
+
+
+def test_every_command_is_measured() -> None:
+    """The benchmark knows the imports of each CLI command"""
+    assert sorted(command_names(cli)) == sorted(COMMAND_MODULES)
+    assert set(CLIENT_COMMANDS) <= set(COMMAND_MODULES)
+
+
+def test_client_commands_stay_light() -> None:
+    """The commands that only talk to the service do not import torch, torchvision, aiohttp or numpy"""
+    for command in CLIENT_COMMANDS:
+        times = measure_command(command, runs=1)
+        assert "ml_trial_task.console" in times.own_us
+        assert not times.heavy, command
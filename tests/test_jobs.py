@@ -0,0 +1,59 @@
+"""Test job bookkeeping"""
+
+import pytest
+
+from ml_trial_task.jobs import Job
+
+
+def test_job_counts_and_summary() -> None:
+    """Done when every accepted image has a result, the summary has the counts"""
+    job = Job(expected=3)
+    assert len(job.job_id) == 32
+    assert job.topic == f"results/{job.job_id}/"
+    job.record(failed=False, cached=True, coalesced=False)
+    job.record(failed=True, cached=False, coalesced=False)
+    assert not job.done
+    job.record(failed=False, cached=True, coalesced=True)
+    assert job.done
+    summary = job.summary()
+    assert "url" not in summary
+    assert summary["complete"]
+    assert (summary["num_results"], summary["num_errors"], summary["num_cached"], summary["num_coalesced"]) == (
+        3,
+        1,
+        2,
+        1,
+    )
+
+
+def test_job_id_validation() -> None:
+    """Client supplied IDs must be safe to use in a topic"""
+    assert Job("client-1_A").topic == "results/client-1_A/"
+    for bad in ("", "a/b", "x" * 65, "spa ce"):
+        with pytest.raises(ValueError):
+            Job(bad)
+    assert Job("urgent", priority=5).priority == 5
+    with pytest.raises(ValueError):
+        Job(priority=0)
+    assert Job.for_request(None, 3, max_priority=3).priority == 3
+    for bad_priority in (4, True):
+        with pytest.raises(ValueError, match="from 1 to 3"):
+            Job.for_request("a", bad_priority, max_priority=3)
+    for bad_ttl in (0, -1.0, "5", True):
+        with pytest.raises(ValueError, match="ttl_s"):
+            Job.for_request("a", 1, max_priority=3, ttl_s=bad_ttl)  # type: ignore[arg-type]
+
+
+def test_job_deadline() -> None:
+    """A job with a ttl expires, one without never does, expired results are counted apart from errors"""
+    job = Job.for_request("a", 1, max_priority=3, ttl_s=10)
+    remaining = job.remaining_s()
+    assert remaining is not None and 9 < remaining <= 10
+    assert not job.is_expired()
+    assert job.deadline is not None and job.is_expired(job.deadline)
+    assert Job.for_request("b", 1, max_priority=3).remaining_s() is None
+    assert not Job().is_expired(float("inf"))
+    job.expected = 1
+    job.record(failed=False, cached=False, coalesced=False, expired=True)
+    assert job.done
+    assert (job.summary()["num_expired"], job.summary()["num_errors"]) == (1, 0)
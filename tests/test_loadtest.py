@@ -0,0 +1,50 @@
+"""Test the load test harness"""
+
+import io
+
+import aiohttp
+import pytest
+from PIL import Image
+
+from ml_trial_task.loadtest import LoadTest, LoadTestConfig, make_corpus, serve_corpus
+
+
+def test_make_corpus() -> None:
+    """One image per size and format, deterministic"""
+    corpus = make_corpus([(32, 16), (8, 8)], ["jpeg", "png"])
+    assert sorted(corpus) == ["img32x16.jpeg", "img32x16.png", "img8x8.jpeg", "img8x8.png"]
+    assert Image.open(io.BytesIO(corpus["img32x16.png"])).size == (32, 16)
+    assert make_corpus([(8, 8)], ["png"]) == make_corpus([(8, 8)], ["png"])
+
+
+@pytest.mark.asyncio
+async def test_serve_corpus() -> None:
+    """Images are served by name"""
+    corpus = make_corpus([(8, 8)], ["png"])
+    runner, base_url = await serve_corpus(corpus)
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{base_url}/img8x8.png?r=1") as resp:
+                assert resp.content_type == "image/png"
+                assert await resp.read() == corpus["img8x8.png"]
+            async with session.get(f"{base_url}/nope.png") as resp:
+                assert resp.status == 404
+    finally:
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_load_test_run() -> None:
+    """A short run against the real service reports every image"""
+    config = LoadTestConfig(
+        rate=10.0, list_size=2, requests=2, sizes=[(64, 48)], formats=["jpeg"], probe_interval_s=0.1
+    )
+    report = await LoadTest(config).run()
+    assert report["accepted"] == 4
+    assert report["completed"] == 4
+    assert report["errors"] == 0
+    assert report["latency_ms"]["count"] == 4
+    assert report["predict_rtt_ms"]["count"] == 2
+    assert report["images_per_s"] > 0
+    assert report["peak_rss_mb"] > 0
+    assert report["service_metrics"]["images"] == 4
@@ -0,0 +1,42 @@
+"""Test the rolling histograms and counters"""
+
+from ml_trial_task.metrics import RateMeter, RollingHistogram, ServiceMetrics
+
+
+def test_histogram_percentiles() -> None:
+    """Nearest-rank percentiles over the window only"""
+    histogram = RollingHistogram(window=100)
+    assert histogram.stats() == {"count": 0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    for value in range(1000, 1100):
+        histogram.add(float(value))
+    for value in range(1, 101):
+        histogram.add(float(value))
+    stats = histogram.stats()
+    assert stats["count"] == 200
+    assert (stats["p50"], stats["p95"], stats["p99"], stats["max"]) == (50.0, 95.0, 99.0, 100.0)
+    assert histogram.percentile(50) == 50.0
+
+
+def test_rate_meter() -> None:
+    """Rate is per second over the lifetime until the window is filled"""
+    meter = RateMeter(window_s=60)
+    meter._started -= 10.0  # pylint: disable=W0212
+    meter.add(5)
+    meter.add(15)
+    assert meter.total == 20
+    assert 1.9 < meter.rate() <= 2.0
+
+
+def test_service_metrics() -> None:
+    """Stages get their own histograms, errors and cached results are counted"""
+    metrics = ServiceMetrics(window=10)
+    metrics.record({"fetch": 5.0, "infer": 20.0, "total": 30.0}, nbytes=1000)
+    metrics.record({"fetch": 7.0, "total": 8.0}, nbytes=2000, cached=True)
+    metrics.record({"fetch": 1.0, "total": 1.0}, nbytes=0, failed=True)
+    stats = metrics.stats()
+    assert (stats["images"], stats["errors"], stats["cached"]) == (3, 1, 1)
+    assert stats["stages_ms"]["fetch"]["count"] == 3
+    assert stats["stages_ms"]["infer"]["p99"] == 20.0
+    assert stats["total_ms"]["max"] == 30.0
+    assert stats["bytes"]["count"] == 2
+    assert stats["images_per_s"] > 0
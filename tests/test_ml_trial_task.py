@@ -1,11 +1,16 @@
 """Package level tests"""
 
 import asyncio
+import json
+from pathlib import Path
+from typing import Any, Awaitable, Callable, cast
 
 import tomlkit
 import pytest
+from aiohttp import web
 from datastreamcorelib.datamessage import PubSubDataMessage
 from datastreamcorelib.pubsub import Subscription, PubSubMessage
+from datastreamcorelib.reqrep import REQMixinBase
 
 
 from ml_trial_task import __version__
@@ -26,6 +31,43 @@ def test_defaultconfig() -> None:
     parsed = tomlkit.parse(DEFAULT_CONFIG_STR).unwrap()
     assert "zmq" in parsed
     assert "pub_sockets" in parsed["zmq"]
+    assert "name" in parsed["model"]
+    assert "score_threshold" in parsed["model"]
+    assert "quantize" in parsed["model"]
+    assert "cache_dir" in parsed["model"]
+    assert "warmup_runs" in parsed["model"]
+    assert "max_depth" in parsed["queue"]
+    assert parsed["sources"]["file_roots"] == []
+    assert parsed["queue"]["policy"] == "fair"
+    assert "max_priority" in parsed["queue"]
+    for stage in ("fetch", "decode", "preprocess", "infer", "publish"):
+        assert f"{stage}_workers" in parsed["pipeline"]
+    assert "stage_queue_size" in parsed["pipeline"]
+    assert "max_pixels" in parsed["decode"]
+    assert parsed["memory"]["budget_mb"] == 2048
+    assert "max_batch_size" in parsed["batching"]
+    assert "max_wait_ms" in parsed["batching"]
+    assert "workers" in parsed["procpool"]
+    for key in ("workers", "intra_op_threads", "interop_threads", "pin_cpus"):
+        assert key in parsed["inference"]
+    assert "max_entries" in parsed["cache"]
+    assert "path" in parsed["cache"]
+    assert parsed["results"]["encoding"] == "json"
+    assert "score_dtype" in parsed["results"]
+    assert "interval_s" in parsed["metrics"]
+    assert "window" in parsed["metrics"]
+    assert "limit_per_host" in parsed["http"]
+    assert "dns_cache_ttl" in parsed["http"]
+    for key in ("total_timeout", "retries", "backoff_base", "backoff_max", "breaker_failures", "breaker_reset_s"):
+        assert key in parsed["http"]
+    assert parsed["http"]["hedge"] is False
+    assert "hedge_percentile" in parsed["http"]
+    assert "hedge_min_delay" in parsed["http"]
+    assert parsed["queue"]["default_ttl_s"] == 0
+    assert parsed["profiling"]["output_dir"] == ""
+    assert parsed["profiling"]["max_seconds"] > 0
+    assert parsed["http"]["body_cache_dir"] == ""
+    assert "body_cache_max_mb" in parsed["http"]
 
 
 @pytest.mark.asyncio
@@ -95,3 +137,228 @@ async def test_running_fixture(running_service_instance):  # type: ignore
 
     await asyncio.wait_for(hb_received(), timeout=5)
     assert hb_received_flag
+
+
+def record_published(serv: ImagePredictionService) -> list[PubSubDataMessage]:
+    """Collect what the service publishes"""
+    published: list[PubSubDataMessage] = []
+    publish = serv.psmgr.publish_async
+
+    async def recorder(msg: PubSubMessage, *args: Any) -> None:
+        published.append(cast(PubSubDataMessage, msg))
+        await publish(msg, *args)
+
+    serv.psmgr.publish_async = recorder  # type: ignore[method-assign,assignment]
+    return published
+
+
+async def wait_for_job(published: list[PubSubDataMessage], job_id: str) -> list[dict[str, Any]]:
+    """Results of the job once its completion marker is published"""
+    while not any(msg.data.get("complete") and msg.data.get("job_id") == job_id for msg in published):
+        await asyncio.sleep(0.05)
+    return [msg.data for msg in published if msg.data.get("job_id") == job_id and "url" in msg.data]
+
+
+async def predict_inline(
+    serv: ImagePredictionService, job_id: str, images: dict[str, bytes], **kwargs: Any
+) -> dict[str, Any]:
+    """Send the images (by name) as frames of a predict request, return the response"""
+    msg = REQMixinBase.construct_command("predict", [], job_id=job_id, inline=list(images), **kwargs)
+    msg.dataparts = [b"", b"", *images.values()]
+    reply = await serv.handle_rep_async(msg.zmq_encode())
+    return cast(dict[str, Any], reply.data["response"])
+
+
+@pytest.mark.asyncio
+async def test_inline_frames_and_local_files(
+    offline_config: dict[str, Any],
+    offline_service: Callable[[dict[str, Any]], Awaitable[ImagePredictionService]],
+    nice_tmpdir: str,
+    jpeg_bytes: bytes,
+) -> None:
+    """Images sent in frames and file:// URLs under the allowed roots go through the same path as fetched ones"""
+    roots = Path(nice_tmpdir) / "images"
+    roots.mkdir()
+    (roots / "red.jpg").write_bytes(jpeg_bytes)
+    (Path(nice_tmpdir) / "outside.jpg").write_bytes(jpeg_bytes)
+    offline_config["sources"] = {"file_roots": [str(roots)]}
+    serv = await offline_service(offline_config)
+    published = record_published(serv)
+
+    msg = REQMixinBase.construct_command(
+        "predict",
+        [f"file://{roots}/red.jpg", f"file://{roots}/../outside.jpg"],
+        job_id="inline",
+        inline=["cam1.jpg"],
+    )
+    msg.dataparts = [b"", b"", jpeg_bytes]
+    reply = await serv.handle_rep_async(msg.zmq_encode())
+    assert reply.data["response"]["num_images"] == 3
+    results = {result["url"]: result for result in await asyncio.wait_for(wait_for_job(published, "inline"), 60)}
+    assert set(results) == {f"file://{roots}/red.jpg", f"file://{roots}/../outside.jpg", "cam1.jpg"}
+    assert "error" not in results["cam1.jpg"]
+    assert results["cam1.jpg"]["bytes"] == len(jpeg_bytes)
+    assert "fetch" not in results["cam1.jpg"]["timings_ms"]
+    assert "error" not in results[f"file://{roots}/red.jpg"]
+    assert "not in an allowed directory" in results[f"file://{roots}/../outside.jpg"]["error"]
+
+    # Names must match the frames
+    msg = REQMixinBase.construct_command("predict", [], inline=["a.jpg", "b.jpg"])
+    msg.dataparts = [b"", b"", jpeg_bytes]
+    reply = await serv.handle_rep_async(msg.zmq_encode())
+    assert reply.data["response"]["status"] == "error"
+
+
+@pytest.mark.asyncio
+async def test_memory_budget(
+    offline_config: dict[str, Any],
+    offline_service: Callable[[dict[str, Any]], Awaitable[ImagePredictionService]],
+    jpeg_bytes: bytes,
+) -> None:
+    """Images wait for the budget instead of all being decoded at once, everything is given back when published"""
+    # Less than one image, so they go one at a time
+    offline_config["memory"] = {"budget_mb": 0.01}
+    serv = await offline_service(offline_config)
+    published = record_published(serv)
+    await predict_inline(serv, "budget", {name: jpeg_bytes for name in ("a.jpg", "b.jpg", "c.jpg")})
+    results = await asyncio.wait_for(wait_for_job(published, "budget"), 60)
+    assert len(results) == 3
+    assert all("error" not in result for result in results)
+    memory = (await serv.stats())["memory"]
+    assert memory["limit_bytes"] == int(0.01 * 1024 * 1024)
+    assert memory["in_use_bytes"] == 0
+    assert memory["peak_bytes"] == memory["limit_bytes"]
+    assert memory["waited"] >= 1
+
+
+@pytest.mark.asyncio
+async def test_reload_with_fewer_workers(
+    offline_config: dict[str, Any],
+    offline_service: Callable[[dict[str, Any]], Awaitable[ImagePredictionService]],
+    jpeg_bytes: bytes,
+) -> None:
+    """Images the retired workers were handling still get their results when the pool shrinks on reload"""
+    offline_config["pipeline"]["decode_workers"] = 4
+    serv = await offline_service(offline_config)
+    published = record_published(serv)
+    # Park the decode workers waiting for memory
+    serv.memory.resize(1000)
+    held = await serv.memory.reserve(1000)
+    await predict_inline(serv, "resized", {f"{idx}.jpg": jpeg_bytes for idx in range(6)})
+    while serv.pipeline["decode"].busy < 4:
+        await asyncio.sleep(0.05)
+    offline_config["pipeline"]["decode_workers"] = 1
+    serv.configpath.write_text(tomlkit.dumps(offline_config), encoding="utf-8")
+    serv.reload()
+    serv.memory.release(held)
+    results = await asyncio.wait_for(wait_for_job(published, "resized"), 60)
+    assert sorted(result["url"] for result in results) == [f"{idx}.jpg" for idx in range(6)]
+    assert all("error" not in result for result in results)
+    assert serv.pipeline["decode"].stats()["workers"] == 1
+    assert serv.pipeline["decode"].failed == 0
+
+
+@pytest.mark.asyncio
+async def test_procpool_weights_per_service(
+    offline_config: dict[str, Any],
+    offline_service: Callable[[dict[str, Any]], Awaitable[ImagePredictionService]],
+) -> None:
+    """Without a state_path the weights for the worker processes go to a temp dir of the service"""
+    offline_config["procpool"]["workers"] = 1
+    serv = await offline_service(offline_config)
+    assert serv.procpool is not None
+    state_dir = serv.procpool_dir
+    assert state_dir is not None
+    assert serv.procpool.state_path == state_dir / "weights.pt"
+    assert serv.procpool.state_path.exists()
+    serv.quit()
+    while state_dir.exists():
+        await asyncio.sleep(0.1)
+    assert serv.procpool_dir is None
+
+
+@pytest.mark.asyncio
+async def test_profile_command(
+    offline_config: dict[str, Any],
+    offline_service: Callable[[dict[str, Any]], Awaitable[ImagePredictionService]],
+    nice_tmpdir: str,
+    jpeg_bytes: bytes,
+) -> None:
+    """The live service is profiled on request, with the operators of the forward passes, and the summary written"""
+    offline_config["profiling"] = {"output_dir": str(Path(nice_tmpdir) / "profiles"), "max_seconds": 30}
+    serv = await offline_service(offline_config)
+    published = record_published(serv)
+
+    reply = await serv.handle_rep_async(REQMixinBase.construct_command("profile", 60.0).zmq_encode())
+    assert "at most" in reply.data["response"]["error"]
+    reply = await serv.handle_rep_async(
+        REQMixinBase.construct_command("profile", 5.0, torch_ops=True, top=10).zmq_encode()
+    )
+    assert reply.data["response"]["status"] == "profiling"
+    reply = await serv.handle_rep_async(REQMixinBase.construct_command("profile", 1.0).zmq_encode())
+    assert reply.data["response"]["error"] == "Already profiling"
+
+    await predict_inline(serv, "profiled", {"a.jpg": jpeg_bytes, "b.jpg": jpeg_bytes})
+    await asyncio.wait_for(wait_for_job(published, "profiled"), 60)
+    while not any(msg.topic == b"profile" for msg in published):
+        await asyncio.sleep(0.1)
+    summary = next(msg.data for msg in published if msg.topic == b"profile")
+    assert summary["mode"] == "sample"
+    assert summary["busy_samples"] > 0
+    assert 0 < len(summary["functions"]) <= 10
+    assert summary["torch"]["forward_passes"] >= 1
+    assert summary["torch"]["operators"]
+    assert json.loads(Path(summary["path"]).read_text(encoding="utf-8"))["mode"] == "sample"
+    assert serv.profiling is None
+
+    # Or wait for it
+    reply = await serv.handle_rep_async(REQMixinBase.construct_command("profile", 0.2, wait=True).zmq_encode())
+    assert reply.data["response"]["status"] == "done"
+    assert "functions" in reply.data["response"]
+
+
+@pytest.mark.asyncio
+async def test_expired_work_is_skipped(
+    offline_config: dict[str, Any],
+    offline_service: Callable[[dict[str, Any]], Awaitable[ImagePredictionService]],
+    jpeg_bytes: bytes,
+) -> None:
+    """Images whose requests gave up are skipped before fetching and before inference"""
+
+    async def slow(request: web.Request) -> web.Response:
+        _ = request
+        await asyncio.sleep(1.0)
+        return web.Response(body=jpeg_bytes, content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_get("/slow.jpg", slow)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    url = f"http://127.0.0.1:{runner.addresses[0][1]}/slow.jpg"
+    offline_config["pipeline"]["fetch_workers"] = 1
+    offline_config["queue"]["policy"] = "fifo"
+    serv = await offline_service(offline_config)
+    published = record_published(serv)
+    try:
+        # The only fetch worker is busy with the slow image for longer than the second job waits
+        await serv.handle_rep_async(REQMixinBase.construct_command("predict", [url], job_id="slow").zmq_encode())
+        assert (await predict_inline(serv, "impatient", {"a.jpg": jpeg_bytes}, ttl_s=0.3))["ttl_s"] == 0.3
+        results = await asyncio.wait_for(wait_for_job(published, "impatient"), 30)
+        assert results[0]["expired"] is True
+        assert "before fetch" in results[0]["error"]
+        assert "error" not in (await asyncio.wait_for(wait_for_job(published, "slow"), 30))[0]
+
+        # Waiting for memory, fetched but not run through the model in time
+        serv.memory.resize(1000)
+        held = await serv.memory.reserve(1000)
+        await predict_inline(serv, "late", {"b.jpg": jpeg_bytes, "c.jpg": jpeg_bytes}, ttl_s=0.3)
+        await asyncio.sleep(0.5)
+        serv.memory.release(held)
+        results = await asyncio.wait_for(wait_for_job(published, "late"), 30)
+        assert all(result["expired"] and "before infer" in result["error"] for result in results)
+        marker = next(msg.data for msg in published if msg.data.get("complete") and msg.data["job_id"] == "late")
+        assert (marker["num_expired"], marker["num_errors"]) == (2, 0)
+        assert (await serv.stats())["expired"] == {"fetch": 1, "infer": 2}
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,120 @@
+"""Test model loading helpers"""
+
+from pathlib import Path
+from typing import Any, Optional
+
+import pytest
+import torch
+from torchvision.models.detection import FasterRCNN_ResNet50_FPN_V2_Weights
+
+from ml_trial_task.benchmark import benchmark_inference, benchmark_model
+from ml_trial_task.executor import ExecutorConfig
+from ml_trial_task.models import ModelConfig, artifact_path, load_detector, quantize_dynamic, warm_up
+
+WEIGHTS = FasterRCNN_ResNet50_FPN_V2_Weights.DEFAULT
+
+
+class FakeDetector(torch.nn.Module):
+    """Stands in for a torchvision builder, "pretrained" means the weight is filled with ones"""
+
+    calls: list[dict[str, Any]] = []
+
+    def __init__(self, weights: Optional[Any] = None, **kwargs: Any) -> None:
+        super().__init__()
+        FakeDetector.calls.append({"weights": weights, **kwargs})
+        self.linear = torch.nn.Linear(2, 2)
+        self.forward_calls = 0
+        if weights is not None:
+            with torch.no_grad():
+                self.linear.weight.fill_(1.0)
+
+    def forward(self, images: list[torch.Tensor]) -> list[dict[str, torch.Tensor]]:  # pylint: disable=C0116
+        self.forward_calls += 1
+        return [{} for _ in images]
+
+
+def test_load_detector_uses_cache(tmp_path: Path) -> None:
+    """First load resolves the pretrained weights and saves them, second load only maps the saved file"""
+    FakeDetector.calls.clear()
+    first = load_detector(FakeDetector, WEIGHTS, tmp_path, box_score_thresh=0.5)
+    assert not first.training
+    assert artifact_path(tmp_path, WEIGHTS).exists()
+    assert FakeDetector.calls[-1] == {"weights": WEIGHTS, "box_score_thresh": 0.5}
+
+    second = load_detector(FakeDetector, WEIGHTS, tmp_path, box_score_thresh=0.5)
+    assert FakeDetector.calls[-1]["weights"] is None
+    assert FakeDetector.calls[-1]["weights_backbone"] is None
+    assert FakeDetector.calls[-1]["num_classes"] == len(WEIGHTS.meta["categories"])
+    assert torch.equal(first.state_dict()["linear.weight"], second.state_dict()["linear.weight"])
+
+
+def test_load_detector_without_cache(tmp_path: Path) -> None:
+    """Without a cache dir nothing gets saved"""
+    FakeDetector.calls.clear()
+    load_detector(FakeDetector, WEIGHTS, None)
+    load_detector(FakeDetector, WEIGHTS, None)
+    assert [call["weights"] for call in FakeDetector.calls] == [WEIGHTS, WEIGHTS]
+    assert not list(tmp_path.iterdir())
+
+
+def test_warm_up() -> None:
+    """Warm-up runs the requested number of forward passes"""
+    model = FakeDetector()
+    warm_up(model, runs=2, batch_size=3, image_size=8)
+    assert model.forward_calls == 2
+    warm_up(model, runs=0, batch_size=3, image_size=8)
+    assert model.forward_calls == 2
+
+
+def test_model_config() -> None:
+    """Config section parsing, validation and identity"""
+    config = ModelConfig.from_config(
+        {"name": "fasterrcnn_mobilenet_v3_large_fpn", "score_threshold": 0.5, "quantize": True, "cache_dir": ""}
+    )
+    assert config.spec.threshold_kwarg == "box_score_thresh"
+    assert config.cache_dir is None
+    assert config.artifact is None
+    assert config.identity.startswith("fasterrcnn_mobilenet_v3_large_fpn:")
+    assert config.identity.endswith(":int8")
+    assert config.categories[1] == "person"
+    assert ModelConfig(pretrained=False).identity == "fasterrcnn_resnet50_fpn_v2:random"
+    with pytest.raises(ValueError):
+        ModelConfig(name="nosuchmodel")
+    # Convolutions only, nothing for dynamic quantization
+    assert ModelConfig(name="ssdlite320_mobilenet_v3_large").spec.threshold_kwarg == "score_thresh"
+    with pytest.raises(ValueError, match="no Linear layers"):
+        ModelConfig(name="ssdlite320_mobilenet_v3_large", quantize=True)
+    with pytest.raises(ValueError, match="no Linear layers"):
+        quantize_dynamic(torch.nn.Conv2d(3, 8, 3))
+
+
+def test_model_config_load_quantized(tmp_path: Path) -> None:
+    """Float weights get saved before quantization and load back into the same architecture"""
+    config = ModelConfig(name="fasterrcnn_mobilenet_v3_large_320_fpn", pretrained=False, quantize=True)
+    state_path = tmp_path / "state.pt"
+    model = config.load(save_to=state_path)
+    assert state_path.exists()
+    assert isinstance(model.roi_heads.box_head.fc6, torch.ao.nn.quantized.dynamic.Linear)
+    reloaded = config.load(state_path=state_path)
+    assert not reloaded.training
+    with torch.inference_mode():
+        result = reloaded([torch.rand(3, 64, 64)])
+    assert set(result[0]) == {"boxes", "labels", "scores"}
+
+
+def test_benchmark_model() -> None:
+    """Benchmark reports the throughput"""
+    config = ModelConfig(name="fasterrcnn_mobilenet_v3_large_320_fpn", pretrained=False)
+    result = benchmark_model(config, batch_size=1, iterations=1, image_size=64)
+    assert result["model"] == "fasterrcnn_mobilenet_v3_large_320_fpn:random"
+    assert result["images_per_s"] > 0
+
+
+def test_benchmark_inference() -> None:
+    """One result per thread setting"""
+    config = ModelConfig(name="fasterrcnn_mobilenet_v3_large_320_fpn", pretrained=False)
+    settings = [ExecutorConfig(workers=1, intra_op_threads=1), ExecutorConfig(workers=2, intra_op_threads=1)]
+    results = benchmark_inference(config, settings, batch_size=1, iterations=2, image_size=64)
+    assert [result["setting"] for result in results] == ["1x1", "2x1"]
+    assert all(result["images_per_s"] > 0 for result in results)
+    assert results[0]["batch_ms"]["count"] == 2
@@ -0,0 +1,220 @@
+"""Test the bounded work queues"""
+
+import asyncio
+import time
+from typing import Any
+
+import pytest
+from libadvian.tasks import TaskMaster
+
+from ml_trial_task.jobs import Job
+from ml_trial_task.pipeline import FairQueue, InFlight, Pipeline, Stage, WorkItem
+
+
+@pytest.mark.asyncio
+async def test_offer_respects_maxsize() -> None:
+    """Items beyond the bound are refused while nothing drains the queue"""
+    handled: list[Any] = []
+
+    async def handler(item: Any) -> None:
+        handled.append(item)
+
+    stage = Stage("test", handler, workers=2, maxsize=3)
+    assert all(stage.offer(item) for item in range(3))
+    assert stage.full()
+    assert not stage.offer(3)
+    assert stage.stats()["depth"] == 3
+
+    tm = TaskMaster()
+    stage.start(tm)
+    await asyncio.wait_for(stage.queue.join(), timeout=1.0)
+    assert sorted(handled) == [0, 1, 2]
+    assert stage.processed == 3
+    assert stage.free == 3
+    await tm.stop_lingering_tasks()
+
+
+@pytest.mark.asyncio
+async def test_put_waits_for_room_and_failures_are_counted() -> None:
+    """put blocks while full and a failing handler does not kill the worker"""
+
+    async def handler(item: Any) -> None:
+        await asyncio.sleep(0.01)
+        if item == "bad":
+            raise ValueError(item)
+
+    stage = Stage("test", handler, workers=1, maxsize=1)
+    tm = TaskMaster()
+    stage.start(tm)
+    for item in ("bad", "good", "good"):
+        await asyncio.wait_for(stage.put(item), timeout=1.0)
+    await asyncio.wait_for(stage.queue.join(), timeout=1.0)
+    assert stage.failed == 1
+    assert stage.processed == 2
+    assert stage.avg_handling_s > 0
+    await tm.stop_lingering_tasks()
+
+
+@pytest.mark.asyncio
+async def test_start_resizes_worker_pool() -> None:
+    """Calling start again applies a changed worker count"""
+
+    async def handler(item: Any) -> None:
+        _ = item
+
+    stage = Stage("test", handler, workers=4)
+    tm = TaskMaster()
+    stage.start(tm)
+    await asyncio.sleep(0)
+    assert len(stage._tasks) == 4  # pylint: disable=W0212
+    stage.workers = 1
+    stage.start(tm)
+    await asyncio.sleep(0)
+    assert len(stage._tasks) == 1  # pylint: disable=W0212
+    await tm.stop_lingering_tasks()
+
+
+@pytest.mark.asyncio
+async def test_resize_down_keeps_items_being_handled() -> None:
+    """Surplus workers finish the item they are handling before they retire"""
+    release = asyncio.Event()
+    handled: list[int] = []
+
+    async def handler(item: int) -> None:
+        await release.wait()
+        handled.append(item)
+
+    stage = Stage("test", handler, workers=3)
+    tm = TaskMaster()
+    stage.start(tm)
+    for idx in range(5):
+        await stage.put(idx)
+    await asyncio.sleep(0.01)
+    assert stage.busy == 3
+    stage.workers = 1
+    stage.start(tm)
+    release.set()
+    await asyncio.wait_for(stage.queue.join(), timeout=1.0)
+    assert sorted(handled) == list(range(5))
+    assert stage.failed == 0
+    assert len([task for task in stage._tasks if not task.done()]) == 1  # pylint: disable=W0212
+    await tm.stop_lingering_tasks()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_passes_items_along() -> None:
+    """Handlers forward items to the next stage and stats show every stage"""
+    pipeline = Pipeline()
+    done: list[WorkItem] = []
+
+    async def first(item: WorkItem) -> None:
+        item.data = item.url.encode("utf-8")
+        await pipeline["second"].put(item)
+
+    async def second(item: WorkItem) -> None:
+        done.append(item)
+
+    pipeline.add(Stage("first", first, workers=2, maxsize=4))
+    pipeline.add(Stage("second", second, maxsize=1))
+    # Adding a stage with an existing name keeps the original
+    assert pipeline.add(Stage("first", second)).handler is first
+    tm = TaskMaster()
+    pipeline.start(tm)
+    for idx in range(10):
+        await pipeline["first"].put(WorkItem(f"url-{idx}"))
+    await asyncio.wait_for(pipeline["first"].queue.join(), timeout=1.0)
+    await asyncio.wait_for(pipeline["second"].queue.join(), timeout=1.0)
+    assert sorted(bytes(item.data or b"") for item in done) == sorted(f"url-{idx}".encode("utf-8") for idx in range(10))
+    stats = pipeline.stats()
+    assert stats["first"]["processed"] == 10
+    assert stats["second"]["processed"] == 10
+    assert stats["bottleneck"] is None
+    await tm.stop_lingering_tasks()
+
+
+def test_work_item_timed() -> None:
+    """Time spent in a stage adds up in timings_ms"""
+    item = WorkItem("http://example.com/img.jpg")
+    with item.timed("fetch"):
+        pass
+    with item.timed("fetch"):
+        pass
+    assert set(item.timings_ms) == {"fetch"}
+    assert 0.0 <= item.timings_ms["fetch"] <= item.elapsed_ms()
+
+
+def test_inflight_coalescing() -> None:
+    """Requests for a key in flight attach to the item until it is removed"""
+    inflight = InFlight()
+    item = WorkItem("http://example.com/a.jpg", key="k")
+    assert not inflight.attach("k", "http://example.com/a.jpg")
+    inflight.add(item)
+    assert inflight.attach("k", "HTTP://example.com/a.jpg")
+    assert item.duplicates == [("HTTP://example.com/a.jpg", None)]
+    inflight.remove(item)
+    assert not inflight.attach("k", "http://example.com/a.jpg")
+    assert inflight.stats() == {"entries": 0, "coalesced": 1}
+
+
+def test_work_item_past_deadline() -> None:
+    """An item is only given up when every job waiting for it has expired"""
+    expired, waiting = Job(deadline=0.0), Job(deadline=time.monotonic() + 60)
+    assert not WorkItem("http://example.com/a.jpg").past_deadline()
+    assert not WorkItem("http://example.com/a.jpg", job=Job()).past_deadline()
+    item = WorkItem("http://example.com/a.jpg", job=expired)
+    assert item.past_deadline()
+    item.duplicates.append(("http://example.com/a.jpg", waiting))
+    assert not item.past_deadline()
+    item.duplicates[0] = ("http://example.com/a.jpg", expired)
+    assert item.past_deadline()
+
+
+def _by_tag(item: str) -> tuple[Any, float]:
+    """Flow "a1" -> a with weight 1"""
+    return item[0], float(item[1])
+
+
+@pytest.mark.asyncio
+async def test_fair_queue_interleaves_flows() -> None:
+    """A small flow queued behind a big one is served right away, weights set the share, order is kept per flow"""
+    queue = FairQueue(_by_tag)
+    for _ in range(50):
+        queue.put_nowait("b1")
+    assert queue.get_nowait() == "b1"
+    for _ in range(3):
+        queue.put_nowait("s1")
+    assert queue.flows == 2
+    assert [queue.get_nowait() for _ in range(6)] == ["s1", "b1", "s1", "b1", "s1", "b1"]
+
+    queue = FairQueue(_by_tag)
+    for idx in range(6):
+        queue.put_nowait(f"h2{idx}")
+        queue.put_nowait(f"l1{idx}")
+    order = [queue.get_nowait() for _ in range(6)]
+    assert sum(item.startswith("h") for item in order) == 4
+    assert [item for item in order if item.startswith("h")] == ["h20", "h21", "h22", "h23"]
+
+    fifo = FairQueue()
+    for item in ("x1", "y1", "x1", "z1"):
+        fifo.put_nowait(item)
+    assert [await fifo.get() for _ in range(4)] == ["x1", "y1", "x1", "z1"]
+    assert fifo.flows == 0
+
+
+@pytest.mark.asyncio
+async def test_stage_with_fair_queue() -> None:
+    """The workers take the items in fair order"""
+    handled: list[str] = []
+
+    async def handler(item: str) -> None:
+        handled.append(item)
+
+    stage = Stage("fair", handler, workers=1, queue=FairQueue(_by_tag))
+    for item in ["b1"] * 4 + ["s1"]:
+        assert stage.offer(item)
+    assert stage.stats()["flows"] == 2
+    tm = TaskMaster()
+    stage.start(tm)
+    await asyncio.wait_for(stage.queue.join(), timeout=1.0)
+    assert handled.index("s1") == 1
+    await tm.stop_lingering_tasks()
@@ -0,0 +1,82 @@
+"""Test the inference process pool with a tiny stand-in detector"""
+
+import functools
+import io
+from pathlib import Path
+from typing import Any, Callable
+
+import pytest
+import torch
+from PIL import Image
+from torchvision.transforms.functional import convert_image_dtype
+
+from ml_trial_task.decoding import Decoder
+from ml_trial_task.models import assign_state_dict
+from ml_trial_task.procpool import InferenceProcessPool, convert_prediction
+
+
+class TinyDetector(torch.nn.Module):
+    """Reports one box covering the image, scored by a learned weight"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.score = torch.nn.Parameter(torch.tensor([0.0]))
+
+    def forward(self, images: list[torch.Tensor]) -> list[dict[str, torch.Tensor]]:  # pylint: disable=C0116
+        return [
+            {
+                "boxes": torch.tensor([[0.0, 0.0, float(img.shape[2]), float(img.shape[1])]]),
+                "labels": torch.tensor([1]),
+                "scores": self.score.clone(),
+            }
+            for img in images
+        ]
+
+
+def load_tiny(path: Path) -> TinyDetector:
+    """Loader run in the worker process"""
+    model = TinyDetector()
+    assign_state_dict(model, path)
+    return model.eval()
+
+
+def tiny_transforms() -> Callable[[Any], torch.Tensor]:
+    """Same shape as the weights.transforms factory, takes the uint8 tensors from the decoder"""
+    return functools.partial(convert_image_dtype, dtype=torch.float)
+
+
+def test_convert_prediction() -> None:
+    """Tensors are turned into plain lists with category names"""
+    pred = TinyDetector()([torch.zeros(3, 4, 5)])[0]
+    assert convert_prediction(pred, ["background", "thing"]) == {
+        "boxes": [[0, 0, 5, 4]],
+        "labels": ["thing"],
+        "scores": [0.0],
+    }
+    assert convert_prediction(pred, ["background", "thing"], scale=(2.0, 0.5))["boxes"] == [[0, 0, 10, 2]]
+
+
+@pytest.mark.asyncio
+async def test_detect_in_worker_process(tmp_path: Path) -> None:
+    """Workers rebuild the model from the exported weights and return results in original image coordinates"""
+    model = TinyDetector()
+    with torch.no_grad():
+        model.score.fill_(0.75)
+    pool = InferenceProcessPool(
+        loader=functools.partial(load_tiny, tmp_path / "weights.pt"),
+        state_path=tmp_path / "weights.pt",
+        preprocess=tiny_transforms,
+        categories=["background", "thing"],
+        decoder=Decoder(min_size=4, max_size=8),
+        workers=1,
+    )
+    pool.export(model)
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 32)).save(buf, format="PNG")
+    try:
+        result = await pool.detect(buf.getvalue())
+        assert pool.stats()["running"]
+    finally:
+        pool.shutdown()
+    assert result == {"boxes": [[0, 0, 64, 32]], "labels": ["thing"], "scores": [0.75]}
+    assert not pool.stats()["running"]
@@ -0,0 +1,71 @@
+"""Test the on-demand profiling"""
+
+import threading
+import time
+from types import CodeType, SimpleNamespace
+from typing import cast
+
+import pytest
+import torch
+
+from ml_trial_task.profiling import ProfileSession, TorchOperators, code_label
+
+
+def spin(stop: threading.Event) -> None:
+    """Keep a thread busy"""
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampling_sees_other_threads() -> None:
+    """A busy thread shows up in the samples, the sampler only while running"""
+    stop = threading.Event()
+    thread = threading.Thread(target=spin, args=(stop,))
+    thread.start()
+    session = ProfileSession(0.3, top=5)
+    try:
+        session.start()
+        time.sleep(0.3)
+        summary = session.stop()
+    finally:
+        stop.set()
+        thread.join()
+    assert summary["mode"] == "sample"
+    assert summary["busy_samples"] > 0
+    assert len(summary["functions"]) <= 5
+    assert any(row["function"].startswith("spin ") and row["total"] > 0 for row in summary["functions"])
+    assert not any(thread.name == "profile-sampler" for thread in threading.enumerate())
+
+
+def test_code_label() -> None:
+    """Functions are labelled by qualified name where the interpreter has one (3.11+), by name before that"""
+    assert code_label(spin.__code__).startswith("spin (test_profiling.py:")
+    code = SimpleNamespace(co_name="run", co_filename="/src/worker.py", co_firstlineno=7)
+    assert code_label(cast(CodeType, code)) == "run (worker.py:7)"
+
+
+def test_cprofile_and_validation() -> None:
+    """cProfile counts the calls in this thread, nonsense is refused"""
+    session = ProfileSession(1.0, mode="cprofile")
+    session.start()
+    for _ in range(3):
+        sum(range(10000))
+    summary = session.stop()
+    assert summary["mode"] == "cprofile"
+    assert summary["functions"][0]["own_s"] >= summary["functions"][-1]["own_s"]
+    with pytest.raises(ValueError):
+        ProfileSession(1.0, mode="perf")
+    with pytest.raises(ValueError):
+        ProfileSession(0.0)
+
+
+def test_torch_operators() -> None:
+    """Forward passes run through TorchOperators are summed up by operator"""
+    operators = TorchOperators()
+    model = torch.nn.Linear(8, 4)
+    for _ in range(2):
+        assert operators.run(lambda: model(torch.zeros(2, 8))).shape == (2, 4)
+    summary = operators.summary(10)
+    assert summary["forward_passes"] == 2
+    assert summary["operators"]
+    assert any(row["operator"] in ("aten::linear", "aten::addmm") for row in summary["operators"])
@@ -0,0 +1,129 @@
+"""Test streaming submission"""
+
+import asyncio
+import json
+from pathlib import Path
+from typing import Any, cast
+
+import pytest
+from datastreamcorelib.datamessage import PubSubDataMessage
+from datastreamcorelib.pubsub import Subscription
+from datastreamservicelib.reqrep import REQMixin
+
+from ml_trial_task.streaming import JsonlSink, ParquetSink, Progress, StreamingSubmitter, make_sink, read_urls
+
+
+def test_read_urls_is_lazy(tmp_path: Path) -> None:
+    """Rows come one at a time, the header and empty cells are skipped"""
+    path = tmp_path / "urls.csv"
+    path.write_text("id,url\n1,http://a/1.jpg\n2,\n3, http://a/3.jpg \n", encoding="utf-8")
+    urls = read_urls(path, column=1)
+    assert next(urls) == "http://a/1.jpg"
+    assert list(urls) == ["http://a/3.jpg"]
+
+
+def test_jsonl_sink(tmp_path: Path) -> None:
+    """One result per line"""
+    sink = make_sink(tmp_path / "out.jsonl")
+    assert isinstance(sink, JsonlSink)
+    sink.write({"url": "a", "labels": ["cat"]})
+    sink.write({"url": "b", "error": "boom"})
+    sink.close()
+    lines = (tmp_path / "out.jsonl").read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["url"] for line in lines] == ["a", "b"]
+
+
+def test_parquet_sink(tmp_path: Path) -> None:
+    """Rows are written in row groups"""
+    parquet = pytest.importorskip("pyarrow.parquet")
+    sink = make_sink(tmp_path / "out.parquet")
+    assert isinstance(sink, ParquetSink)
+    sink.batch_rows = 2
+    for idx in range(3):
+        sink.write({"url": f"u{idx}", "boxes": [[1, 2, 3, 4]], "labels": ["cat"], "scores": [0.5], "bytes": 10})
+    sink.write({"url": "bad", "error": "boom"})
+    sink.close()
+    table = parquet.read_table(tmp_path / "out.parquet")
+    assert table.num_rows == 4
+    assert table.column("url").to_pylist() == ["u0", "u1", "u2", "bad"]
+    assert table.column("boxes").to_pylist()[0] == [[1, 2, 3, 4]]
+    assert table.column("error").to_pylist()[-1] == "boom"
+
+
+class FakeService:  # pylint: disable=R0903
+    """Answers predict like the service with a small queue and "publishes" the results shortly after"""
+
+    def __init__(self, submitter_ref: list[StreamingSubmitter], queue_size: int) -> None:
+        self.submitter_ref = submitter_ref
+        self.queue_size = queue_size
+        self.queued = 0
+        self.max_in_flight = 0
+        self.tasks: list[asyncio.Task[None]] = []
+
+    async def send_command(self, socket: str, cmd: str, *args: Any, **kwargs: Any) -> PubSubDataMessage:
+        """Accept what fits in the queue"""
+        _ = socket, cmd
+        urls, job_id = args[0], kwargs["job_id"]
+        accepted = urls[: max(0, self.queue_size - self.queued)]
+        self.queued += len(accepted)
+        submitter = self.submitter_ref[0]
+        self.max_in_flight = max(self.max_in_flight, submitter.in_flight + len(accepted))
+        self.tasks.append(asyncio.create_task(self._publish(job_id, accepted)))
+        return PubSubDataMessage(topic="reply", data={"response": {"num_images": len(accepted)}})
+
+    async def _publish(self, job_id: str, urls: list[str]) -> None:
+        """Results one by one, then the completion marker"""
+        submitter = self.submitter_ref[0]
+        sub = cast(Subscription, None)
+        for url in urls:
+            await asyncio.sleep(0.001)
+            self.queued -= 1
+            msg = PubSubDataMessage(topic=f"results/{job_id}/", data={"url": url, "job_id": job_id, "labels": []})
+            await submitter._on_message(sub, msg)  # pylint: disable=W0212
+        marker = PubSubDataMessage(topic=f"results/{job_id}/", data={"job_id": job_id, "complete": True})
+        await submitter._on_message(sub, marker)  # pylint: disable=W0212
+
+
+@pytest.mark.asyncio
+async def test_streaming_submitter(tmp_path: Path) -> None:
+    """Everything ends up in the sink exactly once, the window is respected and rejected URLs are resent"""
+    ref: list[StreamingSubmitter] = []
+    service = FakeService(ref, queue_size=25)
+    lines: list[str] = []
+    submitter = StreamingSubmitter(
+        cast(REQMixin, service),
+        "ipc:///nonexistent-rep",
+        f"ipc://{tmp_path}/pub.sock",
+        JsonlSink(tmp_path / "out.jsonl"),
+        chunk_size=10,
+        window=30,
+        progress=Progress(3600.0, lines.append),
+    )
+    ref.append(submitter)
+    urls = (f"http://a/{idx}.jpg" for idx in range(105))
+    await asyncio.wait_for(submitter.run(urls, subscribe_grace_s=0.0), timeout=30.0)
+    results = [json.loads(line) for line in (tmp_path / "out.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert sorted(result["url"] for result in results) == sorted(f"http://a/{idx}.jpg" for idx in range(105))
+    assert submitter.received == submitter.submitted == 105
+    assert service.max_in_flight <= 30
+    assert submitter.rejected > 0
+    # Rate limited, only the final forced report
+    assert len(lines) == 1
+    assert lines[0].startswith("sent 105 done 105")
+
+
+@pytest.mark.asyncio
+async def test_streaming_submitter_skips_other_sessions(tmp_path: Path) -> None:
+    """Results of jobs whose ID only starts like ours are not written"""
+    submitter = StreamingSubmitter(
+        cast(REQMixin, None), "ipc:///nonexistent-rep", f"ipc://{tmp_path}/pub.sock", JsonlSink(tmp_path / "out.jsonl")
+    )
+    sub = cast(Subscription, None)
+    for job_id in (f"{submitter.session}-x-0", f"{submitter.session}x-0", None):
+        msg = PubSubDataMessage(topic=f"results/{job_id}/", data={"url": "a", "job_id": job_id, "labels": []})
+        await submitter._on_message(sub, msg)  # pylint: disable=W0212
+    assert submitter.received == 0
+    msg = PubSubDataMessage(topic="x", data={"url": "a", "job_id": f"{submitter.session}-0", "labels": []})
+    await submitter._on_message(sub, msg)  # pylint: disable=W0212
+    submitter.sink.close()
+    assert submitter.received == 1
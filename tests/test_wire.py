@@ -0,0 +1,64 @@
+"""Test the binary result encoding"""
+
+import numpy as np
+import pytest
+from datastreamcorelib.datamessage import PubSubDataMessage
+
+from ml_trial_task.wire import (
+    ResultEncoding,
+    category_index,
+    decode_detections,
+    decode_message,
+    encode_detections,
+    encode_message,
+)
+
+CATEGORIES = ["__background__", "person", "N/A", "car", "N/A"]
+DETECTIONS = {"boxes": [[1, 2, 30, 40], [5, 6, 7, 8]], "labels": ["car", "N/A"], "scores": [0.5, 0.25]}
+
+
+def test_round_trip() -> None:
+    """Decoding gives back the json form"""
+    description, frames = encode_detections(DETECTIONS, category_index(CATEGORIES))
+    assert description == {"encoding": "binary", "count": 2, "dtypes": ["<i2", "|u1", "<f2"]}
+    assert [len(frame) for frame in frames] == [16, 2, 4]
+    assert decode_detections({"url": "x", **description}, frames, CATEGORIES) == {"url": "x", **DETECTIONS}
+
+
+def test_wide_boxes_and_float32() -> None:
+    """Coordinates that do not fit in int16 use int32, scores can be float32"""
+    detections = {"boxes": [[0, 0, 40000, 10]], "labels": ["person"], "scores": [0.123456]}
+    description, frames = encode_detections(detections, category_index(CATEGORIES), "float32")
+    assert description["dtypes"] == ["<i4", "|u1", "<f4"]
+    decoded = decode_detections(description, frames, CATEGORIES, as_arrays=True)
+    assert decoded["boxes"].shape == (1, 4)
+    assert decoded["boxes"][0, 2] == 40000
+    assert decoded["scores"][0] == np.float32(0.123456)
+
+
+def test_empty() -> None:
+    """No detections is three empty frames"""
+    description, frames = encode_detections({"boxes": [], "labels": [], "scores": []}, category_index(CATEGORIES))
+    assert description["count"] == 0
+    assert decode_detections(description, frames, CATEGORIES) == {"boxes": [], "labels": [], "scores": []}
+
+
+def test_message_frames() -> None:
+    """The frames survive the ZMQ encoding, json results pass through the decoder"""
+    description, frames = encode_detections(DETECTIONS, category_index(CATEGORIES))
+    parts = encode_message("results", {"url": "x", **description}, frames).zmq_encode()
+    assert len(parts) == 6
+    received = PubSubDataMessage.zmq_decode(parts)
+    assert decode_message(received, CATEGORIES)["labels"] == ["car", "N/A"]
+    plain = PubSubDataMessage.zmq_decode(encode_message("results", {"url": "x", **DETECTIONS}).zmq_encode())
+    assert decode_message(plain, CATEGORIES) == {"url": "x", **DETECTIONS}
+
+
+def test_result_encoding_config() -> None:
+    """json by default, typos are rejected"""
+    assert not ResultEncoding.from_config({}).binary
+    assert ResultEncoding.from_config({"encoding": "binary"}).binary
+    with pytest.raises(ValueError):
+        ResultEncoding(encoding="protobuf")
+    with pytest.raises(ValueError):
+        ResultEncoding(score_dtype="int8")